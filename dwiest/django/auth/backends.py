@@ -0,0 +1,27 @@
+from django.contrib.auth import backends, get_user_model
+
+class ModelBackend(backends.ModelBackend):
+  '''
+  Loads the user's MFA record in the same query as the user, so the
+  login form and the user_logged_in handlers don't have to fetch it.
+  '''
+
+  def authenticate(self, request, username=None, password=None, **kwargs):
+    UserModel = get_user_model()
+
+    if username is None:
+      username = kwargs.get(UserModel.USERNAME_FIELD)
+
+    if username is None or password is None:
+      return
+
+    try:
+      user = UserModel._default_manager.select_related('mfamodel').get(
+        **{UserModel.USERNAME_FIELD: username})
+    except UserModel.DoesNotExist:
+      # hash the password anyway so a missing user takes as long as a
+      # wrong password
+      UserModel().set_password(password)
+    else:
+      if user.check_password(password) and self.user_can_authenticate(user):
+        return user
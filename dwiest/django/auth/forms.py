@@ -1,10 +1,13 @@
 from django.contrib.auth import forms
-from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.forms import CharField
+from django.core.exceptions import ValidationError
+from django.forms import BooleanField, CharField
 from django.utils.translation import gettext, gettext_lazy as _
 from enum import Enum, auto
-import pyotp
-from ..users.mfa import MfaModel, NonstickyTextInput
+from ..users.mfa import NonstickyTextInput
+from ..users.mfa.replay import accept_step
+from ..users.mfa.status import get_user_mfa
+from ..users.mfa.trust import is_trusted
+from ..users.mfa.totp import verify
 from ..users.conf import settings
 
 class AuthenticationForm(forms.AuthenticationForm):
@@ -16,6 +19,7 @@ class AuthenticationForm(forms.AuthenticationForm):
 
   class Fields(str, Enum):
     MFA_TOKEN = 'mfa_token'
+    TRUST_DEVICE = 'trust_device'
 
   CLASS = 'class'
   SIZE = 'size'
@@ -33,6 +37,15 @@ class AuthenticationForm(forms.AuthenticationForm):
       )
     )
 
+  trust_device = BooleanField(
+    label=_(settings.USERS_LOGIN_TRUST_DEVICE_FIELD_LABEL),
+    required=False,
+    )
+
+  # set by clean() for the view, see LoginView.form_valid()
+  user_mfa = None
+  device_trusted = False
+
   forms.AuthenticationForm.error_messages.update({
     Errors.MFA_TOKEN_INVALID:
       _(settings.USERS_LOGIN_MFA_TOKEN_INVALID_ERROR),
@@ -49,37 +62,42 @@ class AuthenticationForm(forms.AuthenticationForm):
       mfa_token = None
 
     if mfa_token != None:
-      try:
-        user_mfa = MfaModel.objects.get(user_id=self.user_cache.id)
-        totp = pyotp.TOTP(user_mfa.secret_key)
-
-        if mfa_token != totp.now():
-          print("invalid_mfa_token")
-          raise AuthenticationForm.get_mfa_token_invalid_error()
-        elif mfa_token == user_mfa.last_value:
-          print("replayed_mfa_token")
-          raise AuthenticationForm.get_mfa_token_replayed_error()
-        else:
-          print("valid_mfa_token")
-          user_mfa.last_value = mfa_token
-          user_mfa.save()
-
-      except ObjectDoesNotExist:
-          print("No MFA object for user")
-          raise AuthenticationForm.get_mfa_token_invalid_error()
+      # loaded with the user by auth.backends.ModelBackend
+      user_mfa = get_user_mfa(self.user_cache)
+      self.user_mfa = user_mfa
+
+      if is_trusted(self.request, self.user_cache, user_mfa):
+        print("trusted_device")
+        self.device_trusted = True
+        return self.cleaned_data
+
+      if user_mfa is None:
+        print("No MFA object for user")
+        raise AuthenticationForm.get_mfa_token_invalid_error()
+
+      step = verify(user_mfa.secret_key, mfa_token)
+
+      if step is None:
+        print("invalid_mfa_token")
+        raise AuthenticationForm.get_mfa_token_invalid_error()
+      elif not accept_step(user_mfa, step):
+        print("replayed_mfa_token")
+        raise AuthenticationForm.get_mfa_token_replayed_error()
+      else:
+        print("valid_mfa_token")
 
     return self.cleaned_data
 
   @classmethod
   def get_mfa_token_invalid_error(cls):
     return ValidationError(
-      cls.error_messages[Errors.MFA_TOKEN_INVALID],
-      code=Errors.MFA_TOKEN_INVALID,
+      cls.error_messages[cls.Errors.MFA_TOKEN_INVALID],
+      code=cls.Errors.MFA_TOKEN_INVALID,
     )
 
   @classmethod
   def get_mfa_token_replayed_error(cls):
     return ValidationError(
-      cls.error_messages[Errors.MFA_TOKEN_REPLAYED],
-      code=Errors.MFA_TOKEN_REPLAYED,
+      cls.error_messages[cls.Errors.MFA_TOKEN_REPLAYED],
+      code=cls.Errors.MFA_TOKEN_REPLAYED,
     )
@@ -3,10 +3,30 @@ from ..users import views as myViews
 from .forms import AuthenticationForm
 from ..users.conf import settings
 from ..users.forms import PasswordChangeForm
+from ..users.mfa.trust import revoke, trust_device
 
 class LoginView(views.LoginView):
   form_class = AuthenticationForm
   template_name = settings.USERS_LOGIN_TEMPLATE
 
+  def form_valid(self, form):
+    response = super().form_valid(form)
+
+    # only a login that checked the MFA token can trust a device
+    if (form.cleaned_data.get(form.Fields.TRUST_DEVICE)
+        and form.user_mfa is not None and not form.device_trusted):
+      trust_device(self.request, response, form.get_user(), form.user_mfa)
+
+    return response
+
 class PasswordChangeView(myViews.PasswordChangeView):
   form_class = PasswordChangeForm
+
+  def post(self, request, *args, **kwargs):
+    response = super().post(request, *args, **kwargs)
+
+    # the new password hash already invalidates it, this just tidies up
+    if response.status_code == 302:
+      revoke(response)
+
+    return response
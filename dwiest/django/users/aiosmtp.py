@@ -0,0 +1,329 @@
+from asgiref.sync import sync_to_async
+import asyncio
+import base64
+import re
+import smtplib
+import ssl
+from . import metrics
+from .conf import settings
+from .email import (
+  generate_account_activation_email,
+  generate_password_changed_email,
+  generate_password_reset_email,
+  generate_registration_email,
+  serialize,
+  )
+from .mfa.email import generate_mfa_disabled_email, generate_mfa_enabled_email
+from .notifications import Notification
+
+CRLF = b'\r\n'
+
+
+class AsyncSMTP:
+  '''
+  A minimal SMTP client built on asyncio streams.  Supports implicit TLS,
+  STARTTLS, AUTH PLAIN/LOGIN and pipelines MAIL/RCPT/DATA when the
+  server advertises PIPELINING.
+  '''
+
+  def __init__(self, host, port, use_ssl=False, starttls=False,
+    local_hostname='localhost', ssl_context=None, proxy_server=None,
+    proxy_port=None, timeout=None, command_timeout=None):
+
+    self.host = host
+    self.port = port
+    self.proxy_server = proxy_server
+    self.proxy_port = proxy_port
+    self.use_ssl = use_ssl
+    self.starttls = starttls
+    self.local_hostname = local_hostname
+    self.ssl_context = ssl_context
+    self.timeout = timeout
+    self.command_timeout = command_timeout
+    self.extensions = {}
+    self.reader = None
+    self.writer = None
+    self.plain_writer = None
+
+  async def connect(self):
+    context = None
+    if self.use_ssl:
+      context = self.ssl_context or ssl.create_default_context()
+
+    if self.proxy_server:
+      import socks
+      # PySocks only offers a blocking handshake, run it off the loop
+      sock = await asyncio.get_running_loop().run_in_executor(
+        None,
+        lambda: socks.create_connection(
+          (self.host, self.port),
+          proxy_type=socks.SOCKS5,
+          proxy_addr=self.proxy_server,
+          proxy_port=self.proxy_port,
+          timeout=self.timeout,
+          ),
+        )
+      sock.setblocking(False)
+      connection = asyncio.open_connection(
+        sock=sock, ssl=context,
+        server_hostname=self.host if context else None)
+
+    else:
+      connection = asyncio.open_connection(self.host, self.port, ssl=context)
+
+    self.reader, self.writer = await asyncio.wait_for(connection, self.timeout)
+
+    await self.expect(220)
+    await self.ehlo()
+
+    if self.starttls and not self.use_ssl:
+      await self.command(b'STARTTLS', 220)
+      await self.start_tls(self.ssl_context or ssl.create_default_context())
+      await self.ehlo()
+
+  async def start_tls(self, context):
+    if hasattr(self.writer, 'start_tls'):
+      await self.writer.start_tls(context, server_hostname=self.host)
+      return
+
+    # StreamWriter.start_tls() was added in Python 3.11, before that the
+    # streams have to be rebuilt on the upgraded transport
+    loop = asyncio.get_running_loop()
+    transport = await loop.start_tls(
+      self.writer.transport, self.writer.transport.get_protocol(), context,
+      server_hostname=self.host)
+
+    reader = asyncio.StreamReader(loop=loop)
+    protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+    transport.set_protocol(protocol)
+    protocol.connection_made(transport)
+
+    # the plain writer closes the socket under TLS if it is collected
+    self.plain_writer = self.writer
+    self.reader = reader
+    self.writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+
+  async def ehlo(self):
+    code, lines = await self.command(
+      'EHLO {}'.format(self.local_hostname).encode('ascii'), 250)
+
+    self.extensions = {}
+    for line in lines[1:]:
+      keyword, _, params = line.partition(b' ')
+      self.extensions[keyword.decode('ascii').upper()] = params.decode('ascii')
+
+  async def login(self, user, password):
+    mechanisms = self.extensions.get('AUTH', '').upper().split()
+
+    if 'PLAIN' in mechanisms or not mechanisms:
+      token = base64.b64encode(
+        '\0{}\0{}'.format(user, password).encode('utf-8'))
+      await self.command(b'AUTH PLAIN ' + token, 235)
+
+    else:
+      await self.command(b'AUTH LOGIN', 334)
+      await self.command(base64.b64encode(user.encode('utf-8')), 334)
+      await self.command(base64.b64encode(password.encode('utf-8')), 235)
+
+  async def sendmail(self, sender, recipients, message):
+    if isinstance(message, str):
+      message = message.encode('utf-8')
+
+    mail = b'MAIL FROM:<' + sender.encode('ascii') + b'>'
+    rcpts = [b'RCPT TO:<' + r.encode('ascii') + b'>' for r in recipients]
+
+    if 'PIPELINING' in self.extensions:
+      commands = [mail] + rcpts + [b'DATA']
+      self.writer.write(b''.join(c + CRLF for c in commands))
+      await self.writer.drain()
+      replies = [await self.read_reply() for c in commands]
+      mail_reply, rcpt_replies, data_reply = replies[0], replies[1:-1], replies[-1]
+
+    else:
+      # without pipelining stop as soon as the transaction can't succeed
+      rcpt_replies = []
+      data_reply = (None, [])
+      mail_reply = await self.send(mail)
+
+      if mail_reply[0] == 250:
+        for rcpt in rcpts:
+          rcpt_replies.append(await self.send(rcpt))
+
+        if any(code in (250, 251) for code, lines in rcpt_replies):
+          data_reply = await self.send(b'DATA')
+
+    refused = {}
+    for recipient, (code, lines) in zip(recipients, rcpt_replies):
+      if code not in (250, 251):
+        refused[recipient] = (code, b'\n'.join(lines))
+
+    mail_code, mail_lines = mail_reply
+    data_code, data_lines = data_reply
+
+    if mail_code != 250 or len(refused) == len(recipients) or data_code != 354:
+      if data_code == 354:
+        # a pipelined DATA was accepted anyway, end it empty
+        self.writer.write(b'.' + CRLF)
+        await self.writer.drain()
+        await self.read_reply()
+      await self.rset()
+
+      if mail_code != 250:
+        raise smtplib.SMTPSenderRefused(mail_code, b'\n'.join(mail_lines), sender)
+      if len(refused) == len(recipients):
+        raise smtplib.SMTPRecipientsRefused(refused)
+      raise smtplib.SMTPDataError(data_code, b'\n'.join(data_lines))
+
+    data = re.sub(br'(?:\r\n|\n|\r(?!\n))', CRLF, message)
+    data = re.sub(br'(?m)^\.', b'..', data)
+    if not data.endswith(CRLF):
+      data += CRLF
+
+    self.writer.write(data + b'.' + CRLF)
+    await self.writer.drain()
+    await self.expect(250, smtplib.SMTPDataError)
+
+    return refused
+
+  async def rset(self):
+    try:
+      await self.command(b'RSET', 250)
+    except smtplib.SMTPException:
+      pass
+
+  async def quit(self):
+    try:
+      await self.command(b'QUIT', 221)
+    finally:
+      await self.close()
+
+  async def close(self):
+    if self.writer is not None:
+      self.writer.close()
+      try:
+        await self.writer.wait_closed()
+      except OSError:
+        pass
+      self.writer = None
+      self.plain_writer = None
+
+  async def command(self, line, expected_code):
+    self.writer.write(line + CRLF)
+    await self.writer.drain()
+    return await self.expect(expected_code)
+
+  async def send(self, line):
+    '''
+    Send a command and return its reply, whatever the code.
+    '''
+    self.writer.write(line + CRLF)
+    await self.writer.drain()
+    return await self.read_reply()
+
+  async def expect(self, expected_code, error=smtplib.SMTPResponseException):
+    code, lines = await self.read_reply()
+    if code != expected_code:
+      raise error(code, b'\n'.join(lines))
+    return code, lines
+
+  async def read_reply(self):
+    lines = []
+
+    while True:
+      line = await asyncio.wait_for(self.reader.readline(), self.command_timeout)
+      if not line:
+        raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+      code, separator, text = line[:3], line[3:4], line[4:].rstrip(b'\r\n')
+      lines.append(text)
+
+      if separator != b'-':
+        return int(code), lines
+
+async def send_email_async(recipients, message,
+  sender=settings.DEFAULT_FROM_EMAIL,
+  smtp_server=settings.EMAIL_HOST,
+  smtp_server_port=settings.EMAIL_PORT,
+  smtp_server_login=settings.EMAIL_HOST_USER,
+  smtp_server_password=settings.EMAIL_HOST_PASSWORD,
+  proxy_server=settings.PROXY_SERVER,
+  proxy_port=settings.PROXY_PORT):
+  '''
+  The asyncio counterpart of email.send_email().  message may be a
+  message object, bytes or str.
+  '''
+  if hasattr(message, 'as_bytes'):
+    message = serialize(message)
+
+  client = AsyncSMTP(
+    smtp_server,
+    smtp_server_port,
+    use_ssl=settings.EMAIL_USE_SSL,
+    starttls=settings.EMAIL_USE_TLS,
+    proxy_server=proxy_server,
+    proxy_port=proxy_port,
+    timeout=settings.USERS_EMAIL_CONNECT_TIMEOUT,
+    command_timeout=settings.USERS_EMAIL_COMMAND_TIMEOUT,
+    )
+  try:
+    with metrics.timed('connect'):
+      await client.connect()
+    if smtp_server_login:
+      with metrics.timed('login'):
+        await client.login(smtp_server_login, smtp_server_password)
+    with metrics.timed('sendmail'):
+      await client.sendmail(sender, recipients, message)
+  except BaseException as e:
+    if isinstance(e, (smtplib.SMTPException, OSError)):
+      metrics.record_smtp_error(e)
+    await client.close()
+    raise
+
+  metrics.record_sent()
+  await client.quit()
+
+# Async variants of the email generators.  Rendering runs in a worker
+# thread so it doesn't block the event loop.
+
+generate_registration_email_async = sync_to_async(
+  generate_registration_email, thread_sensitive=False)
+generate_account_activation_email_async = sync_to_async(
+  generate_account_activation_email, thread_sensitive=False)
+generate_password_reset_email_async = sync_to_async(
+  generate_password_reset_email, thread_sensitive=False)
+generate_password_changed_email_async = sync_to_async(
+  generate_password_changed_email, thread_sensitive=False)
+generate_mfa_disabled_email_async = sync_to_async(
+  generate_mfa_disabled_email, thread_sensitive=False)
+generate_mfa_enabled_email_async = sync_to_async(
+  generate_mfa_enabled_email, thread_sensitive=False)
+
+async def send_registration_email_async(recipients, domain, activation_id):
+  with metrics.notification(Notification.REGISTRATION):
+    msg = await generate_registration_email_async(recipients, domain, activation_id)
+    await send_email_async(recipients, msg)
+
+async def send_account_activation_email_async(recipients):
+  with metrics.notification(Notification.ACCOUNT_ACTIVATION):
+    msg = await generate_account_activation_email_async(recipients)
+    await send_email_async(recipients, msg)
+
+async def send_password_reset_email_async(recipients, domain, activation_id):
+  with metrics.notification(Notification.PASSWORD_RESET):
+    msg = await generate_password_reset_email_async(recipients, domain, activation_id)
+    await send_email_async(recipients, msg)
+
+async def send_password_changed_email_async(recipients):
+  with metrics.notification(Notification.PASSWORD_CHANGED):
+    msg = await generate_password_changed_email_async(recipients)
+    await send_email_async(recipients, msg)
+
+async def send_mfa_disabled_email_async(recipients):
+  with metrics.notification(Notification.MFA_DISABLED):
+    msg = await generate_mfa_disabled_email_async(recipients)
+    await send_email_async(recipients, msg)
+
+async def send_mfa_enabled_email_async(recipients):
+  with metrics.notification(Notification.MFA_ENABLED):
+    msg = await generate_mfa_enabled_email_async(recipients)
+    await send_email_async(recipients, msg)
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+
+class UsersConfig(AppConfig):
+  name = 'dwiest.django.users'
+  label = 'users'
+
+  def ready(self):
+    from .conf import settings
+    from .mfa import signals, status
+    from . import signals
+    from .renderer import renderer
+
+    if settings.USERS_EMAIL_PRELOAD_TEMPLATES:
+      renderer.load()
@@ -1,24 +1,151 @@
-from celery.app.base import Celery
-import email
+from celery import group, shared_task
+from django.core.cache import cache
+from functools import partial
+import smtplib
+from .. import metrics
+from ..conf import settings
+from ..email import send_mass
+from ..notifications import Notification, deliver, generate
 
-app = Celery(broker='amqp://')
+# The tasks are shared, so they are registered on the project's celery
+# app and use its broker, routing and CELERY_* settings.
 
-@app.task
-def generate_registration_email(recipients, activation_id):
-  email.generate_registration_email(recipients, activation_id)
+def add_periodic_tasks(app):
+  '''
+  Schedule purge_expired_registrations every USERS_CELERY_PURGE_INTERVAL
+  seconds on app's beat schedule.  Call it from the project's celery
+  module, e.g. from an app.on_after_configure handler.
+  '''
+  if settings.USERS_CELERY_PURGE_INTERVAL:
+    app.add_periodic_task(
+      settings.USERS_CELERY_PURGE_INTERVAL,
+      purge_expired_registrations.s(),
+      name='purge-expired-registrations',
+      )
 
-@app.task
-def generate_account_activation_email(recipients):
-  email.generate_account_activation_email(recipients)
+retry_options = {
+  'autoretry_for': (smtplib.SMTPException, OSError),
+  'retry_backoff': True,
+  'max_retries': settings.USERS_CELERY_MAX_RETRIES,
+}
 
-@app.task
-def generate_password_reset_email(recipients, activation_id):
-  email.generate_password_reset_email(recipients, activation_id)
+def get_rate_limit(notification):
+  return settings.USERS_CELERY_RATE_LIMITS.get(notification.value)
 
-@app.task
-def generate_password_change_email(recipients):
-  email.generate_password_change_email(recipients)
+def get_idempotency_key(notification, activation_id):
+  return 'dwiest-django-users:celery:{}:{}'.format(notification.value, activation_id)
 
-@app.task
-def send_email(sender, recipients, message, smtp_server, smtp_server_port=465, smtp_server_login=None, smtp_server_password=None, proxy_server=None, proxy_port=None):
-  email.send_email(sender, recipients, message, smtp_server, smtp_server_port=smtp_server_port, smtp_server_login=smtp_server_login, smtp_server_password=smtp_server_password, proxy_server=proxy_server, proxy_port=proxy_port)
+def deliver_once(notification, activation_id, recipients, **kwargs):
+  '''
+  Deliver a notification unless one has already been delivered for the
+  same activation id, so redelivered or duplicated tasks don't send
+  the same link twice.
+  '''
+  key = get_idempotency_key(notification, activation_id)
+
+  if not cache.add(key, True, settings.USERS_CELERY_IDEMPOTENCY_TIMEOUT):
+    return False
+
+  try:
+    deliver(notification, recipients, activation_id=activation_id, **kwargs)
+  except BaseException:
+    # allow a retry to claim the key again
+    cache.delete(key)
+    raise
+
+  return True
+
+@shared_task(rate_limit=get_rate_limit(Notification.REGISTRATION), **retry_options)
+def send_registration_email(recipients, domain, activation_id):
+  return deliver_once(
+    Notification.REGISTRATION, activation_id, recipients, domain=domain)
+
+@shared_task(rate_limit=get_rate_limit(Notification.ACCOUNT_ACTIVATION), **retry_options)
+def send_account_activation_email(recipients):
+  deliver(Notification.ACCOUNT_ACTIVATION, recipients)
+
+@shared_task(rate_limit=get_rate_limit(Notification.PASSWORD_RESET), **retry_options)
+def send_password_reset_email(recipients, domain, activation_id):
+  return deliver_once(
+    Notification.PASSWORD_RESET, activation_id, recipients, domain=domain)
+
+@shared_task(rate_limit=get_rate_limit(Notification.PASSWORD_CHANGED), **retry_options)
+def send_password_changed_email(recipients):
+  deliver(Notification.PASSWORD_CHANGED, recipients)
+
+@shared_task(rate_limit=get_rate_limit(Notification.MFA_DISABLED), **retry_options)
+def send_mfa_disabled_email(recipients):
+  deliver(Notification.MFA_DISABLED, recipients)
+
+@shared_task(rate_limit=get_rate_limit(Notification.MFA_ENABLED), **retry_options)
+def send_mfa_enabled_email(recipients):
+  deliver(Notification.MFA_ENABLED, recipients)
+
+tasks = {
+  Notification.ACCOUNT_ACTIVATION: send_account_activation_email,
+  Notification.MFA_DISABLED: send_mfa_disabled_email,
+  Notification.MFA_ENABLED: send_mfa_enabled_email,
+  Notification.PASSWORD_CHANGED: send_password_changed_email,
+  Notification.PASSWORD_RESET: send_password_reset_email,
+  Notification.REGISTRATION: send_registration_email,
+}
+
+def dispatch_task(notification, recipients, **kwargs):
+  return tasks[Notification(notification)].delay(recipients, **kwargs)
+
+@shared_task
+def send_email_chunk(notification, recipients_list, kwargs):
+  '''
+  Send one notification per entry in recipients_list over a shared SMTP
+  session.  Failures are reported in the result instead of failing the
+  whole chunk.
+  '''
+  with metrics.notification(Notification(notification)):
+    # rendered by send_mass, so one bad message is reported on its own
+    result = send_mass(
+      (recipients, partial(generate, notification, recipients, **kwargs))
+      for recipients in recipients_list
+      )
+
+  return [(recipients, repr(e)) for index, recipients, e in result.failures]
+
+@shared_task
+def send_bulk_email(notification, recipients_list, chunk_size=None, **kwargs):
+  '''
+  Split recipients_list into chunks of chunk_size and send each chunk
+  from its own task.  Returns the number of chunks.
+  '''
+  chunk_size = chunk_size or settings.USERS_CELERY_BULK_CHUNK_SIZE
+  chunks = [
+    recipients_list[i:i + chunk_size]
+    for i in range(0, len(recipients_list), chunk_size)
+    ]
+
+  group(
+    send_email_chunk.s(notification, chunk, kwargs) for chunk in chunks
+    ).apply_async()
+
+  return len(chunks)
+
+@shared_task
+def flush_coalesced(notification, recipients):
+  '''
+  Send the latest notification held back by coalescing, see
+  coalesce.hold().
+  '''
+  from ..coalesce import flush
+  from ..notifications import dispatch_now
+
+  flush(Notification(notification), recipients, dispatch_now)
+
+@shared_task
+def purge_expired_registrations(batch_size=None, sleep=None):
+  from ..purge import purge
+
+  result = purge(batch_size=batch_size, sleep=sleep)
+  return {
+    'users': result.users,
+    'activation_ids': result.activation_ids,
+    'outbox_messages': result.outbox_messages,
+    'seconds': result.seconds,
+    }
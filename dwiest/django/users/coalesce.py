@@ -0,0 +1,184 @@
+from django.core.cache import caches
+from django.db import connections
+from django.utils import timezone
+import datetime
+import hashlib
+import logging
+import threading
+import time
+from .conf import settings
+
+KEY_PREFIX = 'dwiest-django-users:coalesce'
+
+logger = logging.getLogger(__name__)
+
+def get_cache():
+  return caches[settings.USERS_EMAIL_COALESCE_CACHE]
+
+def is_coalesced(notification):
+  return settings.USERS_EMAIL_COALESCE_WINDOW > 0 and \
+    notification.value in settings.USERS_EMAIL_COALESCE_NOTIFICATIONS
+
+def get_key(notification, recipients, name):
+  digest = hashlib.sha256(
+    ','.join(sorted(r.lower() for r in recipients)).encode('utf-8')).hexdigest()
+  return ':'.join((KEY_PREFIX, notification.value, digest, name))
+
+def get_suppressed_key(notification):
+  return ':'.join((KEY_PREFIX, 'suppressed', notification.value))
+
+def coalesce(notification, recipients, kwargs, send):
+  '''
+  Call send(notification, recipients, **kwargs) unless the same
+  notification was already sent to the same recipients within
+  USERS_EMAIL_COALESCE_WINDOW seconds.  Call it once the change the
+  notification is about has been committed.
+
+  Suppressed notifications aren't lost: the latest one is kept, and if
+  it differs from the one that was sent (it carries a newer link) it is
+  sent once the window closes.  Returns True if send was called.
+  '''
+  cache = get_cache()
+  window = settings.USERS_EMAIL_COALESCE_WINDOW
+  window_key = get_key(notification, recipients, 'window')
+
+  if cache.add(window_key, time.time(), window):
+    cache.set(get_key(notification, recipients, 'last'), kwargs, window * 2)
+    send(notification, recipients, **kwargs)
+    return True
+
+  add_suppressed(notification, 1)
+
+  opened_at = cache.get(window_key) or time.time()
+  delay = max(0, window - (time.time() - opened_at))
+  hold(notification, recipients, kwargs, delay, send)
+
+  return False
+
+def hold(notification, recipients, kwargs, delay, send):
+  '''
+  Keep kwargs as the notification to send in delay seconds.  With celery
+  delivery the flush is a delayed task, so it survives the process that
+  held it.  With the other deliveries it is flushed by a timer in this
+  process.  Outbox delivery holds its messages in the outbox instead,
+  see coalesce_outbox().
+  '''
+  from .notifications import Delivery
+
+  cache = get_cache()
+  window = settings.USERS_EMAIL_COALESCE_WINDOW
+  cache.set(get_key(notification, recipients, 'pending'), kwargs, window * 2)
+
+  # only the first duplicate in a window schedules the flush
+  if not cache.add(get_key(notification, recipients, 'flush'), True, window):
+    return
+
+  if Delivery(settings.USERS_EMAIL_DELIVERY) == Delivery.CELERY:
+    from .celery.tasks import flush_coalesced
+    flush_coalesced.apply_async(
+      (notification.value, list(recipients)), countdown=delay)
+
+  else:
+    # not a daemon thread, so pending messages are flushed before exit
+    timer = threading.Timer(
+      delay, flush_in_thread, args=(notification, recipients, send))
+    timer.name = 'dwiest-django-users-coalesce'
+    timer.start()
+
+def coalesce_outbox(notification, recipients, kwargs, message_id):
+  '''
+  The outbox counterpart of coalesce(), called once the change and its
+  outbox message message_id have been committed.  The message is sent
+  right away if it opens a window.  Otherwise it is held in the outbox
+  until the window closes, replacing any message held before it.  If
+  this is never called the message is simply sent uncoalesced.
+  '''
+  from .models import OutboxMessage
+
+  cache = get_cache()
+  window = settings.USERS_EMAIL_COALESCE_WINDOW
+  window_key = get_key(notification, recipients, 'window')
+  last_key = get_key(notification, recipients, 'last')
+  held_key = get_key(notification, recipients, 'held')
+
+  if cache.add(window_key, time.time(), window):
+    cache.set(last_key, kwargs, window * 2)
+    return True
+
+  # only messages no worker has picked up can be held or dropped
+  waiting = OutboxMessage.objects.filter(
+    status=OutboxMessage.Status.PENDING,
+    leased_until__isnull=True,
+    attempts=0,
+    )
+
+  held_id = cache.get(held_key)
+  if held_id is not None:
+    add_suppressed(notification, waiting.filter(id=held_id).delete()[0])
+
+  if kwargs == cache.get(last_key):
+    # the same link was already sent
+    add_suppressed(notification, waiting.filter(id=message_id).delete()[0])
+    return False
+
+  opened_at = cache.get(window_key) or time.time()
+  delay = max(0, window - (time.time() - opened_at))
+  waiting.filter(id=message_id).update(
+    available_at=timezone.now() + datetime.timedelta(seconds=delay))
+  cache.set(held_key, message_id, window * 2)
+
+  return False
+
+def flush(notification, recipients, send):
+  cache = get_cache()
+  pending_key = get_key(notification, recipients, 'pending')
+  last_key = get_key(notification, recipients, 'last')
+
+  pending = cache.get(pending_key)
+  last = cache.get(last_key)
+  cache.delete(pending_key)
+
+  if pending is None or pending == last:
+    return
+
+  window = settings.USERS_EMAIL_COALESCE_WINDOW
+  cache.set(get_key(notification, recipients, 'window'), time.time(), window)
+  cache.set(last_key, pending, window * 2)
+  add_suppressed(notification, -1)
+
+  send(notification, recipients, **pending)
+
+def flush_in_thread(notification, recipients, send):
+  try:
+    flush(notification, recipients, send)
+  except Exception:
+    logger.exception('failed to send coalesced %s notification', notification.value)
+  finally:
+    # release any database connection opened by this timer thread
+    connections.close_all()
+
+def add_suppressed(notification, delta):
+  cache = get_cache()
+  key = get_suppressed_key(notification)
+  cache.add(key, 0, None)
+
+  try:
+    cache.incr(key, delta)
+  except ValueError:
+    # evicted between add() and incr()
+    cache.set(key, max(delta, 0), None)
+
+def get_suppressed_count(notification=None):
+  '''
+  Number of sends suppressed by coalescing, for one notification type
+  or for all of them.
+  '''
+  from .notifications import Notification
+
+  if notification is not None:
+    notifications = [Notification(notification)]
+  else:
+    notifications = list(Notification)
+
+  counts = get_cache().get_many([get_suppressed_key(n) for n in notifications])
+  return sum(counts.values())
@@ -16,6 +16,200 @@ class UsersAppConf(AppConf):
   EMAIL_FIELD_MAX_LENGTH = 50
   EMAIL_SEND = True
 
+  '''
+    EMAIL_PRELOAD_TEMPLATES - Compile the email templates when the app is
+      loaded instead of on first use.
+  '''
+
+  EMAIL_PRELOAD_TEMPLATES = True
+
+  '''
+    HTML email template settings:
+      EMAIL_HTML_INLINE_CSS - Move the rules in <style> blocks onto the
+        elements they select when the template is loaded.
+      EMAIL_HTML_MINIFY - Strip comments and collapse whitespace in the
+        template source when it is loaded.
+      Only rules with tag, class and id selectors, or combinations of
+        them such as a.button, are inlined.  Descendant selectors,
+        pseudo-classes and at-rules stay in the <style> block.  The built
+        templates are kept in memory by each process; the
+        build_email_templates command only reports the savings.
+      EMAIL_QP_MAX_ESCAPED_RATIO - Text parts that aren't plain 7bit are
+        sent quoted-printable unless more than this share of their bytes
+        would need escaping, in which case base64 is smaller.
+  '''
+
+  EMAIL_HTML_INLINE_CSS = True
+  EMAIL_HTML_MINIFY = True
+  EMAIL_QP_MAX_ESCAPED_RATIO = 0.17
+
+  '''
+    EMAIL_METRICS_REPORTER - Import path of the dwiest.django.users.metrics
+      Reporter subclass that receives per-stage timings and counters for
+      each notification type.  None disables metrics.
+  '''
+
+  EMAIL_METRICS_REPORTER = 'dwiest.django.users.metrics.InMemoryReporter'
+
+  '''
+    SMTP connection pool settings:
+
+      EMAIL_POOL_SIZE - Maximum number of connections held open to
+        each mail relay.
+
+      EMAIL_POOL_MAX_IDLE - Seconds an idle connection is kept before
+        it is closed.
+
+      EMAIL_POOL_HEALTH_CHECK_INTERVAL - Seconds a connection may sit
+        idle before it is checked with NOOP on reuse.
+
+      EMAIL_MESSAGES_PER_CONNECTION - Messages send_mass() sends over one
+        SMTP session before reconnecting.
+
+      EMAIL_CONNECT_TIMEOUT - Seconds to wait for a connection to the
+        mail relay, and for a free connection when the pool is in use.
+
+      EMAIL_COMMAND_TIMEOUT - Seconds to wait for a reply to each SMTP
+        command.
+
+      EMAIL_CIRCUIT_BREAKER_THRESHOLD - Consecutive relay failures after
+        which messages are no longer sent to the relay.  0 disables the
+        circuit breaker.
+
+      EMAIL_CIRCUIT_BREAKER_RESET_TIMEOUT - Seconds before the relay is
+        tried again once the circuit breaker has tripped.
+
+      EMAIL_SPOOL_DIR - Directory where messages are spooled while the
+        relay is unavailable.  They are replayed when the relay recovers,
+        or by the replay_email_spool management command.  Messages the
+        relay rejects on replay are renamed to *.failed.  If not set,
+        send_email() raises instead.
+  '''
+
+  EMAIL_POOL_SIZE = 4
+  EMAIL_POOL_MAX_IDLE = 60
+  EMAIL_POOL_HEALTH_CHECK_INTERVAL = 5
+  EMAIL_MESSAGES_PER_CONNECTION = 100
+  EMAIL_CONNECT_TIMEOUT = 10
+  EMAIL_COMMAND_TIMEOUT = 30
+  EMAIL_CIRCUIT_BREAKER_THRESHOLD = 5
+  EMAIL_CIRCUIT_BREAKER_RESET_TIMEOUT = 60
+  EMAIL_SPOOL_DIR = None
+
+  '''
+    Email delivery settings:
+
+      EMAIL_DELIVERY - How notifications are delivered.  'smtp' renders
+        and sends them during the request, once its transaction has
+        committed, 'outbox' stores them in the
+        OutboxMessage table to be sent by the drain_email_outbox
+        management command, 'celery' sends them from the tasks in
+        dwiest.django.users.celery.tasks, and 'thread' sends them from
+        a background thread pool once the request's transaction commits.
+
+      EMAIL_OUTBOX_BATCH_SIZE - Number of outbox messages claimed and sent
+        over one connection at a time.
+
+      EMAIL_OUTBOX_LEASE_SECONDS - Seconds a claimed message is reserved
+        for a worker before other workers may claim it.
+
+      EMAIL_OUTBOX_MAX_ATTEMPTS - Attempts before a message is marked as
+        failed.
+
+      EMAIL_OUTBOX_RETRY_BACKOFF - Seconds to wait before the first retry,
+        doubled for each further attempt.
+
+      EMAIL_OUTBOX_RETENTION_DAYS - Days sent and failed messages are kept
+        before purge_expired_registrations deletes them.  Their context,
+        which holds activation tokens, is cleared as soon as they are
+        sent or given up on.
+  '''
+
+  EMAIL_DELIVERY = 'smtp'
+
+  '''
+    Notification coalescing settings:
+
+      EMAIL_COALESCE_WINDOW - Seconds during which repeated notifications
+        of the same type to the same recipient are collapsed into one
+        message carrying the latest link.  0 disables coalescing.  With
+        'outbox' every message is written with the change and later
+        duplicates are held in the outbox until the window closes; with
+        'celery' the held message is a delayed task; with 'smtp' and
+        'thread' it is held by a timer in the process and lost if the
+        process dies.
+
+      EMAIL_COALESCE_NOTIFICATIONS - Notification types that are
+        coalesced.
+
+      EMAIL_COALESCE_CACHE - The cache used to coalesce notifications
+        across processes.
+  '''
+
+  EMAIL_COALESCE_WINDOW = 0
+  EMAIL_COALESCE_NOTIFICATIONS = ('registration', 'password_reset')
+  EMAIL_COALESCE_CACHE = 'default'
+  EMAIL_OUTBOX_BATCH_SIZE = 100
+  EMAIL_OUTBOX_LEASE_SECONDS = 300
+  EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+  EMAIL_OUTBOX_RETRY_BACKOFF = 60
+  EMAIL_OUTBOX_POLL_INTERVAL = 5
+  EMAIL_OUTBOX_RETENTION_DAYS = 7
+
+  '''
+    Thread pool delivery settings:
+
+      EMAIL_THREAD_POOL_SIZE - Number of threads sending email.
+
+      EMAIL_THREAD_QUEUE_SIZE - Number of notifications that may wait for
+        a free thread.
+
+      EMAIL_THREAD_BACKPRESSURE - What to do when the queue is full:
+        'block' waits for room, 'caller_runs' sends on the request thread
+        and 'drop' discards the notification.
+
+      EMAIL_THREAD_SHUTDOWN_TIMEOUT - Seconds to spend sending queued
+        notifications when the process exits.
+  '''
+
+  EMAIL_THREAD_POOL_SIZE = 2
+  EMAIL_THREAD_QUEUE_SIZE = 100
+  EMAIL_THREAD_BACKPRESSURE = 'caller_runs'
+  EMAIL_THREAD_SHUTDOWN_TIMEOUT = 30
+
+  '''
+    Celery settings:
+
+      The Celery app itself is configured from the project's CELERY_*
+      settings, e.g. CELERY_BROKER_URL, CELERY_RESULT_BACKEND and, for
+      tests, CELERY_BROKER_URL = 'memory://' with
+      CELERY_TASK_ALWAYS_EAGER = True.
+
+      CELERY_RATE_LIMITS - Per-notification task rate limits, e.g.
+        {'registration': '10/s'}.
+
+      CELERY_IDEMPOTENCY_TIMEOUT - Seconds during which a registration or
+        password reset email for the same activation id is only sent once.
+
+      CELERY_BULK_CHUNK_SIZE - Number of messages sent by each task
+        spawned from send_bulk_email.
+
+      CELERY_PURGE_INTERVAL - Seconds between runs of the
+        purge_expired_registrations task when celery beat is used, once
+        the project's app has been passed to
+        dwiest.django.users.celery.tasks.add_periodic_tasks().  None
+        doesn't schedule it.
+
+      The tasks are celery shared tasks: they run on the project's celery
+      app, with its broker and CELERY_* settings.
+  '''
+
+  CELERY_RATE_LIMITS = {}
+  CELERY_MAX_RETRIES = 5
+  CELERY_IDEMPOTENCY_TIMEOUT = 300
+  CELERY_BULK_CHUNK_SIZE = 100
+  CELERY_PURGE_INTERVAL = None
+
   ''' Account activation '''
   ACCOUNT_ACTIVATION_EMAIL_SUBJECT = 'Account Activated'
   ACCOUNT_ACTIVATION_EMAIL_HTML = 'dwiest-django-users/email/account_activation.html'
@@ -59,10 +253,44 @@ class UsersAppConf(AppConf):
 
       ACTIVATION_ID_DO_NOT_DELETE - Don't delete the activation id 
         record after use.  Intended for debug/test purposes.
+
+      ACTIVATION_TOKEN_MODE - 'database' stores a digest of each
+        registration and password reset token in the ActivationId table.
+        'signed' puts the user id in a timestamped token signed with
+        SECRET_KEY, so no ActivationId records are written or read.
+        Signed tokens stop working once the password changes or the user
+        logs in, and can't be revoked otherwise.
   '''
 
   ACTIVATION_ID_ALLOW_EXPIRED = False
   ACTIVATION_ID_DO_NOT_DELETE = False
+  ACTIVATION_TOKEN_MODE = 'database'
+
+  '''
+    Purge settings, used by the purge_expired_registrations management
+    command and celery task:
+
+      PURGE_BATCH_SIZE - Number of rows deleted per statement.
+
+      PURGE_SLEEP - Seconds to wait between batches, so the purge doesn't
+        hold locks or saturate the database on a live site.
+
+      PURGE_SIGNED_MODE_USERS - Also purge abandoned registrations in
+        the 'signed' token mode.  Off by default: there the expiry of a
+        link can't be checked against a stored record.
+
+      Expired activation ids are deleted once both the registration and
+      the password reset expiration have passed.  Users created by the
+      registration form who never activated their account and never
+      logged in are deleted once REGISTRATION_EXPIRATION_DAYS have passed
+      since their latest registration link was sent.  Accounts created
+      any other way are never deleted.  Run the command with --dry-run
+      to see what would be deleted.
+  '''
+
+  PURGE_BATCH_SIZE = 500
+  PURGE_SLEEP = 0.1
+  PURGE_SIGNED_MODE_USERS = False
 
   '''
     Account registration settings:
@@ -72,9 +300,24 @@ class UsersAppConf(AppConf):
 
       REGISTRATION_ALLOW_ALREADY_ACTIVE - Allow active users to
         re-register for an account.  Intended for debug/test purposes.
+
+      REGISTRATION_RESEND_LINK_MAX_AGE - Seconds for which the resend
+        link on the registration failed page works.
+
+      REGISTRATION_CONFIRM_CACHE_TIMEOUT - Seconds for which a successful
+        confirmation is remembered, so the same link opened again (e.g.
+        after a mail scanner has followed it) shows the success page
+        without touching the database.  0 disables.
+
+      REGISTRATION_CONFIRM_CACHE - The cache remembering successful
+        confirmations.  Shared between processes unless it is a locmem
+        cache.
   '''
 
   REGISTRATION_ALLOW_EMAIL_RESEND = False
+  REGISTRATION_CONFIRM_CACHE = 'default'
+  REGISTRATION_CONFIRM_CACHE_TIMEOUT = 3600
+  REGISTRATION_RESEND_LINK_MAX_AGE = 3600
   REGISTRATION_ALLOW_ALREADY_ACTIVE = False
   REGISTRATION_EMAIL_FIELD_CLASS = 'email'
   REGISTRATION_EMAIL_FIELD_MAX_LENGTH = 50
@@ -100,6 +343,7 @@ class UsersAppConf(AppConf):
 
   LOGIN_TEMPLATE = 'dwiest-django-users/registration/login.html'
   LOGIN_MFA_FIELD_LABEL = 'MFA token'
+  LOGIN_TRUST_DEVICE_FIELD_LABEL = 'Trust this device'
   LOGIN_MFA_TOKEN_INVALID_ERROR = 'The MFA token you entered is not correct.'
   LOGIN_MFA_TOKEN_REPLAYED_ERROR = 'The MFA token you entered has already been used. Please wait and enter the next value shown in your authenticator app.'
 
@@ -115,6 +359,56 @@ class UsersAppConf(AppConf):
     MFA_SECRET_KEY - Allows the secret key to be specified instead of 
       using a randomly generated value.  Intended for debug/test 
       purposes.
+
+    MFA_TOKEN_VALID_WINDOW - Number of time steps (30 seconds each)
+      before and after the current one in which a token is accepted, to
+      allow for clock drift and slow typing.
+
+    MFA_SECRET_CACHE_SIZE - Number of decoded secret keys kept in memory
+      by the token verifier.
+
+    MFA_STATUS_CACHE - Cache holding whether each user has MFA enabled.
+      It is shared by all processes, so it should be memcached, redis or
+      the database cache rather than the local memory cache.
+
+    MFA_STATUS_CACHE_TIMEOUT - Seconds an MFA status is cached for.  The
+      status is rewritten when it changes, this only bounds staleness
+      after changes made outside the ORM or a lost cache write.
+
+    MFA_TRUST_DEVICE_DAYS - Days for which a device the user chose to
+      trust at login can skip the MFA token.  The trust is revoked when
+      the password changes or MFA is disabled.
+
+    MFA_TRUST_COOKIE_NAME - Name of the cookie marking a trusted device.
+
+    MFA_PROVISION_BATCH_SIZE - Number of MFA records the provision_mfa
+      command creates per statement.
+
+    MFA_PROVISION_WORKERS - Number of processes the provision_mfa
+      command renders QR codes in, None for one per CPU.
+
+    MFA_REPLAY_LEDGER - Where used tokens are recorded.  'database'
+      advances MfaModel.last_step with a conditional UPDATE, so a token
+      older than the last accepted one is also refused.  'cache' adds a
+      key per used token to the MFA_REPLAY_CACHE cache, which expires
+      with the token's window, so logins don't write to the database.
+      The cache must be shared by all processes, e.g. memcached or
+      redis.
+
+    MFA_QRCODE_IMAGE_MODE - PIL mode the QR code is converted to before
+      it is saved.  'RGB' as before, 'P' for a smaller two colour PNG
+      (black on white is saved as qrcode's 1-bit image), or None to save
+      the image as qrcode renders it.
+
+    MFA_QRCODE_CACHE_SIZE - Number of rendered QR codes kept in memory,
+      so a form that is redisplayed after a validation error doesn't
+      render the same image again.
+
+    MFA_QRCODE_IMAGE_FORMAT - A PIL image format, or 'SVG' to render
+      the QR code as SVG without PIL.
+
+    MFA_QRCODE_MAX_AGE - Seconds for which the link to the QR code image
+      on the enable page works.
   '''
 
   MFA_SECRET_KEY = None
@@ -123,6 +417,16 @@ class UsersAppConf(AppConf):
   MFA_FIELD_CLASS = 'mfa'
   MFA_TOKEN_FIELD_LABEL = 'Token'
   MFA_TOKEN_LENGTH = 6
+  MFA_TOKEN_VALID_WINDOW = 1
+  MFA_SECRET_CACHE_SIZE = 1024
+  MFA_REPLAY_LEDGER = 'database'
+  MFA_STATUS_CACHE = 'default'
+  MFA_STATUS_CACHE_TIMEOUT = 300
+  MFA_TRUST_DEVICE_DAYS = 30
+  MFA_TRUST_COOKIE_NAME = 'mfa_trusted_device'
+  MFA_PROVISION_BATCH_SIZE = 500
+  MFA_PROVISION_WORKERS = None
+  MFA_REPLAY_CACHE = 'default'
   MFA_SECRET_KEY_LENGTH = 32
   MFA_PASSWORD_FIELD_LABEL = 'Password'
   MFA_PASSWORD_CLASS = 'password'
@@ -131,6 +435,9 @@ class UsersAppConf(AppConf):
   MFA_QRCODE_FILL_COLOR = 'black'
   MFA_QRCODE_BACKGROUND_COLOR = 'white'
   MFA_QRCODE_IMAGE_FORMAT = 'PNG'
+  MFA_QRCODE_IMAGE_MODE = 'RGB'
+  MFA_QRCODE_CACHE_SIZE = 128
+  MFA_QRCODE_MAX_AGE = 600
   MFA_CONFIRM_MESSAGE = 'I want to make my account less secure'
   MFA_DISABLE_FIELD_LABEL = 'Confirm Text'
   MFA_CONFIRM_MESSAGE_INVALID = 'Please type the confirmation text.'
@@ -1,16 +1,27 @@
 from django.shortcuts import render
-from django.template.loader import get_template
 from django.urls import reverse
+from email import charset
 from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import smtplib
+from email.mime.nonmultipart import MIMENonMultipart
+from email.policy import SMTP
 from .conf import settings
+from .metrics import record_sent, record_smtp_error, timed
+from .renderer import renderer
+from .smtp import (
+  CircuitOpenError,
+  PoolTimeoutError,
+  get_connection_pool,
+  get_spool,
+  is_disconnected,
+  is_relay_error,
+  )
+import smtplib
 
 def generate_registration_email(recipients, domain, activation_id):
   subject = settings.USERS_REGISTRATION_EMAIL_SUBJECT
   sender = settings.DEFAULT_FROM_EMAIL
-  html_template = get_template(settings.USERS_REGISTRATION_EMAIL_HTML)
-  text_template = get_template(settings.USERS_REGISTRATION_EMAIL_TEXT)
+  html_template = renderer.get_template(settings.USERS_REGISTRATION_EMAIL_HTML)
+  text_template = renderer.get_template(settings.USERS_REGISTRATION_EMAIL_TEXT)
 
   query_string = '?activation_id={}'.format(activation_id)
   link = str(domain) + reverse('registration_confirm') + query_string
@@ -22,17 +33,17 @@ def generate_registration_email(recipients, domain, activation_id):
 def generate_account_activation_email(recipients):
   subject = settings.USERS_ACCOUNT_ACTIVATION_EMAIL_SUBJECT
   sender = settings.DEFAULT_FROM_EMAIL
-  html_template = get_template(settings.USERS_ACCOUNT_ACTIVATION_EMAIL_HTML)
-  text_template = get_template(settings.USERS_ACCOUNT_ACTIVATION_EMAIL_TEXT)
 
-  return generate_email(
-    sender, recipients, subject, html_template, text_template)
+  return generate_prerendered_email(
+    sender, recipients, subject,
+    settings.USERS_ACCOUNT_ACTIVATION_EMAIL_HTML,
+    settings.USERS_ACCOUNT_ACTIVATION_EMAIL_TEXT)
 
 def generate_password_reset_email(recipients, domain, activation_id):
   subject = settings.USERS_PASSWORD_RESET_EMAIL_SUBJECT
   sender = settings.DEFAULT_FROM_EMAIL
-  html_template = get_template(settings.USERS_PASSWORD_RESET_EMAIL_HTML)
-  text_template = get_template(settings.USERS_PASSWORD_RESET_EMAIL_TEXT)
+  html_template = renderer.get_template(settings.USERS_PASSWORD_RESET_EMAIL_HTML)
+  text_template = renderer.get_template(settings.USERS_PASSWORD_RESET_EMAIL_TEXT)
 
   query_string = '?activation_id={}'.format(activation_id)
   link = str(domain) + reverse('password_reset_confirm') + query_string
@@ -44,49 +55,326 @@ def generate_password_reset_email(recipients, domain, activation_id):
 def generate_password_changed_email(recipients):
   subject = settings.USERS_PASSWORD_CHANGE_EMAIL_SUBJECT
   sender = settings.DEFAULT_FROM_EMAIL
-  html_template = get_template(settings.USERS_PASSWORD_CHANGE_EMAIL_HTML)
-  text_template = get_template(settings.USERS_PASSWORD_CHANGE_EMAIL_TEXT)
 
-  return generate_email(
-    sender, recipients, subject, html_template, text_template)
+  return generate_prerendered_email(
+    sender, recipients, subject,
+    settings.USERS_PASSWORD_CHANGE_EMAIL_HTML,
+    settings.USERS_PASSWORD_CHANGE_EMAIL_TEXT)
 
 def send_email(recipients, message,
   sender=settings.DEFAULT_FROM_EMAIL,
   smtp_server=settings.EMAIL_HOST,
-  smtp_server_port=465,
+  smtp_server_port=settings.EMAIL_PORT,
   smtp_server_login=settings.EMAIL_HOST_USER,
   smtp_server_password=settings.EMAIL_HOST_PASSWORD,
   proxy_server=settings.PROXY_SERVER,
   proxy_port=settings.PROXY_PORT):
-  if proxy_server:
-    import socks
-    socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, proxy_server, proxy_port)
-    socks.wrapmodule(smtplib)
+  pool = get_connection_pool(
+    smtp_server,
+    smtp_server_port,
+    smtp_server_login,
+    smtp_server_password,
+    use_ssl=settings.EMAIL_USE_SSL,
+    proxy_server=proxy_server,
+    proxy_port=proxy_port,
+    )
+  spool = get_spool()
+
+  # don't make the caller wait on a relay that is known to be down
+  if not pool.breaker.allow():
+    if spool is None:
+      raise CircuitOpenError('mail relay {} is unavailable'.format(smtp_server))
+    spool.put(sender, recipients, message)
+    return
+
+  try:
+    pool.sendmail(sender, recipients, message)
+
+  except (CircuitOpenError, PoolTimeoutError) as e:
+    record_smtp_error(e)
+    raise
+
+  except OSError as e:
+    record_smtp_error(e)
+
+    if not is_relay_error(e):
+      # the relay answered, so it is up even though it refused the message
+      pool.breaker.record_success()
+      raise
+
+    pool.breaker.record_failure()
+    if spool is None:
+      raise
+    spool.put(sender, recipients, message)
 
-  if settings.EMAIL_USE_SSL == True:
-    server = smtplib.SMTP_SSL(smtp_server, smtp_server_port)
   else:
-    server = smtplib.SMTP(smtp_server, smtp_server_port)
-  server.login(smtp_server_login, smtp_server_password)
-  server.sendmail(sender, recipients, message)
-  server.quit()
+    record_sent()
+    pool.breaker.record_success()
+
+def get_default_connection_pool():
+  return get_connection_pool(
+    settings.EMAIL_HOST,
+    settings.EMAIL_PORT,
+    settings.EMAIL_HOST_USER,
+    settings.EMAIL_HOST_PASSWORD,
+    use_ssl=settings.EMAIL_USE_SSL,
+    proxy_server=settings.PROXY_SERVER,
+    proxy_port=settings.PROXY_PORT,
+    )
+
+def send_mass(messages, sender=None, messages_per_connection=None, pool=None):
+  '''
+  Send an iterable of (recipients, message) pairs, reusing each SMTP
+  session for up to messages_per_connection messages.  messages may be
+  a generator; only failures are kept, so memory use doesn't grow with
+  the number of messages.  message may be a callable returning the
+  message, so it is rendered when it is sent.  A message that fails to
+  render or send doesn't stop the rest from being sent.
+
+  An unavailable relay does: if the circuit breaker is open, no
+  connection can be had, or a new connection fails, the remaining
+  messages are reported as failed without being rendered or sent.
+  '''
+  messages_per_connection = \
+    messages_per_connection or settings.USERS_EMAIL_MESSAGES_PER_CONNECTION
+  pool = pool or get_default_connection_pool()
+  result = MassSendResult()
+  connection = None
+  connection_count = 0
+  messages = iter(messages)
+  index = 0
+
+  try:
+    while True:
+      try:
+        recipients, message = next(messages)
+      except StopIteration:
+        break
+      except Exception as e:
+        # a generator that raised can't be resumed
+        result.failures.append((index, None, e))
+        break
+
+      if connection is not None and connection_count >= messages_per_connection:
+        pool.release(connection, discard=True)
+        connection = None
+
+      if connection is None and not pool.breaker.allow():
+        error = CircuitOpenError('mail relay {} is unavailable'.format(pool.host))
+        record_smtp_error(error)
+        fail_remaining(result, index, recipients, messages, error)
+        break
+
+      try:
+        # connect first, nothing is rendered while the relay is down
+        if connection is None:
+          connection = pool.acquire()
+          connection_count = 0
+
+        if callable(message):
+          message = message()
+
+        if hasattr(message, 'as_bytes'):
+          message_sender = sender or message['From']
+          message = serialize(message)
+        else:
+          message_sender = sender or settings.DEFAULT_FROM_EMAIL
+
+        connection_count += 1
+        with timed('sendmail'):
+          refused = connection.sendmail(message_sender, recipients, message)
+
+      except Exception as e:
+        if isinstance(e, OSError):
+          record_smtp_error(e)
+
+        # a pooled connection may just have been dropped by the relay, the
+        # next message gets a new one.  Failing to get or use a new
+        # connection means the relay is down
+        relay_down = isinstance(e, PoolTimeoutError) or (is_relay_error(e) and
+          (connection is None or not getattr(connection, 'reused', False)))
+
+        if is_disconnected(e) and connection is not None:
+          pool.release(connection, discard=True)
+          connection = None
+
+        if relay_down:
+          if not isinstance(e, PoolTimeoutError):
+            pool.breaker.record_failure()
+          fail_remaining(result, index, recipients, messages, e)
+          break
+
+        if isinstance(e, OSError) and not is_relay_error(e):
+          # the relay answered, so it is up even though it refused the message
+          pool.breaker.record_success()
+
+        result.failures.append((index, recipients, e))
+
+      else:
+        record_sent()
+        pool.breaker.record_success()
+        result.sent += 1
+        if refused:
+          error = smtplib.SMTPRecipientsRefused(refused)
+          record_smtp_error(error)
+          result.failures.append((index, recipients, error))
+
+      index += 1
+
+  finally:
+    if connection is not None:
+      pool.release(connection)
+
+  return result
+
+def fail_remaining(result, index, recipients, messages, error):
+  '''
+  Report the message at index and every message left in messages as
+  failed with error, without rendering them.
+  '''
+  result.failures.append((index, recipients, error))
+
+  while True:
+    index += 1
+    try:
+      recipients, message = next(messages)
+    except StopIteration:
+      break
+    except Exception as e:
+      result.failures.append((index, None, e))
+      break
+
+    result.failures.append((index, recipients, error))
+
+
+class MassSendResult:
+  '''
+  The outcome of send_mass().  failures holds (index, recipients, error)
+  tuples for each message, or partially refused message, that failed.
+  recipients is None if the messages iterable itself raised.
+  '''
+
+  def __init__(self):
+    self.sent = 0
+    self.failures = []
+
+  def __repr__(self):
+    return '<MassSendResult sent={} failed={}>'.format(self.sent, len(self.failures))
+
 
 def generate_email( sender, recipients, subject,
   html_template=None, text_template=None, context={}):
 
-  msg = MIMEMultipart('alternative') # need to handle single part
+  msg = generate_email_body(html_template, text_template, context)
   msg['Subject'] = subject
   msg['From'] = sender
   msg['To'] = ', '.join(recipients)
 
-  if text_template:
-    text_body = text_template.render(context)
-    part = MIMEText(text_body, 'plain')
-    msg.attach(part)
+  return msg
+
+def generate_email_body(html_template=None, text_template=None, context={}):
+  bodies = []
 
-  if html_template:
-    html_body = html_template.render(context)
-    part = MIMEText(html_body, 'html')
-    msg.attach(part)
+  with timed('render'):
+    if text_template:
+      bodies.append((text_template.render(context), 'plain'))
 
-  return msg
+    if html_template:
+      bodies.append((html_template.render(context), 'html'))
+
+  with timed('mime'):
+    parts = [make_text_part(body, subtype) for body, subtype in bodies]
+
+    if len(parts) == 1:
+      return parts[0]
+
+    msg = MIMEMultipart('alternative')
+    for part in parts:
+      msg.attach(part)
+
+    return msg
+
+def make_text_part(body, subtype):
+  '''
+  Build a text/<subtype> part using the cheapest transfer encoding for
+  the body: 7bit when it is plain ASCII with short lines, otherwise
+  quoted-printable or base64, whichever is smaller.
+  '''
+  part = MIMENonMultipart('text', subtype)
+
+  try:
+    body.encode('us-ascii')
+    is_ascii = True
+  except UnicodeEncodeError:
+    is_ascii = False
+
+  if is_ascii and max(map(len, body.splitlines() or [''])) <= 998:
+    part.set_payload(body, charset.Charset('us-ascii'))
+    return part
+
+  encoded = body.encode('utf-8')
+  # quoted-printable escapes each of these bytes as three characters
+  escaped = sum(1 for b in encoded if b > 126 or b == 61 or (b < 32 and b not in (9, 10, 13)))
+
+  body_charset = charset.Charset('utf-8')
+  if escaped > len(encoded) * settings.USERS_EMAIL_QP_MAX_ESCAPED_RATIO:
+    body_charset.body_encoding = charset.BASE64
+  else:
+    body_charset.body_encoding = charset.QP
+
+  part.set_payload(body, body_charset)
+  return part
+
+def generate_prerendered_email(sender, recipients, subject,
+  html_template_name=None, text_template_name=None):
+  '''
+  Build an email whose body doesn't depend on the recipient.  The body
+  is rendered and serialized the first time it is needed and shared by
+  every later message.
+  '''
+  def render_body():
+    html_template = html_template_name and renderer.get_template(html_template_name)
+    text_template = text_template_name and renderer.get_template(text_template_name)
+    return serialize(generate_email_body(html_template, text_template))
+
+  body = renderer.get_prerendered(
+    (html_template_name, text_template_name), render_body)
+
+  return PrerenderedEmail(sender, recipients, subject, body)
+
+def serialize(msg):
+  '''
+  Serialize a message to the bytes sent over SMTP.
+  '''
+  with timed('mime'):
+    return msg.as_bytes(policy=SMTP)
+
+
+class PrerenderedEmail:
+  '''
+  A serialized email body with the per-recipient address headers kept
+  apart, so it can be sent to many recipients without being rendered
+  or encoded again.
+  '''
+
+  def __init__(self, sender, recipients, subject, body):
+    self.headers = [
+      ('Subject', subject),
+      ('From', sender),
+      ('To', ', '.join(recipients)),
+      ]
+    self.body = body
+
+  def __getitem__(self, name):
+    for header, value in self.headers:
+      if header.lower() == name.lower():
+        return value
+
+  def as_bytes(self, policy=SMTP):
+    headers = b''.join(
+      policy.fold_binary(name, policy.header_factory(name, value))
+      for name, value in self.headers)
+    return headers + self.body
+
+  def as_string(self):
+    return self.as_bytes().decode('utf-8')
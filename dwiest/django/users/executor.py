@@ -0,0 +1,162 @@
+from enum import Enum
+import atexit
+import logging
+import queue
+import threading
+import time
+from .conf import settings
+from .metrics import record_dropped
+
+logger = logging.getLogger(__name__)
+
+class Backpressure(str, Enum):
+  BLOCK = 'block'
+  CALLER_RUNS = 'caller_runs'
+  DROP = 'drop'
+
+
+class BoundedExecutor:
+  '''
+  A fixed-size thread pool with a bounded work queue.  When the queue is
+  full the backpressure policy decides whether submit() blocks until
+  there is room, runs the work on the calling thread, or drops it.
+  '''
+
+  # how often idle workers check for the end of the queue after shutdown
+  POLL_INTERVAL = 0.1
+
+  def __init__(self, max_workers, max_queue, backpressure=Backpressure.BLOCK,
+    name='dwiest-django-users'):
+
+    self.max_workers = max_workers
+    self.backpressure = Backpressure(backpressure)
+    self.name = name
+    self.dropped = 0
+
+    self._queue = queue.Queue(maxsize=max_queue)
+    self._threads = []
+    self._lock = threading.Lock()
+    self._shutdown = False
+
+  def submit(self, fn, *args, **kwargs):
+    if self._shutdown:
+      raise RuntimeError('cannot submit work after shutdown')
+
+    self._start_workers()
+    item = (fn, args, kwargs)
+
+    if self.backpressure == Backpressure.BLOCK:
+      self._queue.put(item)
+      return
+
+    try:
+      self._queue.put_nowait(item)
+
+    except queue.Full:
+      if self.backpressure == Backpressure.CALLER_RUNS:
+        self._run(item)
+
+      else:
+        with self._lock:
+          self.dropped += 1
+        record_dropped()
+        logger.warning('%s queue full, dropping %s', self.name, fn.__name__)
+
+  def shutdown(self, wait=True, timeout=None):
+    '''
+    Stop accepting work and let the workers finish everything already
+    queued, waiting up to timeout seconds if wait is set.  Never blocks
+    for longer than timeout, even when the queue is full.
+    '''
+    with self._lock:
+      if self._shutdown:
+        return
+      self._shutdown = True
+      threads = list(self._threads)
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    # wake idle workers.  If the queue is full the workers are busy, and
+    # they stop once it has drained without needing the sentinel
+    for thread in threads:
+      try:
+        if wait:
+          self._queue.put(None, timeout=self._remaining(deadline))
+        else:
+          self._queue.put_nowait(None)
+      except queue.Full:
+        break
+
+    if wait:
+      for thread in threads:
+        thread.join(self._remaining(deadline))
+
+  @staticmethod
+  def _remaining(deadline):
+    if deadline is None:
+      return None
+    return max(0, deadline - time.monotonic())
+
+  def _start_workers(self):
+    if len(self._threads) >= self.max_workers:
+      return
+
+    with self._lock:
+      while len(self._threads) < self.max_workers:
+        thread = threading.Thread(
+          target=self._work,
+          name='{}-{}'.format(self.name, len(self._threads)),
+          daemon=True,
+          )
+        thread.start()
+        self._threads.append(thread)
+
+  def _work(self):
+    while True:
+      try:
+        item = self._queue.get(
+          timeout=self.POLL_INTERVAL if self._shutdown else None)
+      except queue.Empty:
+        break
+
+      try:
+        if item is None:
+          break
+        self._run(item)
+      finally:
+        self._queue.task_done()
+
+  @staticmethod
+  def _run(item):
+    fn, args, kwargs = item
+
+    try:
+      fn(*args, **kwargs)
+    except Exception:
+      logger.exception('%s failed', getattr(fn, '__name__', fn))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+  global _executor
+
+  with _executor_lock:
+    if _executor is None:
+      _executor = BoundedExecutor(
+        settings.USERS_EMAIL_THREAD_POOL_SIZE,
+        settings.USERS_EMAIL_THREAD_QUEUE_SIZE,
+        backpressure=settings.USERS_EMAIL_THREAD_BACKPRESSURE,
+        )
+
+  return _executor
+
+def shutdown_executor():
+  with _executor_lock:
+    executor = _executor
+
+  if executor is not None:
+    executor.shutdown(timeout=settings.USERS_EMAIL_THREAD_SHUTDOWN_TIMEOUT)
+
+atexit.register(shutdown_executor)
@@ -1,18 +1,25 @@
-import datetime
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from django.core import signing
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django import forms
 from django.contrib.auth import forms as authForms
+from django.utils import timezone
 from django.utils.translation import ugettext, ugettext_lazy as _
 from enum import Enum, auto
-import pyotp
-import pytz
-import uuid
 from .conf import settings
 from .mfa import MfaModel, NonstickyTextInput
-from .models import ActivationId
+from .mfa.replay import accept_step
+from .mfa.totp import verify
+from .models import ActivationId, PendingRegistration
+from .tokens import (
+  SignedActivationId,
+  TokenPurpose,
+  TokenStatus,
+  is_signed_mode,
+  load_resend_target,
+  )
 
 class RegistrationForm(UserCreationForm):
 
@@ -26,6 +33,7 @@ class RegistrationForm(UserCreationForm):
     PASSWORD2 = 'password2'
 
   user = None
+  activation_id = None
 
   UserCreationForm.base_fields[Fields.PASSWORD2].label = \
     settings.USERS_REGISTRATION_PASSWORD2_FIELD_LABEL
@@ -88,7 +96,8 @@ class RegistrationForm(UserCreationForm):
     password = self.cleaned_data[self.__class__.Fields.PASSWORD1]
 
     # Create an account if one doesn't already exist
-    if not self.user:
+    created = not self.user
+    if created:
       self.user = User.objects.create_user(username, email, password)
 
     else:
@@ -97,23 +106,23 @@ class RegistrationForm(UserCreationForm):
     self.user.is_active=False
     self.user.save()
 
-    # Check if an activation record exists (it shouldn't); prevents multiple per-user
-    try:
-      activation_id = ActivationId.objects.get(user_id=self.user.id)
-
-      # Update the timestamp if it does exist
-      if settings.USE_TZ:
-        activation_id.created_at = datetime.datetime.now(tz=pytz.timezone(settings.TIME_ZONE))
-
-      else:
-        activation_id.created_at = datetime.datetime.now()
+    # only accounts created here are ever purged
+    if created:
+      PendingRegistration.objects.create(user=self.user)
+    else:
+      PendingRegistration.objects.filter(user=self.user).update(
+        issued_at=timezone.now())
 
-    except ObjectDoesNotExist:
-      # Create an activation id record if one doesn't exist (it shouldn't)
-      activation_id = ActivationId(value=uuid.uuid4(), user_id=self.user.id)
+    if is_signed_mode():
+      # signed after the password is set, so re-registering invalidates
+      # earlier links
+      self.activation_id = SignedActivationId.issue(
+        self.user, TokenPurpose.REGISTRATION)
 
-    activation_id.save()
-    self.activation_id = activation_id
+    else:
+      # Replaces an existing activation record (there shouldn't be one);
+      # prevents multiple per-user
+      self.activation_id = ActivationId.objects.issue(self.user)
 
 
 class RegistrationConfirmForm(forms.Form):
@@ -147,25 +156,43 @@ class RegistrationConfirmForm(forms.Form):
   def clean_activation_id(self):
     activation_id = self.cleaned_data[self.__class__.Fields.ACTIVATION_ID]
 
+    if is_signed_mode():
+      return self.clean_signed_activation_id(activation_id)
+
+    # the token, its user and whether it has expired in one query
+    resolution = ActivationId.objects.resolve(
+      activation_id, expiration_days=self.get_expiration_days())
+
+    if resolution.status == TokenStatus.UNKNOWN:
+      raise RegistrationConfirmForm.get_activation_id_invalid_error()
+
+    self.activation_id = resolution.activation_id
+
+    if resolution.status == TokenStatus.EXPIRED:
+      raise RegistrationConfirmForm.get_activation_id_expired_error()
+
+    return activation_id
+
+  def clean_signed_activation_id(self, activation_id):
     try:
-      self.activation_id = ActivationId.objects.get(value=activation_id)
+      self.activation_id = SignedActivationId.load(
+        activation_id, TokenPurpose.REGISTRATION, self.get_expiration_days())
 
-    except ObjectDoesNotExist:
+    except signing.SignatureExpired:
+      raise RegistrationConfirmForm.get_activation_id_expired_error()
+
+    except signing.BadSignature:
       raise RegistrationConfirmForm.get_activation_id_invalid_error()
 
-    # check if the activation_id has expired
+    return activation_id
+
+  @staticmethod
+  def get_expiration_days():
     if settings.USERS_ACTIVATION_ID_ALLOW_EXPIRED == True:
       print("!WARNING! Ignoring expired activation ids")
+      return None
 
-    else:
-      if settings.USE_TZ:
-        expires_at = datetime.datetime.now(tz=pytz.timezone(settings.TIME_ZONE)) - datetime.timedelta(days=settings.REGISTRATION_EXPIRATION_DAYS)
-      else:
-        expires_at = datetime.datetime.now() - datetime.timedelta(days=settings.REGISTRATION_EXPIRATION_DAYS)
-      if self.activation_id.created_at < expires_at:
-        raise RegistrationConfirmForm.get_activation_id_expired_error()
-
-    return activation_id
+    return settings.USERS_REGISTRATION_EXPIRATION_DAYS
 
   @classmethod
   def get_activation_id_invalid_error(cls):
@@ -182,12 +209,11 @@ class RegistrationConfirmForm(forms.Form):
       )
 
   def clean(self):
-    if hasattr(self, 'activation_id'):
-      try:
-        self.user = User.objects.get(id=self.activation_id.user_id)
+    if not hasattr(self, 'activation_id'):
+      return # clean_activation_id() has already reported the error
 
-      except ObjectDoesNotExist:
-        raise RegistrationConfirmForm.get_user_invalid_error()
+    # loaded along with the activation id
+    self.user = self.activation_id.user
 
     if settings.USERS_REGISTRATION_ALLOW_ALREADY_ACTIVE == True:
       print("!WARNING! allowing pre-existing user")
@@ -213,6 +239,7 @@ class RegistrationConfirmForm(forms.Form):
     # mark the user as active
     self.user.is_active = True
     self.user.save()
+    PendingRegistration.objects.filter(user=self.user).delete()
 
     # delete the activation id record
     if settings.USERS_ACTIVATION_ID_DO_NOT_DELETE == True:
@@ -252,15 +279,40 @@ class RegistrationResendForm(forms.Form):
       _(settings.USERS_REGISTRATION_RESEND_NOT_ALLOWED_ERROR),
     }
 
+  user = None
+
   def clean_activation_id(self):
     activation_id = self.cleaned_data[self.__class__.Fields.ACTIVATION_ID]
 
+    # the registration failed page links here with a signed resend value,
+    # the confirm failed page with the token from the email
     try:
-      self.activation_id = ActivationId.objects.get(value=activation_id)
+      self.user = load_resend_target(activation_id)
+      return activation_id
 
-    except ObjectDoesNotExist:
+    except signing.SignatureExpired:
+      raise RegistrationResendForm.get_activation_id_invalid_error()
+
+    except signing.BadSignature:
+      pass
+
+    if is_signed_mode():
+      # the link may have expired, that's why it is being resent
+      try:
+        self.user = SignedActivationId.load(
+          activation_id, TokenPurpose.REGISTRATION).user
+
+      except signing.BadSignature:
+        raise RegistrationResendForm.get_activation_id_invalid_error()
+
+      return activation_id
+
+    resolution = ActivationId.objects.resolve(activation_id)
+
+    if resolution.status == TokenStatus.UNKNOWN:
       raise RegistrationResendForm.get_activation_id_invalid_error()
 
+    self.user = resolution.user
     return activation_id
 
   @classmethod
@@ -292,29 +344,32 @@ class RegistrationResendForm(forms.Form):
     if settings.USERS_REGISTRATION_ALLOW_EMAIL_RESEND != True:
       raise RegistrationResendForm.get_resend_not_allowed_error()
 
-    # Check that the user is not already active
-    try:
-      self.user = User.objects.get(id=self.activation_id.user_id)
-
-    except ObjectDoesNotExist:
-      raise RegistrationResendForm.get_user_invalid_error()
+    if self.user is None:
+      return # clean_activation_id() has already reported the error
 
+    # Check that the user is not already active
     if settings.USERS_REGISTRATION_ALLOW_ALREADY_ACTIVE == True:
       print("!WARNING! allowing pre-existing user")
 
     elif self.user.is_active == True:
       raise RegistrationResendForm.get_user_already_active_error()
 
+    # only accounts created by RegistrationForm get activation links
+    if not PendingRegistration.objects.filter(user=self.user).exists():
+      raise RegistrationResendForm.get_user_invalid_error()
+
   def save(self):
-    # Update the created_at timestamp
-    if settings.USE_TZ == True:
-      timezone = pytz.timezone(settings.TIME_ZONE)
-      self.activation_id.created_at = datetime.datetime.now(tz=timezone)
+    if is_signed_mode():
+      self.activation_id = SignedActivationId.issue(
+        self.user, TokenPurpose.REGISTRATION)
 
     else:
-       self.activation_id.created_at = datetime.datetime.now()
+      # Only the digest is stored, so the email gets a new token; this
+      # also updates the created_at timestamp
+      self.activation_id = ActivationId.objects.issue(self.user)
 
-    self.activation_id.save()
+    PendingRegistration.objects.filter(user=self.user).update(
+      issued_at=timezone.now())
 
 
 class SendPasswordResetForm(forms.Form):
@@ -351,23 +406,13 @@ class SendPasswordResetForm(forms.Form):
     except ObjectDoesNotExist:
       raise self.get_invalid_user_error()
 
-    # Re-use an activation id record it exists; don't allows multiple per-user
-    try:
-      activation_id = ActivationId.objects.get(user_id=user.id)
+    if is_signed_mode():
+      self.activation_id = SignedActivationId.issue(
+        user, TokenPurpose.PASSWORD_RESET)
 
-      # Update the timestamp
-      if settings.USE_TZ:
-        activation_id.created_at = datetime.datetime.now(tz=pytz.timezone(settings.TIME_ZONE))
-
-      else:
-        activation_id.created_at = datetime.datetime.now()
-
-    except ObjectDoesNotExist:
-      # No record found, create a new one
-      activation_id = ActivationId(user_id=user.id, value=uuid.uuid4())
-
-    activation_id.save()
-    self.activation_id = activation_id
+    else:
+      # Replace an existing activation id record; don't allows multiple per-user
+      self.activation_id = ActivationId.objects.issue(user)
 
   @classmethod
   def get_invalid_user_error(cls):
@@ -443,27 +488,50 @@ class PasswordResetConfirmForm(authForms.PasswordChangeForm):
   def clean_activation_id(self):
     id = self.cleaned_data[self.__class__.Fields.ACTIVATION_ID]
 
-    try:
-      self.activation_id = ActivationId.objects.get(value=id)
-      self.user = User.objects.get(id=self.activation_id.user_id, is_active=True)
+    if is_signed_mode():
+      return self.clean_signed_activation_id(id)
 
-    except ObjectDoesNotExist:
+    # the token, its user and whether it has expired in one query
+    resolution = ActivationId.objects.resolve(
+      id,
+      expiration_days=self.get_expiration_days(),
+      require_active_user=True,
+      )
+
+    if resolution.status in (TokenStatus.UNKNOWN, TokenStatus.USER_INACTIVE):
       raise PasswordResetConfirmForm.get_activation_id_invalid_error()
 
-    # check if the activation_id has expired
+    self.activation_id = resolution.activation_id
+    self.user = resolution.user
+
+    if resolution.status == TokenStatus.EXPIRED:
+      raise PasswordResetConfirmForm.get_activation_id_expired_error()
+
+    return id
+
+  @staticmethod
+  def get_expiration_days():
     if settings.USERS_ACTIVATION_ID_ALLOW_EXPIRED == True:
       print("!WARNING! Ignoring expired activation ids")
+      return None
 
-    else:
-      if settings.USE_TZ:
-        expires_at = datetime.datetime.now(tz=pytz.timezone(settings.TIME_ZONE)) - datetime.timedelta(days=settings.USERS_PASSWORD_RESET_EXPIRATION_DAYS)
+    return settings.USERS_PASSWORD_RESET_EXPIRATION_DAYS
 
-      else:
-        expires_at = datetime.datetime.now() - datetime.timedelta(days=settings.USERS_PASSWORD_RESET_EXPIRATION_DAYS)
+  def clean_signed_activation_id(self, id):
+    try:
+      self.activation_id = SignedActivationId.load(
+        id, TokenPurpose.PASSWORD_RESET, self.get_expiration_days())
+
+    except signing.SignatureExpired:
+      raise PasswordResetConfirmForm.get_activation_id_expired_error()
 
-      if self.activation_id.created_at < expires_at:
-        raise PasswordResetConfirmForm.get_activation_id_expired_error()
+    except signing.BadSignature:
+      raise PasswordResetConfirmForm.get_activation_id_invalid_error()
+
+    if not self.activation_id.user.is_active:
+      raise PasswordResetConfirmForm.get_activation_id_invalid_error()
 
+    self.user = self.activation_id.user
     return id
 
   def clean_mfa_token(self):
@@ -477,18 +545,15 @@ class PasswordResetConfirmForm(authForms.PasswordChangeForm):
 
       try:
         user_mfa = MfaModel.objects.get(user_id=self.user.id)
-        totp = pyotp.TOTP(user_mfa.secret_key)
 
-        if mfa_token != totp.now():
+        step = verify(user_mfa.secret_key, mfa_token)
+
+        if step is None:
           raise PasswordResetConfirmForm.get_invalid_mfa_token_error()
 
-        elif mfa_token == user_mfa.last_value:
+        elif not accept_step(user_mfa, step):
           raise PasswordResetConfirmForm.get_replayed_mfa_token_error()
 
-        else:
-          user_mfa.last_value = mfa_token
-          user_mfa.save()
-
       except ObjectDoesNotExist:
         raise PasswordResetConfirmForm.get_invalid_mfa_token_error()
 
@@ -568,18 +633,15 @@ class PasswordChangeForm(authForms.PasswordChangeForm):
     if mfa_token != None:
       try:
         user_mfa = MfaModel.objects.get(user_id=self.user.id)
-        totp = pyotp.TOTP(user_mfa.secret_key)
 
-        if mfa_token != totp.now():
+        step = verify(user_mfa.secret_key, mfa_token)
+
+        if step is None:
           raise PasswordChangeForm.get_invalid_mfa_token_error()
 
-        elif mfa_token == user_mfa.last_value:
+        elif not accept_step(user_mfa, step):
           raise PasswordChangeForm.get_replayed_mfa_token_error()
 
-        else:
-          user_mfa.last_value = mfa_token
-          user_mfa.save()
-
       except ObjectDoesNotExist:
           raise PasswordChangeForm.get_invalid_mfa_token_error()
 
@@ -0,0 +1,136 @@
+import re
+
+# Preprocessing for HTML email templates.  These work on the template
+# source before it is compiled, so the cost is paid once per process
+# rather than once per message.
+
+STYLE_RE = re.compile(r'<style[^>]*>(.*?)</style>', re.IGNORECASE | re.DOTALL)
+RULE_RE = re.compile(r'([^{}@]+)\{([^{}]*)\}')
+AT_RULE_RE = re.compile(r'@[^{]+\{(?:[^{}]*\{[^{}]*\})*[^{}]*\}', re.DOTALL)
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+START_TAG_RE = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)(\s[^<>]*?)?(/?)>')
+ATTRIBUTE_RE = r'\s{}\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+)'
+SELECTOR_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9]*)?(?:#([\w-]+))?((?:\.[\w-]+)*)$')
+HTML_COMMENT_RE = re.compile(r'<!--(?!\[if).*?-->', re.DOTALL)
+PRESERVE_RE = re.compile(r'(<(pre|textarea)\b.*?</\2>)', re.IGNORECASE | re.DOTALL)
+WHITESPACE_RE = re.compile(r'\s+')
+
+def parse_selector(selector):
+  '''
+  Parse a simple selector (tag, #id, .class or a combination of them)
+  into (tag, id, classes, specificity).  Returns None for anything more
+  complex, which is left in the style block.
+  '''
+  match = SELECTOR_RE.match(selector.strip())
+  if not match or not selector.strip():
+    return None
+
+  tag, id, classes = match.groups()
+  classes = set(c for c in classes.split('.') if c)
+  specificity = (1 if id else 0, len(classes), 1 if tag else 0)
+  return (tag and tag.lower(), id, classes, specificity)
+
+def parse_rules(css):
+  '''
+  Split a stylesheet into rules that can be inlined and the remaining
+  CSS (at-rules and complex selectors) that has to stay in a style
+  block.
+  '''
+  css = CSS_COMMENT_RE.sub('', css)
+  remaining = AT_RULE_RE.findall(css)
+  css = AT_RULE_RE.sub('', css)
+  rules = []
+
+  for order, (selectors, declarations) in enumerate(RULE_RE.findall(css)):
+    declarations = ';'.join(
+      d.strip() for d in declarations.split(';') if d.strip())
+
+    for selector in selectors.split(','):
+      parsed = parse_selector(selector)
+      if parsed:
+        rules.append(parsed + (order, declarations))
+      else:
+        remaining.append('{}{{{}}}'.format(selector.strip(), declarations))
+
+  rules.sort(key=lambda rule: (rule[3], rule[4]))
+  return rules, remaining
+
+def get_attribute(attributes, name):
+  match = re.search(ATTRIBUTE_RE.format(name), attributes, re.IGNORECASE)
+  if match:
+    return match.group(1).strip('\'"')
+
+def inline_css(html):
+  '''
+  Move the declarations from <style> blocks onto the style attribute of
+  the elements they select.  Existing style attributes take precedence.
+  '''
+  stylesheets = STYLE_RE.findall(html)
+  if not stylesheets:
+    return html
+
+  rules, remaining = parse_rules('\n'.join(stylesheets))
+
+  # rules that can't be inlined go back in the first style block
+  def replace_style(match):
+    nonlocal remaining
+    style = remaining and '<style>{}</style>'.format(''.join(remaining))
+    remaining = None
+    return style or ''
+
+  html = STYLE_RE.sub(replace_style, html)
+
+  def replace_tag(match):
+    tag, attributes, closing = match.group(1), match.group(2) or '', match.group(3)
+    id = get_attribute(attributes, 'id')
+    classes = set((get_attribute(attributes, 'class') or '').split())
+
+    declarations = []
+    matched = set()
+
+    for rule_tag, rule_id, rule_classes, specificity, order, rule_declarations in rules:
+      if order in matched:
+        # another selector of the same rule already matched
+        continue
+      if (rule_tag is None or rule_tag == tag.lower()) \
+        and (rule_id is None or rule_id == id) and rule_classes <= classes:
+        declarations.append(rule_declarations)
+        matched.add(order)
+
+    if not declarations:
+      return match.group(0)
+
+    style = get_attribute(attributes, 'style')
+    if style:
+      declarations.append(style)
+      attributes = re.sub(ATTRIBUTE_RE.format('style'), '', attributes, flags=re.IGNORECASE)
+
+    return '<{}{} style="{}"{}>'.format(
+      tag, attributes.rstrip(), ';'.join(declarations).replace('"', "'"), closing)
+
+  return START_TAG_RE.sub(replace_tag, html)
+
+def minify_html(html):
+  '''
+  Strip comments and collapse whitespace outside of <pre> and
+  <textarea> elements.  Line breaks are kept so lines stay short.
+  '''
+  html = HTML_COMMENT_RE.sub('', html)
+  parts = PRESERVE_RE.split(html)
+  minified = []
+
+  # split() returns [text, preserved, tag name, text, ...]
+  for i in range(0, len(parts), 3):
+    minified.append(WHITESPACE_RE.sub(
+      lambda m: '\n' if '\n' in m.group(0) else ' ', parts[i]))
+    if i + 1 < len(parts):
+      minified.append(parts[i + 1])
+
+  return ''.join(minified).strip()
+
+def build(html, inline=True, minify=True):
+  if inline:
+    html = inline_css(html)
+  if minify:
+    html = minify_html(html)
+  return html
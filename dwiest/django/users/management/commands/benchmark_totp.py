@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+import base64
+import os
+import time
+from ...conf import settings
+from ...mfa import totp
+
+class Command(BaseCommand):
+  help = 'Measure MFA token verifications per second.'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--iterations',
+      type=int,
+      default=100000,
+      help='Number of verifications to run.',
+      )
+    parser.add_argument(
+      '--users',
+      type=int,
+      default=100,
+      help='Number of distinct secret keys to verify against.',
+      )
+    parser.add_argument(
+      '--window',
+      type=int,
+      default=settings.USERS_MFA_TOKEN_VALID_WINDOW,
+      help='Number of time steps checked either side of the current one.',
+      )
+
+  def handle(self, *args, **options):
+    secret_keys = [
+      base64.b32encode(os.urandom(20)).decode('ascii')
+      for i in range(options['users'])
+      ]
+
+    totp.decode_secret.cache_clear()
+    self.run('cold', secret_keys[:1], 1, options['window'])
+    self.run('verify', secret_keys, options['iterations'], options['window'])
+
+    info = totp.decode_secret.cache_info()
+    self.stdout.write('secret cache hits={} misses={}'.format(info.hits, info.misses))
+
+  def run(self, name, secret_keys, iterations, window):
+    start = time.perf_counter()
+
+    for i in range(iterations):
+      # a wrong token makes every step in the window be computed
+      totp.verify(secret_keys[i % len(secret_keys)], '000000', window=window)
+
+    seconds = time.perf_counter() - start
+    self.stdout.write('{} iterations={} window={} seconds={:.3f} verifications/s={:.0f}'.format(
+      name, iterations, window, seconds, iterations / seconds))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.template.loader import get_template
+from ...renderer import renderer
+
+class Command(BaseCommand):
+  help = 'Report the size of the HTML email templates before and after CSS inlining and minification.'
+
+  # Templates are built in memory by the renderer of each process when
+  # they are first loaded, nothing is written to disk.  This only warms
+  # this process's cache to report the savings; it is not a build step.
+
+  def handle(self, *args, **options):
+    renderer.clear()
+
+    for name, template in sorted(renderer.load().items()):
+      original = getattr(get_template(name).template, 'source', None)
+      built = getattr(template.template, 'source', None)
+
+      if original is None or built is None:
+        self.stdout.write('{} skipped'.format(name))
+        continue
+
+      self.stdout.write('{} {} -> {} bytes'.format(
+        name, len(original.encode('utf-8')), len(built.encode('utf-8'))))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+import time
+from ...conf import settings
+from ...outbox import drain, get_lease_owner
+
+class Command(BaseCommand):
+  help = 'Send pending messages from the email outbox.'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--batch-size',
+      type=int,
+      default=settings.USERS_EMAIL_OUTBOX_BATCH_SIZE,
+      help='Number of messages to claim and send per connection.',
+      )
+    parser.add_argument(
+      '--loop',
+      action='store_true',
+      help='Keep polling the outbox instead of exiting once it is empty.',
+      )
+    parser.add_argument(
+      '--interval',
+      type=float,
+      default=settings.USERS_EMAIL_OUTBOX_POLL_INTERVAL,
+      help='Seconds to wait between polls when --loop is given.',
+      )
+
+  def handle(self, *args, **options):
+    owner = get_lease_owner()
+
+    while True:
+      sent, failed = drain(owner=owner, batch_size=options['batch_size'])
+
+      if sent or failed:
+        self.stdout.write('sent={} failed={}'.format(sent, failed))
+
+      if not options['loop']:
+        break
+
+      time.sleep(options['interval'])
@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...conf import settings
+from ...mfa.provision import get_users, provision, read_usernames
+
+class Command(BaseCommand):
+  help = 'Enable MFA for many users at once and write their QR codes to a directory or zip file.'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      'usernames',
+      nargs='*',
+      help='Users to provision.',
+      )
+    parser.add_argument(
+      '--csv',
+      help='CSV file with a username column, or usernames in its first column.',
+      )
+    parser.add_argument(
+      '--group',
+      help='Provision the members of this group.',
+      )
+    parser.add_argument(
+      '--output',
+      required=True,
+      help='Directory for the QR codes, or a path ending in .zip for a single archive.',
+      )
+    parser.add_argument(
+      '--batch-size',
+      type=int,
+      default=settings.USERS_MFA_PROVISION_BATCH_SIZE,
+      help='Number of MFA records created per statement.',
+      )
+    parser.add_argument(
+      '--workers',
+      type=int,
+      default=settings.USERS_MFA_PROVISION_WORKERS,
+      help='Number of processes rendering QR codes, defaults to the number of CPUs.',
+      )
+
+  def handle(self, *args, **options):
+    usernames = None
+
+    if options['usernames'] or options['csv']:
+      usernames = list(options['usernames'])
+      if options['csv']:
+        usernames += read_usernames(options['csv'])
+
+    if usernames is None and options['group'] is None:
+      raise CommandError('Give usernames, --csv or --group.')
+
+    users = get_users(usernames=usernames, group=options['group'])
+
+    result = provision(
+      users,
+      options['output'],
+      batch_size=options['batch_size'],
+      workers=options['workers'],
+      stdout=self.stdout,
+      )
+
+    if usernames is not None:
+      found = set(user.get_username() for user in users)
+      for username in sorted(set(usernames) - found):
+        result.errors.append((username, 'no active user with that username'))
+
+    for username, error in result.errors:
+      self.stderr.write('{}: {}'.format(username, error))
+
+    self.stdout.write('provisioned={} skipped={} errors={} batches={} seconds={:.2f} users/s={:.1f}'.format(
+      result.provisioned,
+      result.skipped,
+      len(result.errors),
+      result.batches,
+      result.seconds,
+      result.users_per_second,
+      ))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from ...conf import settings
+from ...purge import purge
+
+class Command(BaseCommand):
+  help = 'Delete expired activation ids, registrations that were never activated and old outbox messages.'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--batch-size',
+      type=int,
+      default=settings.USERS_PURGE_BATCH_SIZE,
+      help='Number of rows deleted per statement.',
+      )
+    parser.add_argument(
+      '--sleep',
+      type=float,
+      default=settings.USERS_PURGE_SLEEP,
+      help='Seconds to wait between batches.',
+      )
+    parser.add_argument(
+      '--dry-run',
+      action='store_true',
+      help='Count the rows that would be deleted without deleting them.',
+      )
+
+  def handle(self, *args, **options):
+    result = purge(
+      batch_size=options['batch_size'],
+      sleep=options['sleep'],
+      dry_run=options['dry_run'],
+      )
+
+    if options['dry_run']:
+      self.stdout.write('would delete users={} activation_ids={} outbox_messages={}'.format(
+        result.users, result.activation_ids, result.outbox_messages))
+      return
+
+    self.stdout.write('users={} activation_ids={} outbox_messages={} batches={} seconds={:.2f} rows/s={:.1f}'.format(
+      result.users,
+      result.activation_ids,
+      result.outbox_messages,
+      result.batches,
+      result.seconds,
+      result.rows_per_second,
+      ))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from ...email import get_default_connection_pool
+from ...smtp import get_spool, is_relay_error
+
+class Command(BaseCommand):
+  help = 'Send messages spooled while the mail relay was unavailable.'
+
+  def handle(self, *args, **options):
+    spool = get_spool()
+
+    if spool is None:
+      self.stderr.write('USERS_EMAIL_SPOOL_DIR is not set.')
+      return
+
+    pool = get_default_connection_pool()
+    sent = spool.replay(pool.sendmail, should_stop=is_relay_error)
+    self.stdout.write('sent={} pending={} failed={}'.format(
+      sent, len(spool), len(spool.failed())))
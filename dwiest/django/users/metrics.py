@@ -0,0 +1,191 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+import bisect
+import smtplib
+import threading
+import time
+from .conf import settings
+
+STAGE_SECONDS = 'email.stage.seconds'
+STAGE_ERRORS = 'email.stage.errors'
+SENT = 'email.sent'
+SMTP_ERRORS = 'email.smtp.errors'
+DROPPED = 'email.dropped'
+
+current_notification = ContextVar('current_notification', default=None)
+
+
+class Reporter:
+  '''
+  Receives the email pipeline's metrics.  tags is a tuple of
+  (name, value) pairs sorted by name.
+  '''
+
+  def increment(self, name, tags=(), value=1):
+    pass
+
+  def observe(self, name, value, tags=()):
+    pass
+
+
+class Histogram:
+  BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+  def __init__(self):
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+    self.buckets = [0] * (len(self.BUCKETS) + 1) # the last one is +Inf
+
+  def observe(self, value):
+    self.count += 1
+    self.sum += value
+    self.max = max(self.max, value)
+    self.buckets[bisect.bisect_left(self.BUCKETS, value)] += 1
+
+  def quantile(self, q):
+    '''
+    The upper bound of the bucket holding the q-th quantile.
+    '''
+    rank = q * self.count
+    total = 0
+
+    for bound, count in zip(self.BUCKETS + (self.max,), self.buckets):
+      total += count
+      if total >= rank and count:
+        return min(bound, self.max)
+
+    return 0.0
+
+  def as_dict(self):
+    return {
+      'count': self.count,
+      'sum': self.sum,
+      'max': self.max,
+      'p50': self.quantile(0.5),
+      'p99': self.quantile(0.99),
+      }
+
+
+class InMemoryReporter(Reporter):
+  '''
+  Keeps counters and latency histograms in process memory.
+  '''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def increment(self, name, tags=(), value=1):
+    key = (name, tags)
+    with self._lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name, value, tags=()):
+    key = (name, tags)
+    with self._lock:
+      histogram = self.histograms.get(key)
+      if histogram is None:
+        histogram = self.histograms[key] = Histogram()
+      histogram.observe(value)
+
+  def get_counter(self, name, **tags):
+    '''
+    The sum of name's counters whose tags include the given ones.
+    '''
+    with self._lock:
+      return sum(
+        value for (counter_name, counter_tags), value in self.counters.items()
+        if counter_name == name and set(tags.items()) <= set(counter_tags))
+
+  def snapshot(self):
+    with self._lock:
+      return {
+        'counters': dict(self.counters),
+        'histograms': {k: v.as_dict() for k, v in self.histograms.items()},
+        }
+
+  def reset(self):
+    with self._lock:
+      self.counters = {}
+      self.histograms = {}
+
+
+_reporter = None
+_reporter_lock = threading.Lock()
+
+def get_reporter():
+  global _reporter
+
+  with _reporter_lock:
+    if _reporter is None:
+      path = settings.USERS_EMAIL_METRICS_REPORTER
+      _reporter = import_string(path)() if path else Reporter()
+
+  return _reporter
+
+@receiver(setting_changed)
+def setting_changed_callback(sender, setting, **kwargs):
+  global _reporter
+
+  if setting == 'USERS_EMAIL_METRICS_REPORTER':
+    with _reporter_lock:
+      _reporter = None
+
+def get_tags(**tags):
+  notification = current_notification.get()
+  tags['notification'] = notification.value if notification is not None else 'unknown'
+  return tuple(sorted(tags.items()))
+
+@contextmanager
+def notification(value):
+  '''
+  Attribute the metrics recorded inside the block to a notification.
+  '''
+  token = current_notification.set(value)
+  try:
+    yield
+  finally:
+    current_notification.reset(token)
+
+@contextmanager
+def timed(stage):
+  '''
+  Record the time spent in the block as a stage of the email pipeline:
+  template, render, mime, connect, login or sendmail.
+  '''
+  reporter = get_reporter()
+  tags = get_tags(stage=stage)
+  start = time.perf_counter()
+
+  try:
+    yield
+  except BaseException:
+    reporter.increment(STAGE_ERRORS, tags)
+    raise
+  finally:
+    reporter.observe(STAGE_SECONDS, time.perf_counter() - start, tags)
+
+def record_sent(count=1):
+  get_reporter().increment(SENT, get_tags(), count)
+
+def record_dropped(count=1):
+  get_reporter().increment(DROPPED, get_tags(), count)
+
+def record_smtp_error(error):
+  '''
+  Count an SMTP error by reply code.  Errors without one, such as
+  dropped connections, are counted under their class name.
+  '''
+  reporter = get_reporter()
+
+  if isinstance(error, smtplib.SMTPRecipientsRefused):
+    codes = [code for code, message in error.recipients.values()]
+  else:
+    codes = [getattr(error, 'smtp_code', None) or type(error).__name__]
+
+  for code in codes:
+    reporter.increment(SMTP_ERRORS, get_tags(code=str(code)))
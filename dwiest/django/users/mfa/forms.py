@@ -1,12 +1,16 @@
 import base64
 from django import forms
 from django.core.exceptions import ValidationError
+from django.utils.functional import cached_property
 from django.utils.translation import gettext as _
 from enum import Enum, auto
+from functools import lru_cache
 from io import BytesIO
 import pyotp
 import qrcode
+import qrcode.image.svg
 from ..conf import settings
+from .totp import verify
 
 # copied from https://stackoverflow.com/questions/43425116/clear-all-form-fields-on-validation-error-in-django
 class NonstickyTextInput(forms.TextInput):
@@ -71,6 +75,7 @@ class MfaEnableForm(forms.Form):
     super(forms.Form, self).__init__(*args, **kwargs)
 
     self.user = user
+    self.step = None # time step of the token that was entered
 
     if settings.USERS_MFA_SECRET_KEY:
       self.initial[self.Fields.SECRET_KEY] = settings.USERS_MFA_SECRET_KEY
@@ -81,17 +86,24 @@ class MfaEnableForm(forms.Form):
     else:
       self.initial[self.Fields.SECRET_KEY] = pyotp.random_base32()
 
-    self.totp = pyotp.TOTP(self.initial[self.Fields.SECRET_KEY])
     self.account_name = None
 
     self.mfa_issuer_name = settings.USERS_MFA_ISSUER_NAME
 
-    self.provisioning_uri = self.totp.provisioning_uri(
-      name=self.account_name,
-      issuer_name=self.mfa_issuer_name
+    self.provisioning_uri = self.get_provisioning_uri(
+      self.initial[self.Fields.SECRET_KEY], self.account_name)
+
+  @staticmethod
+  def get_provisioning_uri(secret_key, account_name=None):
+    return pyotp.TOTP(secret_key).provisioning_uri(
+      name=account_name,
+      issuer_name=settings.USERS_MFA_ISSUER_NAME
       )
 
-    self.secret_key_image = self.get_qrcode(self.provisioning_uri)
+  @cached_property
+  def secret_key_image(self):
+    # only rendered when the template shows it, a valid POST never does
+    return self.get_qrcode(self.provisioning_uri)
 
   def clean(self):
     if self.user.check_password(self.cleaned_data[self.Fields.PASSWORD]) != True:
@@ -100,49 +112,89 @@ class MfaEnableForm(forms.Form):
     if settings.USERS_MFA_ACCEPT_ANY_VALUE == True:
       print("!WARNING! MFA accepting any value")
 
-    elif self.cleaned_data[self.Fields.TOKEN] == self.totp.now():
-      pass
-
     else:
-      raise self.get_invalid_token_error()
+      self.step = verify(
+        self.initial[self.Fields.SECRET_KEY], self.cleaned_data[self.Fields.TOKEN])
+
+      if self.step is None:
+        raise self.get_invalid_token_error()
 
     return super().clean()
 
   @classmethod
-  def get_token_invalid_error(cls):
+  def get_invalid_token_error(cls):
     return ValidationError(
-      cls.error_messages[cls.Errors.TOKEN_INVALID_ERROR],
-      code=cls.Errors.TOKEN_INVALID_ERROR,
+      cls.error_messages[cls.Errors.TOKEN_INVALID],
+      code=cls.Errors.TOKEN_INVALID,
       )
 
   @classmethod
   def get_invalid_password_error(cls):
     return ValidationError(
-      cls.error_messages[cls.Errors.PASSWORD_INVALID_ERROR],
-      code=cls.Errors.PASSWORD_INVALID_ERROR,
+      cls.error_messages[cls.Errors.PASSWORD_INVALID],
+      code=cls.Errors.PASSWORD_INVALID,
       )
 
   @staticmethod
   def get_qrcode(text):
-    qr = qrcode.QRCode(
-      version=settings.USERS_MFA_QRCODE_VERSION,
-      error_correction=settings.USERS_MFA_QRCODE_ERROR_CORRECTION,
-      box_size=settings.USERS_MFA_QRCODE_BOX_SIZE,
-      border=settings.USERS_MFA_QRCODE_BORDER,
-    )
+    encoded_img = base64.b64encode(MfaEnableForm.get_qrcode_image(text))
+    return encoded_img.decode("utf-8")
+
+  @staticmethod
+  def get_qrcode_image(text):
+    # the render settings are part of the cache key
+    return render_qrcode(
+      text,
+      settings.USERS_MFA_QRCODE_VERSION,
+      settings.USERS_MFA_QRCODE_ERROR_CORRECTION,
+      settings.USERS_MFA_QRCODE_BOX_SIZE,
+      settings.USERS_MFA_QRCODE_BORDER,
+      settings.USERS_MFA_QRCODE_FILL_COLOR,
+      settings.USERS_MFA_QRCODE_BACKGROUND_COLOR,
+      settings.USERS_MFA_QRCODE_IMAGE_MODE,
+      settings.USERS_MFA_QRCODE_IMAGE_FORMAT,
+      )
+
+
+@lru_cache(maxsize=settings.USERS_MFA_QRCODE_CACHE_SIZE)
+def render_qrcode(text, version, error_correction, box_size, border,
+  fill_color, back_color, mode, format):
+
+  qr = qrcode.QRCode(
+    version=version,
+    error_correction=error_correction,
+    box_size=box_size,
+    border=border,
+  )
+
+  qr.add_data(text)
+  qr.make(fit=True)
 
-    qr.add_data(text)
-    qr.make(fit=True)
+  stream = BytesIO()
 
-    img = qr.make_image(
-      fill_color=settings.USERS_MFA_QRCODE_FILL_COLOR,
-      back_color=settings.USERS_MFA_QRCODE_BACKGROUND_COLOR,
-      ).convert('RGB')
+  if format.upper() == 'SVG':
+    img = qr.make_image(image_factory=qrcode.image.svg.SvgPathImage)
+    img.save(stream)
+    return stream.getvalue()
 
-    stream = BytesIO()
-    img.save(stream, format=settings.USERS_MFA_QRCODE_IMAGE_FORMAT)
-    encoded_img = base64.b64encode(stream.getvalue()).decode("utf-8")
-    return encoded_img
+  img = qr.make_image(fill_color=fill_color, back_color=back_color)
+
+  if mode == 'P':
+    # black on white is already a 1-bit image, other colours are
+    # reduced straight to a two colour palette
+    if img.mode != '1':
+      img = img.quantize(colors=2)
+  elif mode:
+    img = img.convert(mode)
+
+  img.save(stream, format=format)
+  return stream.getvalue()
+
+def get_qrcode_content_type():
+  format = settings.USERS_MFA_QRCODE_IMAGE_FORMAT.lower()
+  if format == 'svg':
+    return 'image/svg+xml'
+  return 'image/' + format
 
 
 class MfaDisableForm(forms.Form):
@@ -191,7 +243,7 @@ class MfaDisableForm(forms.Form):
 
   def clean(self):
     if self.user.check_password(self.cleaned_data[self.Fields.PASSWORD]) != True:
-      raise self.get_invalid_password_error()
+      raise self.get_password_invalid_error()
 
     if self.cleaned_data[self.Fields.DISABLE_MFA] != self.confirm_message:
       raise self.get_confirm_message_invalid_error()
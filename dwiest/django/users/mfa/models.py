@@ -12,8 +12,8 @@ class MfaModel(models.Model):
     max_length=settings.USERS_MFA_SECRET_KEY_LENGTH,
     )
 
-  last_value = models.CharField(
-    max_length=settings.USERS_MFA_TOKEN_LENGTH,
+  # time step of the last accepted token, see mfa.replay
+  last_step = models.BigIntegerField(
     null=True,
     blank=True
     )
@@ -0,0 +1,268 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+import csv
+import io
+import os
+import pyotp
+import time
+import zipfile
+from ..conf import settings
+from .forms import MfaEnableForm
+from .models import MfaModel
+from .status import invalidate
+
+MANIFEST = 'manifest.csv'
+
+class ProvisionResult:
+
+  def __init__(self):
+    self.provisioned = 0
+    self.skipped = 0
+    self.errors = []
+    self.batches = 0
+    self.seconds = 0.0
+
+  @property
+  def users_per_second(self):
+    if not self.seconds:
+      return 0.0
+    return self.provisioned / self.seconds
+
+  def __repr__(self):
+    return '<ProvisionResult provisioned={} skipped={} errors={} seconds={:.2f}>'.format(
+      self.provisioned, self.skipped, len(self.errors), self.seconds)
+
+
+def open_private(path, mode='wb'):
+  '''
+  Open a file for writing that only its owner can read: the QR codes
+  hold the users' secret keys.
+  '''
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  return os.fdopen(fd, mode)
+
+
+class DirectoryWriter:
+
+  def __init__(self, path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    self.path = path
+
+  def write(self, name, data):
+    mode = 'w' if isinstance(data, str) else 'wb'
+    with open_private(os.path.join(self.path, name), mode) as f:
+      f.write(data)
+
+  def discard(self, names):
+    for name in names:
+      try:
+        os.remove(os.path.join(self.path, name))
+      except FileNotFoundError:
+        pass
+
+  def close(self):
+    pass
+
+
+class ZipWriter:
+
+  def __init__(self, path):
+    self.file = open_private(path)
+    # the images are already compressed
+    self.archive = zipfile.ZipFile(self.file, 'w', compression=zipfile.ZIP_STORED)
+
+  def write(self, name, data):
+    self.archive.writestr(name, data)
+
+  def discard(self, names):
+    # entries can't be removed from a zip file; the write error fails the
+    # whole run, so the archive isn't handed out
+    pass
+
+  def close(self):
+    try:
+      self.archive.close()
+    finally:
+      self.file.close()
+
+
+def get_writer(path):
+  if path.lower().endswith('.zip'):
+    return ZipWriter(path)
+  return DirectoryWriter(path)
+
+def read_usernames(csv_file):
+  '''
+  Usernames from the 'username' column of a CSV file, or its first
+  column if it has no header.
+  '''
+  with open(csv_file, newline='') as f:
+    rows = list(csv.reader(f))
+
+  if not rows:
+    return []
+
+  header = [column.strip().lower() for column in rows[0]]
+
+  if 'username' in header:
+    index = header.index('username')
+    rows = rows[1:]
+  else:
+    index = 0
+
+  return [row[index].strip() for row in rows if len(row) > index and row[index].strip()]
+
+def get_users(usernames=None, group=None):
+  users = User.objects.filter(is_active=True)
+
+  if usernames is not None:
+    users = users.filter(username__in=usernames)
+
+  if group is not None:
+    users = users.filter(groups__name=group)
+
+  return users.select_related('mfamodel').order_by('pk')
+
+def get_extension():
+  format = settings.USERS_MFA_QRCODE_IMAGE_FORMAT.lower()
+  if format == 'jpeg':
+    return 'jpg'
+  return format
+
+def init_worker():
+  # workers started with spawn don't inherit the configured Django
+  import django
+  django.setup()
+
+def render(job):
+  '''
+  Runs in a worker process.  Errors are returned rather than raised so
+  one bad user doesn't stop the batch.
+  '''
+  user_id, provisioning_uri = job
+  try:
+    return user_id, MfaEnableForm.get_qrcode_image(provisioning_uri), None
+  except Exception as e:
+    return user_id, None, '{}: {}'.format(type(e).__name__, e)
+
+def save_batch(batch, result):
+  '''
+  Create the MfaModel rows for a batch.  Returns the rows that were
+  created; a user who enrolled meanwhile is reported as an error.
+  '''
+  try:
+    with transaction.atomic():
+      MfaModel.objects.bulk_create(batch)
+    return batch
+  except IntegrityError:
+    pass
+
+  # find the rows that failed one at a time
+  created = []
+  for row in batch:
+    try:
+      with transaction.atomic():
+        row.save(force_insert=True)
+      created.append(row)
+    except IntegrityError as e:
+      result.errors.append((row.username, 'IntegrityError: {}'.format(e)))
+
+  return created
+
+def flush(batch, images, writer, manifest, result):
+  '''
+  Create a batch's rows and write their QR codes in one transaction, so
+  no user is left with a secret key they never received.  If a write
+  fails the batch is rolled back, its files removed and the error
+  raised.
+  '''
+  extension = get_extension()
+  written = []
+
+  with transaction.atomic():
+    created = save_batch(batch, result)
+
+    try:
+      for row in created:
+        name = '{}.{}'.format(row.username, extension)
+        writer.write(name, images.pop(row.user_id))
+        written.append((row, name))
+    except BaseException:
+      writer.discard([name for row, name in written])
+      raise
+
+  for row, name in written:
+    invalidate(row.user_id)
+    manifest.writerow([row.username, name])
+    result.provisioned += 1
+
+  result.batches += 1
+
+def provision(users, output, batch_size, workers=None, stdout=None):
+  '''
+  Give each user without MFA a new secret key, write their QR code to
+  output, a directory or a .zip file, and create their MfaModel rows
+  batch_size at a time.
+  '''
+  result = ProvisionResult()
+  start = time.perf_counter()
+
+  rows = {}
+  jobs = []
+
+  for user in users:
+    if hasattr(user, 'mfamodel'):
+      result.skipped += 1
+      continue
+
+    row = MfaModel(user_id=user.pk, secret_key=pyotp.random_base32())
+    row.username = user.get_username()
+    rows[user.pk] = row
+    jobs.append((user.pk, MfaEnableForm.get_provisioning_uri(
+      row.secret_key, row.username)))
+
+  writer = get_writer(output)
+  manifest_file = io.StringIO()
+  manifest = csv.writer(manifest_file)
+  manifest.writerow(['username', 'file'])
+
+  batch = []
+  images = {}
+
+  workers = workers or os.cpu_count() or 1
+  # big enough chunks to amortise the pickling, small enough to keep
+  # every worker busy
+  chunksize = max(1, min(100, len(jobs) // (4 * workers)))
+
+  try:
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+
+      for user_id, image, error in executor.map(render, jobs, chunksize=chunksize):
+        row = rows.pop(user_id)
+
+        if error is not None:
+          result.errors.append((row.username, error))
+          continue
+
+        batch.append(row)
+        images[user_id] = image
+
+        if len(batch) >= batch_size:
+          flush(batch, images, writer, manifest, result)
+          batch = []
+
+          if stdout is not None:
+            stdout.write('provisioned={} errors={}'.format(
+              result.provisioned, len(result.errors)))
+
+      if batch:
+        flush(batch, images, writer, manifest, result)
+
+    writer.write(MANIFEST, manifest_file.getvalue())
+
+  finally:
+    writer.close()
+    result.seconds = time.perf_counter() - start
+
+  return result
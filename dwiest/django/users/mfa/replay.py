@@ -0,0 +1,38 @@
+from django.core.cache import caches
+from django.db.models import Q
+from enum import Enum
+from ..conf import settings
+from .models import MfaModel
+from .totp import INTERVAL
+
+class Ledger(str, Enum):
+  CACHE = 'cache'
+  DATABASE = 'database'
+
+
+def get_cache_key(user_id, step):
+  return 'dwiest-django-users:mfa:step:{}:{}'.format(user_id, step)
+
+def accept_step(user_mfa, step):
+  '''
+  Record that the token for a time step has been used.  Returns False
+  if it was already used, in which case the token is a replay.  Safe
+  against concurrent submissions of the same token: exactly one of them
+  is accepted.
+  '''
+  if Ledger(settings.USERS_MFA_REPLAY_LEDGER) == Ledger.CACHE:
+    # a token can't verify once it is outside the window, so the key
+    # only has to outlive the window
+    timeout = (2 * settings.USERS_MFA_TOKEN_VALID_WINDOW + 1) * INTERVAL
+    cache = caches[settings.USERS_MFA_REPLAY_CACHE]
+    return cache.add(get_cache_key(user_mfa.user_id, step), True, timeout)
+
+  # compare-and-set: only advances if no later step has been accepted
+  updated = MfaModel.objects.filter(pk=user_mfa.pk).filter(
+    Q(last_step__isnull=True) | Q(last_step__lt=step)
+    ).update(last_step=step)
+
+  if updated:
+    user_mfa.last_step = step
+
+  return updated == 1
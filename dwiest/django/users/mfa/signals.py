@@ -1,7 +1,6 @@
 from django.dispatch import Signal
 from django.dispatch import receiver
-from .email import *
-from ..email import send_email
+from ..notifications import Notification, dispatch
 
 mfa_enabled = Signal()
 mfa_disabled = Signal()
@@ -9,11 +8,9 @@ mfa_disabled = Signal()
 @receiver(mfa_disabled)
 def mfa_disabled_callback(sender, **kwargs):
   recipients = [kwargs['request'].user.email]
-  msg = generate_mfa_disabled_email(recipients)
-  send_email(recipients, msg.as_string())
+  dispatch(Notification.MFA_DISABLED, recipients)
 
 @receiver(mfa_enabled)
 def mfa_enabled_callback(sender, **kwargs):
   recipients = [kwargs['request'].user.email]
-  msg = generate_mfa_enabled_email(recipients)
-  send_email(recipients, msg.as_string())
+  dispatch(Notification.MFA_ENABLED, recipients)
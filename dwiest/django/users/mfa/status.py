@@ -0,0 +1,69 @@
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from ..conf import settings
+from .models import MfaModel
+from .signals import mfa_disabled, mfa_enabled
+
+def get_cache():
+  return caches[settings.USERS_MFA_STATUS_CACHE]
+
+def get_key(user_id):
+  return 'dwiest-django-users:mfa:status:{}'.format(user_id)
+
+def user_has_mfa(user_id):
+  '''
+  Whether the user has MFA enabled, from the shared cache when possible.
+  '''
+  cache = get_cache()
+  key = get_key(user_id)
+  has_mfa = cache.get(key)
+
+  if has_mfa is None:
+    has_mfa = has_mfa_record(user_id)
+    # add rather than set: if the status changed since it was read,
+    # refresh() has already stored the new one
+    cache.add(key, has_mfa, settings.USERS_MFA_STATUS_CACHE_TIMEOUT)
+
+  return has_mfa
+
+def has_mfa_record(user_id):
+  return MfaModel.objects.filter(user_id=user_id).exists()
+
+def refresh(user_id):
+  '''
+  Store the user's committed status.  Deleting the key instead would let
+  a request that read the old status just before the commit cache it
+  again.
+  '''
+  get_cache().set(
+    get_key(user_id), has_mfa_record(user_id),
+    settings.USERS_MFA_STATUS_CACHE_TIMEOUT)
+
+def invalidate(user_id):
+  # wait for the commit, so the new status is the one read
+  transaction.on_commit(lambda: refresh(user_id))
+
+@receiver(post_save, sender=MfaModel)
+@receiver(post_delete, sender=MfaModel)
+def mfa_model_changed_callback(sender, instance, **kwargs):
+  invalidate(instance.user_id)
+
+@receiver(mfa_enabled)
+@receiver(mfa_disabled)
+def mfa_status_changed_callback(sender, **kwargs):
+  invalidate(kwargs['request'].user.id)
+
+def is_mfa_loaded(user):
+  return type(user).mfamodel.is_cached(user)
+
+def get_user_mfa(user):
+  '''
+  The user's MFA record or None.  Free if the record was loaded with the
+  user, see auth.backends.ModelBackend.
+  '''
+  try:
+    return user.mfamodel
+  except MfaModel.DoesNotExist:
+    return None
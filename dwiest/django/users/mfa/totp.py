@@ -0,0 +1,55 @@
+from functools import lru_cache
+import base64
+import binascii
+import hashlib
+import hmac
+import struct
+import time
+from ..conf import settings
+
+INTERVAL = 30 # seconds per time step, as used by pyotp and authenticator apps
+
+@lru_cache(maxsize=settings.USERS_MFA_SECRET_CACHE_SIZE)
+def decode_secret(secret_key):
+  padding = '=' * (-len(secret_key) % 8)
+  return base64.b32decode(secret_key + padding, casefold=True)
+
+def get_time_step(for_time=None):
+  if for_time is None:
+    for_time = time.time()
+  return int(for_time) // INTERVAL
+
+def hotp(key, counter, digits):
+  '''
+  RFC 4226 HOTP value for a decoded key.
+  '''
+  mac = hmac.new(key, struct.pack('>Q', counter), hashlib.sha1).digest()
+  offset = mac[-1] & 0x0f
+  code = struct.unpack('>I', mac[offset:offset + 4])[0] & 0x7fffffff
+  return str(code % 10 ** digits).zfill(digits).encode('ascii')
+
+def verify(secret_key, token, window=None, for_time=None):
+  '''
+  Check a TOTP token against the current time step and window steps on
+  either side.  Returns the matching time step, or None.  Every step in
+  the window is compared, in constant time, so the time taken doesn't
+  depend on which step matched.
+  '''
+  if window is None:
+    window = settings.USERS_MFA_TOKEN_VALID_WINDOW
+
+  try:
+    key = decode_secret(secret_key)
+  except (binascii.Error, TypeError):
+    return None
+
+  token = str(token).encode('utf-8')
+  digits = settings.USERS_MFA_TOKEN_LENGTH
+  current = get_time_step(for_time)
+  matched = None
+
+  for step in range(current - window, current + window + 1):
+    if hmac.compare_digest(hotp(key, step, digits), token) and matched is None:
+      matched = step
+
+  return matched
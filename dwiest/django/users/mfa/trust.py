@@ -0,0 +1,54 @@
+from django.core import signing
+from django.utils.crypto import constant_time_compare, salted_hmac
+from ..conf import settings
+
+SALT = 'dwiest.django.users.mfa.trust'
+
+def get_max_age():
+  return settings.USERS_MFA_TRUST_DEVICE_DAYS * 24 * 60 * 60
+
+def get_fingerprint(user, user_mfa):
+  '''
+  Changes when the password changes or MFA is re-enrolled, which
+  revokes every device trusted before.
+  '''
+  value = '{}{}'.format(user.password, user_mfa.secret_key)
+  return salted_hmac(SALT, value, algorithm='sha256').hexdigest()[:32]
+
+def get_value(user, user_mfa):
+  return '{}:{}'.format(user.pk, get_fingerprint(user, user_mfa))
+
+def is_trusted(request, user, user_mfa):
+  '''
+  Whether the request comes from a device the user trusted.  Only checks
+  signatures, the user and their MFA record must already be loaded.
+  '''
+  cookie = request.COOKIES.get(settings.USERS_MFA_TRUST_COOKIE_NAME)
+
+  if cookie is None or user_mfa is None:
+    return False
+
+  try:
+    value = signing.TimestampSigner(salt=SALT).unsign(
+      cookie, max_age=get_max_age())
+  except signing.BadSignature:
+    return False
+
+  return constant_time_compare(value, get_value(user, user_mfa))
+
+def trust_device(request, response, user, user_mfa):
+  value = signing.TimestampSigner(salt=SALT).sign(get_value(user, user_mfa))
+  response.set_cookie(
+    settings.USERS_MFA_TRUST_COOKIE_NAME,
+    value,
+    max_age=get_max_age(),
+    secure=request.is_secure(),
+    httponly=True,
+    samesite='Lax',
+    )
+
+def revoke(response):
+  response.delete_cookie(
+    settings.USERS_MFA_TRUST_COOKIE_NAME,
+    samesite='Lax',
+    )
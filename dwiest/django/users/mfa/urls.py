@@ -27,6 +27,11 @@ urlpatterns = [
     views.MfaEnableView.as_view(),
     name='mfa_enable'
     ),
+  path(
+    'enable/qrcode/<str:ref>/',
+    views.MfaQrCodeView.as_view(),
+    name='mfa_enable_qrcode'
+    ),
   path(
     'enable/success/',
     views.MfaEnableSuccessView.as_view(),
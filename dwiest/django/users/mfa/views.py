@@ -1,28 +1,53 @@
+from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.signals import user_logged_in
-from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponseRedirect
+from django.core import signing
+from django.db import IntegrityError, transaction
+from django.http import Http404, HttpResponse, HttpResponseNotModified, HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import reverse
-from django.views.generic import FormView, TemplateView
+from django.utils.crypto import constant_time_compare
+from django.views.generic import FormView, TemplateView, View
 from django.views.generic.base import TemplateResponseMixin
 from enum import Enum
-from .forms import MfaEnableForm, MfaDisableForm
+import hashlib
+from .forms import MfaEnableForm, MfaDisableForm, get_qrcode_content_type
 from .models import MfaModel
 from .signals import mfa_disabled, mfa_enabled
+from .status import get_user_mfa, is_mfa_loaded, user_has_mfa
+from .trust import revoke
 from ..conf import settings
 
 def check_user_mfa(sender, user, request, **kwargs):
-  try:
-    mfa_record = MfaModel.objects.get(user_id=request.user.id)
-    if mfa_record:
-       request.session['user_has_mfa'] = True
-  except ObjectDoesNotExist:
-    pass
+  if is_mfa_loaded(user):
+    has_mfa = get_user_mfa(user) is not None
+  else:
+    has_mfa = user_has_mfa(user.id)
+
+  if has_mfa:
+    request.session['user_has_mfa'] = True
 
 user_logged_in.connect(check_user_mfa)
 
 status_page = 'mfa_status'
 
+PENDING_SECRET_KEY = 'mfa_pending_secret_key'
+QRCODE_SALT = 'dwiest.django.users.mfa.qrcode'
+
+def get_secret_key_digest(secret_key):
+  return hashlib.sha256(secret_key.encode('utf-8')).hexdigest()[:32]
+
+def get_qrcode_url(request, form):
+  '''
+  Keep the secret being enrolled in the session and return the URL of
+  its QR code.  The URL holds a signed digest of the secret, never the
+  secret itself.
+  '''
+  secret_key = form.initial[form.Fields.SECRET_KEY]
+  request.session[PENDING_SECRET_KEY] = secret_key
+  ref = signing.TimestampSigner(salt=QRCODE_SALT).sign(
+    get_secret_key_digest(secret_key))
+  return reverse('mfa_enable_qrcode', args=[ref])
+
 
 class MfaStatusView(FormView, TemplateResponseMixin):
   template_name = settings.USERS_MFA_STATUS_TEMPLATE
@@ -31,7 +56,8 @@ class MfaStatusView(FormView, TemplateResponseMixin):
     self.response_dict = {}
 
   def get(self, request, *args, **kwargs):
-    if request.session.get('user_has_mfa'):
+    # the session flag goes stale when MFA is changed from another device
+    if request.user.is_authenticated and user_has_mfa(request.user.id):
       self.response_dict['user_has_mfa'] = True
     return render(request, self.template_name, self.response_dict)
 
@@ -40,6 +66,7 @@ class MfaEnableView(FormView, TemplateResponseMixin):
 
   class ResponseDict(str, Enum):
     FORM = 'form'
+    QRCODE_URL = 'qrcode_url'
 
   form_class = MfaEnableForm
   template_name = settings.USERS_MFA_ENABLE_TEMPLATE
@@ -49,22 +76,17 @@ class MfaEnableView(FormView, TemplateResponseMixin):
     self.response_dict = {}
 
   def get(self, request, *args, **kwargs):
-    try:
-      mfa_record = MfaModel.objects.get(user_id=request.user.id)
+    if user_has_mfa(request.user.id):
       return HttpResponseRedirect(reverse(status_page))
-    except ObjectDoesNotExist:
-      pass
 
     form = self.form_class()
     self.response_dict[self.ResponseDict.FORM] = form
+    self.response_dict[self.ResponseDict.QRCODE_URL] = get_qrcode_url(request, form)
     return render(request, self.template_name, self.response_dict)
 
   def post(self, request, *args, **kwargs):
-    try:
-      mfa_record = MfaModel.objects.get(user_id=request.user.id)
+    if user_has_mfa(request.user.id):
       return HttpResponseRedirect(reverse(status_page))
-    except ObjectDoesNotExist:
-      pass
 
     form = self.form_class(user=request.user, data=request.POST)
     self.response_dict[self.ResponseDict.FORM] = form
@@ -73,17 +95,77 @@ class MfaEnableView(FormView, TemplateResponseMixin):
       # create and store an MFA model object
       secret_key = form.cleaned_data['secret_key']
       user_id = request.user.id
-      mfa_record = MfaModel(secret_key=secret_key, user_id=user_id)
-      mfa_record.save()
+      # the token used to enable MFA can't be used again to log in
+      mfa_record = MfaModel(secret_key=secret_key, user_id=user_id, last_step=form.step)
+      try:
+        with transaction.atomic():
+          mfa_record.save()
+          mfa_enabled.send(sender=request.user.__class__, request=request)
+      except IntegrityError:
+        # enabled by another request since the status was checked
+        return HttpResponseRedirect(reverse(status_page))
       request.session['mfa_enabled'] = True
       request.session['user_has_mfa'] = True
-      mfa_enabled.send(sender=request.user.__class__, request=request)
+      request.session.pop(PENDING_SECRET_KEY, None)
       return HttpResponseRedirect(reverse(self.success_page))
 
     else:
+      self.response_dict[self.ResponseDict.QRCODE_URL] = get_qrcode_url(request, form)
       return render(request, self.template_name, self.response_dict)
 
 
+class MfaQrCodeView(LoginRequiredMixin, View):
+  '''
+  Serves the QR code for the secret being enrolled as an image, so the
+  enable page doesn't have to inline it.
+  '''
+
+  def get(self, request, ref, *args, **kwargs):
+    secret_key = request.session.get(PENDING_SECRET_KEY)
+
+    try:
+      digest = signing.TimestampSigner(salt=QRCODE_SALT).unsign(
+        ref, max_age=settings.USERS_MFA_QRCODE_MAX_AGE)
+    except signing.BadSignature:
+      raise Http404
+
+    if secret_key is None or \
+      not constant_time_compare(digest, get_secret_key_digest(secret_key)):
+      raise Http404
+
+    etag = self.get_etag(digest)
+
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+      response = HttpResponseNotModified()
+    else:
+      uri = MfaEnableForm.get_provisioning_uri(secret_key)
+      response = HttpResponse(
+        MfaEnableForm.get_qrcode_image(uri),
+        content_type=get_qrcode_content_type())
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age={}'.format(
+      settings.USERS_MFA_QRCODE_MAX_AGE)
+    return response
+
+  @staticmethod
+  def get_etag(digest):
+    # the image only depends on the secret and the render settings
+    render_settings = '|'.join(str(getattr(settings, name)) for name in (
+      'USERS_MFA_ISSUER_NAME',
+      'USERS_MFA_QRCODE_VERSION',
+      'USERS_MFA_QRCODE_ERROR_CORRECTION',
+      'USERS_MFA_QRCODE_BOX_SIZE',
+      'USERS_MFA_QRCODE_BORDER',
+      'USERS_MFA_QRCODE_FILL_COLOR',
+      'USERS_MFA_QRCODE_BACKGROUND_COLOR',
+      'USERS_MFA_QRCODE_IMAGE_MODE',
+      'USERS_MFA_QRCODE_IMAGE_FORMAT',
+      ))
+    value = '{}|{}'.format(digest, render_settings).encode('utf-8')
+    return '"{}"'.format(hashlib.sha256(value).hexdigest()[:32])
+
+
 class MfaEnableSuccessView(TemplateView):
   template_name = settings.USERS_MFA_ENABLE_SUCCESS_TEMPLATE
 
@@ -109,9 +191,7 @@ class MfaDisableView(FormView, TemplateResponseMixin):
     return super(FormView, self).__init__(*args, **kwargs)
 
   def get(self, request, *args, **kwargs):
-    try:
-      mfa_record = MfaModel.objects.get(user_id=request.user.id)
-    except ObjectDoesNotExist:
+    if not user_has_mfa(request.user.id):
       return HttpResponseRedirect(reverse(status_page))
 
     form = self.form_class()
@@ -119,20 +199,21 @@ class MfaDisableView(FormView, TemplateResponseMixin):
     return render(request, self.template_name, self.response_dict)
 
   def post(self, request, *args, **kwargs):
-    try:
-      mfa_record = MfaModel.objects.get(user_id=request.user.id)
-    except ObjectDoesNotExist:
+    if not user_has_mfa(request.user.id):
       return HttpResponseRedirect(reverse(status_page))
 
     form = self.form_class(user=request.user, data=request.POST)
     self.response_dict[self.ResponseDict.FORM] = form
 
     if form.is_valid():
-      mfa_record.delete()
+      with transaction.atomic():
+        MfaModel.objects.filter(user_id=request.user.id).delete()
+        mfa_disabled.send(sender=request.user.__class__, request=request)
       request.session['mfa_disabled'] = True
       request.session['user_has_mfa'] = False
-      mfa_disabled.send(sender=request.user.__class__, request=request)
-      return HttpResponseRedirect(reverse(self.success_page))
+      response = HttpResponseRedirect(reverse(self.success_page))
+      revoke(response)
+      return response
     else:
       return render(request, self.template_name, self.response_dict)
 
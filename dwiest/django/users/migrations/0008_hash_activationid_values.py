@@ -0,0 +1,51 @@
+# Generated by Django 3.2.16 on 2026-10-18 10:04
+
+from django.db import migrations, transaction
+import hashlib
+
+BATCH_SIZE = 1000
+
+
+def hash_values(apps, schema_editor):
+    ActivationId = apps.get_model('users', 'ActivationId')
+    db_alias = schema_editor.connection.alias
+    last_pk = 0
+
+    while True:
+        # each batch is committed on its own so large tables aren't
+        # locked for the whole backfill
+        with transaction.atomic(using=db_alias):
+            batch = list(
+                ActivationId.objects.using(db_alias)
+                .filter(pk__gt=last_pk)
+                .order_by('pk')
+                .select_for_update()[:BATCH_SIZE]
+            )
+
+            if not batch:
+                break
+
+            changed = []
+            for activation_id in batch:
+                # uuids are 36 characters, digests are 64
+                if len(activation_id.value) != 64:
+                    activation_id.value = hashlib.sha256(
+                        activation_id.value.encode('utf-8')).hexdigest()
+                    changed.append(activation_id)
+
+            ActivationId.objects.using(db_alias).bulk_update(changed, ['value'])
+            last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('users', '0007_alter_activationid_value'),
+    ]
+
+    operations = [
+        # the original values can't be recovered
+        migrations.RunPython(hash_values, migrations.RunPython.noop),
+    ]
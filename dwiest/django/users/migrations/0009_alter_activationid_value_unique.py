@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_hash_activationid_values'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activationid',
+            name='value',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+    ]
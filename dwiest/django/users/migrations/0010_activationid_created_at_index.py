@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 11:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_alter_activationid_value_unique'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activationid',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
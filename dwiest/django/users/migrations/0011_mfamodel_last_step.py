@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 14:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_activationid_created_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mfamodel',
+            name='last_step',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
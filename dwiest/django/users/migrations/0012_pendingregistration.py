@@ -0,0 +1,46 @@
+# Generated by Django 3.2.16 on 2026-10-18 16:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def mark_pending_registrations(apps, schema_editor):
+    # an inactive user who never logged in and has an activation id went
+    # through registration; anyone else is left alone
+    ActivationId = apps.get_model('users', 'ActivationId')
+    PendingRegistration = apps.get_model('users', 'PendingRegistration')
+    db_alias = schema_editor.connection.alias
+
+    activation_ids = ActivationId.objects.using(db_alias).filter(
+        user__is_active=False, user__last_login__isnull=True)
+
+    PendingRegistration.objects.using(db_alias).bulk_create(
+        [
+            PendingRegistration(user_id=user_id, issued_at=created_at)
+            for user_id, created_at
+            in activation_ids.values_list('user_id', 'created_at').iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('users', '0011_mfamodel_last_step'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingRegistration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('issued_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(mark_pending_registrations, migrations.RunPython.noop),
+    ]
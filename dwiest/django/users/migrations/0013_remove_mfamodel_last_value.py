@@ -0,0 +1,17 @@
+# Generated by Django 3.2.16 on 2026-10-18 16:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0012_pendingregistration'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='mfamodel',
+            name='last_value',
+        ),
+    ]
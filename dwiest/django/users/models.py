@@ -1,7 +1,177 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
+from django.utils import timezone
+import datetime
+import sqlite3
+from .tokens import TokenResolution, TokenStatus, generate_token, hash_token
+
+class ActivationIdManager(models.Manager):
+
+  def issue(self, user):
+    '''
+    Create or replace the user's activation id with a new token.  The
+    token itself is only available from the returned object's token
+    attribute; the database holds its digest.
+    '''
+    token = generate_token()
+    value = hash_token(token)
+    now = timezone.now()
+    connection = connections[self.db]
+
+    if self.supports_upsert(connection):
+      activation_id = self.upsert(connection, user.id, value, now)
+    else:
+      activation_id = self.locked_update_or_create(user.id, value, now)
+
+    activation_id.token = token
+    return activation_id
+
+  @staticmethod
+  def supports_upsert(connection):
+    if connection.vendor == 'postgresql':
+      return True
+    # RETURNING was added in SQLite 3.35
+    return connection.vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 35)
+
+  def upsert(self, connection, user_id, value, created_at):
+    '''
+    Insert or replace the user's record in a single statement, so
+    concurrent requests for the same user can't collide on user_id.
+    '''
+    meta = self.model._meta
+    quote = connection.ops.quote_name
+    columns = {
+      name: quote(meta.get_field(name).column)
+      for name in ('id', 'user', 'value', 'created_at')
+      }
+
+    sql = (
+      'INSERT INTO {table} ({user}, {value}, {created_at}) VALUES (%s, %s, %s) '
+      'ON CONFLICT ({user}) DO UPDATE SET '
+      '{value} = EXCLUDED.{value}, {created_at} = EXCLUDED.{created_at} '
+      'RETURNING {id}, {created_at}'
+      ).format(table=quote(meta.db_table), **columns)
+
+    created_at_field = meta.get_field('created_at')
+    params = (
+      user_id,
+      value,
+      created_at_field.get_db_prep_value(created_at, connection),
+      )
+
+    with connection.cursor() as cursor:
+      cursor.execute(sql, params)
+      pk, created_at = cursor.fetchone()
+
+    # convert the stored value the way a queryset would
+    column = created_at_field.get_col(meta.db_table)
+    converters = connection.ops.get_db_converters(column) + \
+      column.get_db_converters(connection)
+    for converter in converters:
+      created_at = converter(created_at, column, connection)
+
+    # a saved instance, as if it had been loaded by a queryset
+    return self.model.from_db(
+      self.db,
+      ['id', 'user_id', 'value', 'created_at'],
+      [pk, user_id, value, created_at],
+      )
+
+  def locked_update_or_create(self, user_id, value, created_at):
+    with transaction.atomic(using=self.db):
+      activation_id = self.select_for_update().filter(user_id=user_id).first()
+
+      if activation_id is None:
+        try:
+          with transaction.atomic(using=self.db):
+            return self.create(user_id=user_id, value=value)
+        except IntegrityError:
+          # created by a concurrent request since the select
+          activation_id = self.select_for_update().get(user_id=user_id)
+
+      activation_id.value = value
+      activation_id.created_at = created_at
+      activation_id.save(update_fields=['value', 'created_at'])
+      return activation_id
+
+  def get_by_token(self, token):
+    return self.get(value=hash_token(token))
+
+  def resolve(self, token, expiration_days=None, require_active_user=False):
+    '''
+    Look up a token together with its user in one query.  The database
+    decides whether it is older than expiration_days; None doesn't
+    check.
+    '''
+    queryset = self.select_related('user').filter(value=hash_token(token))
+
+    if expiration_days is not None:
+      cutoff = timezone.now() - datetime.timedelta(days=expiration_days)
+      queryset = queryset.annotate(is_expired=models.ExpressionWrapper(
+        models.Q(created_at__lt=cutoff), output_field=models.BooleanField()))
+
+    activation_id = queryset.first()
+
+    if activation_id is None:
+      return TokenResolution(TokenStatus.UNKNOWN)
+
+    if require_active_user and not activation_id.user.is_active:
+      return TokenResolution(TokenStatus.USER_INACTIVE, activation_id)
+
+    if getattr(activation_id, 'is_expired', False):
+      return TokenResolution(TokenStatus.EXPIRED, activation_id)
+
+    return TokenResolution(TokenStatus.VALID, activation_id)
+
 
 class ActivationId(models.Model):
   user = models.OneToOneField(User, on_delete=models.CASCADE)
-  value = models.CharField(max_length=36)
+  value = models.CharField(max_length=64, unique=True)
+  created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+  objects = ActivationIdManager()
+
+  token = None # only set when the id is issued
+
+
+class PendingRegistration(models.Model):
+  '''
+  Marks a user created by RegistrationForm who hasn't activated the
+  account yet.  Only these users are purged, never accounts created by
+  an admin or another app.  issued_at is when the latest registration
+  link was sent.
+  '''
+  user = models.OneToOneField(User, on_delete=models.CASCADE)
+  issued_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+
+class OutboxMessage(models.Model):
+
+  class Status(models.TextChoices):
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+  notification = models.CharField(max_length=32)
+  recipients = models.JSONField()
+  context = models.JSONField(default=dict, blank=True)
+  status = models.CharField(
+    max_length=16,
+    choices=Status.choices,
+    default=Status.PENDING,
+    )
+  attempts = models.PositiveIntegerField(default=0)
+  last_error = models.TextField(blank=True, default='')
   created_at = models.DateTimeField(auto_now_add=True)
+  available_at = models.DateTimeField(default=timezone.now)
+  leased_until = models.DateTimeField(null=True, blank=True)
+  lease_owner = models.CharField(max_length=64, null=True, blank=True)
+  sent_at = models.DateTimeField(null=True, blank=True)
+
+  class Meta:
+    indexes = [
+      models.Index(
+        fields=['status', 'available_at'],
+        name='users_outbox_status_idx',
+        ),
+    ]
@@ -0,0 +1,114 @@
+from django.db import transaction
+from enum import Enum
+import logging
+from .coalesce import coalesce, coalesce_outbox, is_coalesced
+from .conf import settings
+from .email import (
+  generate_account_activation_email,
+  generate_password_changed_email,
+  generate_password_reset_email,
+  generate_registration_email,
+  send_email,
+  serialize,
+  )
+from .metrics import notification as metrics_notification
+from .mfa.email import generate_mfa_disabled_email, generate_mfa_enabled_email
+
+logger = logging.getLogger(__name__)
+
+class Notification(str, Enum):
+  ACCOUNT_ACTIVATION = 'account_activation'
+  MFA_DISABLED = 'mfa_disabled'
+  MFA_ENABLED = 'mfa_enabled'
+  PASSWORD_CHANGED = 'password_changed'
+  PASSWORD_RESET = 'password_reset'
+  REGISTRATION = 'registration'
+
+
+class Delivery(str, Enum):
+  CELERY = 'celery'
+  OUTBOX = 'outbox'
+  SMTP = 'smtp'
+  THREAD = 'thread'
+
+
+generators = {
+  Notification.ACCOUNT_ACTIVATION: generate_account_activation_email,
+  Notification.MFA_DISABLED: generate_mfa_disabled_email,
+  Notification.MFA_ENABLED: generate_mfa_enabled_email,
+  Notification.PASSWORD_CHANGED: generate_password_changed_email,
+  Notification.PASSWORD_RESET: generate_password_reset_email,
+  Notification.REGISTRATION: generate_registration_email,
+}
+
+def generate(notification, recipients, **kwargs):
+  return generators[Notification(notification)](recipients, **kwargs)
+
+def deliver(notification, recipients, **kwargs):
+  '''
+  Render and send a notification on the calling thread.
+  '''
+  with metrics_notification(Notification(notification)):
+    msg = generate(notification, recipients, **kwargs)
+    send_email(recipients, serialize(msg))
+
+def deliver_after_commit(notification, recipients, **kwargs):
+  '''
+  deliver() for transaction.on_commit().  The change the notification is
+  about is already committed, so a relay error is logged rather than
+  turned into an error page.
+  '''
+  try:
+    deliver(notification, recipients, **kwargs)
+  except Exception:
+    logger.exception('failed to send %s notification', notification.value)
+
+def dispatch(notification, recipients, **kwargs):
+  '''
+  Hand a notification to the configured USERS_EMAIL_DELIVERY backend.
+  kwargs are passed to the email generator and must be JSON serializable.
+  '''
+  notification = Notification(notification)
+
+  if is_coalesced(notification) and \
+    Delivery(settings.USERS_EMAIL_DELIVERY) == Delivery.OUTBOX:
+    from .outbox import enqueue
+    # written with the change, like any outbox message; coalescing only
+    # holds it back once the change is committed
+    message = enqueue(notification, recipients, **kwargs)
+    transaction.on_commit(
+      lambda: coalesce_outbox(notification, recipients, kwargs, message.id))
+
+  elif is_coalesced(notification):
+    # claim the coalescing window only if the change is committed
+    transaction.on_commit(
+      lambda: coalesce(notification, recipients, kwargs, dispatch_now))
+
+  else:
+    dispatch_now(notification, recipients, **kwargs)
+
+def dispatch_now(notification, recipients, **kwargs):
+  delivery = Delivery(settings.USERS_EMAIL_DELIVERY)
+
+  if delivery == Delivery.OUTBOX:
+    from .outbox import enqueue
+    enqueue(notification, recipients, **kwargs)
+
+  elif delivery == Delivery.CELERY:
+    from .celery.tasks import dispatch_task
+    # don't let a worker pick the task up before the change it refers to
+    # has been committed
+    transaction.on_commit(
+      lambda: dispatch_task(notification, recipients, **kwargs))
+
+  elif delivery == Delivery.THREAD:
+    from .executor import get_executor
+    # nothing is sent if the surrounding transaction is rolled back
+    transaction.on_commit(
+      lambda: get_executor().submit(deliver, notification, recipients, **kwargs))
+
+  else:
+    # don't hold the transaction, and its row locks, open while talking
+    # to the relay, and don't let a relay error roll the change back
+    transaction.on_commit(
+      lambda: deliver_after_commit(notification, recipients, **kwargs))
@@ -0,0 +1,179 @@
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+import datetime
+import os
+import smtplib
+import socket
+import uuid
+from . import metrics
+from .conf import settings
+from .email import get_default_connection_pool, serialize
+from .models import OutboxMessage
+from .smtp import is_disconnected
+
+def enqueue(notification, recipients, **kwargs):
+  return OutboxMessage.objects.create(
+    notification=notification,
+    recipients=list(recipients),
+    context=kwargs,
+    )
+
+def get_lease_owner():
+  return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])[-64:]
+
+def claim_batch(owner, batch_size=None, lease_seconds=None):
+  '''
+  Lease up to batch_size pending messages to owner.  Rows are locked with
+  SKIP LOCKED where the backend supports it, and the lease is taken with
+  a conditional UPDATE so concurrent workers never claim the same row.
+  '''
+  batch_size = batch_size or settings.USERS_EMAIL_OUTBOX_BATCH_SIZE
+  lease_seconds = lease_seconds or settings.USERS_EMAIL_OUTBOX_LEASE_SECONDS
+  now = timezone.now()
+  claimable = Q(leased_until__isnull=True) | Q(leased_until__lt=now)
+
+  with transaction.atomic():
+    ids = list(
+      OutboxMessage.objects
+        .select_for_update(
+          skip_locked=connection.features.has_select_for_update_skip_locked)
+        .filter(claimable, status=OutboxMessage.Status.PENDING, available_at__lte=now)
+        .order_by('available_at')
+        .values_list('id', flat=True)[:batch_size]
+      )
+
+    OutboxMessage.objects.filter(claimable, id__in=ids).update(
+      lease_owner=owner,
+      leased_until=now + datetime.timedelta(seconds=lease_seconds),
+      )
+
+  return list(
+    OutboxMessage.objects
+      .filter(id__in=ids, lease_owner=owner)
+      .order_by('available_at')
+    )
+
+def mark_sent(message):
+  # the context holds the activation token, it isn't needed any more
+  OutboxMessage.objects.filter(id=message.id, lease_owner=message.lease_owner).update(
+    status=OutboxMessage.Status.SENT,
+    context={},
+    sent_at=timezone.now(),
+    attempts=message.attempts + 1,
+    leased_until=None,
+    )
+
+def mark_failed(message, error):
+  '''
+  Release a message for a later attempt, backing off exponentially, or
+  give up on it once USERS_EMAIL_OUTBOX_MAX_ATTEMPTS is reached.
+  '''
+  attempts = message.attempts + 1
+  delay = settings.USERS_EMAIL_OUTBOX_RETRY_BACKOFF * 2 ** (attempts - 1)
+
+  if attempts >= settings.USERS_EMAIL_OUTBOX_MAX_ATTEMPTS:
+    status = OutboxMessage.Status.FAILED
+    context = {}
+  else:
+    status = OutboxMessage.Status.PENDING
+    context = message.context
+
+  OutboxMessage.objects.filter(id=message.id, lease_owner=message.lease_owner).update(
+    status=status,
+    context=context,
+    attempts=attempts,
+    last_error=repr(error),
+    available_at=timezone.now() + datetime.timedelta(seconds=delay),
+    leased_until=None,
+    )
+
+def release(messages, delay=0):
+  '''
+  Hand claimed messages that weren't attempted back to the outbox,
+  available again after delay seconds.
+  '''
+  OutboxMessage.objects.filter(
+    id__in=[m.id for m in messages],
+    status=OutboxMessage.Status.PENDING,
+    leased_until__isnull=False,
+    ).update(
+      leased_until=None,
+      available_at=timezone.now() + datetime.timedelta(seconds=delay),
+      )
+
+def send_batch(messages):
+  '''
+  Render and send claimed messages over a single SMTP connection.
+  Returns a (sent, failed) tuple.
+  '''
+  from .notifications import Notification, generate
+
+  sent = failed = 0
+  sender = settings.DEFAULT_FROM_EMAIL
+  pool = get_default_connection_pool()
+
+  try:
+    smtp_connection = pool.acquire()
+  except (smtplib.SMTPException, OSError) as e:
+    metrics.record_smtp_error(e)
+    raise
+
+  discard = False
+
+  try:
+    for message in messages:
+      with metrics.notification(Notification(message.notification)):
+        try:
+          msg = generate(message.notification, message.recipients, **message.context)
+          with metrics.timed('sendmail'):
+            smtp_connection.sendmail(sender, message.recipients, serialize(msg))
+
+        except Exception as e:
+          if isinstance(e, OSError):
+            metrics.record_smtp_error(e)
+          mark_failed(message, e)
+
+          if is_disconnected(e):
+            discard = True
+            raise
+
+          failed += 1
+
+        else:
+          metrics.record_sent()
+          mark_sent(message)
+          sent += 1
+
+  finally:
+    pool.release(smtp_connection, discard=discard)
+
+  return sent, failed
+
+def drain(owner=None, batch_size=None, max_batches=None):
+  '''
+  Claim and send batches until the outbox is empty.  Returns a
+  (sent, failed) tuple.
+  '''
+  owner = owner or get_lease_owner()
+  sent = failed = batches = 0
+
+  while max_batches is None or batches < max_batches:
+    messages = claim_batch(owner, batch_size)
+    if not messages:
+      break
+
+    batches += 1
+
+    try:
+      batch_sent, batch_failed = send_batch(messages)
+    except (smtplib.SMTPException, OSError):
+      # the relay is unreachable or refused the login, hand the rest of
+      # the batch back and leave it alone for a while
+      release(messages, delay=settings.USERS_EMAIL_OUTBOX_RETRY_BACKOFF)
+      break
+
+    sent += batch_sent
+    failed += batch_failed
+
+  return sent, failed
@@ -0,0 +1,126 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+import datetime
+import time
+from .conf import settings
+from .models import ActivationId, OutboxMessage
+from .tokens import is_signed_mode
+
+class PurgeResult:
+
+  def __init__(self):
+    self.users = 0
+    self.activation_ids = 0
+    self.outbox_messages = 0
+    self.batches = 0
+    self.seconds = 0.0
+
+  @property
+  def rows_per_second(self):
+    if not self.seconds:
+      return 0.0
+    return (self.users + self.activation_ids + self.outbox_messages) / self.seconds
+
+  def __repr__(self):
+    return '<PurgeResult users={} activation_ids={} outbox_messages={} batches={} seconds={:.2f}>'.format(
+      self.users, self.activation_ids, self.outbox_messages, self.batches, self.seconds)
+
+
+def get_registration_cutoff(now=None):
+  now = now or timezone.now()
+  return now - datetime.timedelta(days=settings.USERS_REGISTRATION_EXPIRATION_DAYS)
+
+def get_activation_id_cutoff(now=None):
+  now = now or timezone.now()
+  days = max(
+    settings.USERS_REGISTRATION_EXPIRATION_DAYS,
+    settings.USERS_PASSWORD_RESET_EXPIRATION_DAYS,
+    )
+  return now - datetime.timedelta(days=days)
+
+def get_abandoned_users(now=None):
+  '''
+  Users created by registering who never activated their account or
+  logged in, and whose latest registration link has expired.  Users
+  without a PendingRegistration record, such as those created by an
+  admin or another app, are never included.
+  '''
+  if is_signed_mode() and not settings.USERS_PURGE_SIGNED_MODE_USERS:
+    return User.objects.none()
+
+  return User.objects.filter(
+    is_active=False,
+    last_login__isnull=True,
+    pendingregistration__issued_at__lt=get_registration_cutoff(now),
+    )
+
+def get_expired_activation_ids(now=None):
+  return ActivationId.objects.filter(created_at__lt=get_activation_id_cutoff(now))
+
+def get_finished_outbox_messages(now=None):
+  '''
+  Outbox messages that were sent or given up on more than
+  EMAIL_OUTBOX_RETENTION_DAYS ago.
+  '''
+  now = now or timezone.now()
+  cutoff = now - datetime.timedelta(days=settings.USERS_EMAIL_OUTBOX_RETENTION_DAYS)
+  return OutboxMessage.objects.filter(
+    status__in=[OutboxMessage.Status.SENT, OutboxMessage.Status.FAILED],
+    available_at__lt=cutoff,
+    )
+
+def delete_in_batches(queryset, batch_size, sleep, result):
+  '''
+  Delete the rows matched by queryset batch_size at a time, each batch
+  in its own short transaction.  Returns the number of rows deleted,
+  not counting cascades.
+  '''
+  deleted = 0
+
+  while True:
+    with transaction.atomic():
+      pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+      if not pks:
+        break
+      queryset.model.objects.filter(pk__in=pks).delete()
+
+    deleted += len(pks)
+    result.batches += 1
+
+    if len(pks) < batch_size:
+      break
+    if sleep:
+      time.sleep(sleep)
+
+  return deleted
+
+def purge(batch_size=None, sleep=None, dry_run=False, now=None):
+  '''
+  Delete abandoned registrations, any remaining expired activation ids
+  and old outbox messages.  With dry_run the rows are only counted.
+  '''
+  batch_size = batch_size or settings.USERS_PURGE_BATCH_SIZE
+  sleep = settings.USERS_PURGE_SLEEP if sleep is None else sleep
+  now = now or timezone.now()
+  result = PurgeResult()
+  start = time.monotonic()
+
+  if dry_run:
+    result.users = get_abandoned_users(now).count()
+    # the users' activation ids would go with them
+    result.activation_ids = get_expired_activation_ids(now).exclude(
+      user__in=get_abandoned_users(now)).count()
+    result.outbox_messages = get_finished_outbox_messages(now).count()
+
+  else:
+    # deleting a user cascades to its activation id and mfa record
+    result.users = delete_in_batches(
+      get_abandoned_users(now), batch_size, sleep, result)
+    result.activation_ids = delete_in_batches(
+      get_expired_activation_ids(now), batch_size, sleep, result)
+    result.outbox_messages = delete_in_batches(
+      get_finished_outbox_messages(now), batch_size, sleep, result)
+
+  result.seconds = time.monotonic() - start
+  return result
@@ -0,0 +1,97 @@
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.loader import get_template
+from .conf import settings
+from .htmlmail import build
+from .metrics import timed
+
+TEMPLATE_SETTINGS = (
+  'USERS_ACCOUNT_ACTIVATION_EMAIL_HTML',
+  'USERS_ACCOUNT_ACTIVATION_EMAIL_TEXT',
+  'USERS_MFA_DISABLED_EMAIL_HTML',
+  'USERS_MFA_DISABLED_EMAIL_TEXT',
+  'USERS_MFA_ENABLED_EMAIL_HTML',
+  'USERS_MFA_ENABLED_EMAIL_TEXT',
+  'USERS_PASSWORD_CHANGE_EMAIL_HTML',
+  'USERS_PASSWORD_CHANGE_EMAIL_TEXT',
+  'USERS_PASSWORD_RESET_EMAIL_HTML',
+  'USERS_PASSWORD_RESET_EMAIL_TEXT',
+  'USERS_REGISTRATION_EMAIL_HTML',
+  'USERS_REGISTRATION_EMAIL_TEXT',
+  )
+
+BUILD_SETTINGS = (
+  'USERS_EMAIL_HTML_INLINE_CSS',
+  'USERS_EMAIL_HTML_MINIFY',
+  )
+
+
+class EmailRenderer:
+  '''
+  Holds the compiled email templates, and the serialized bodies of
+  emails that don't depend on the recipient, for the life of the
+  process.  HTML templates have their CSS inlined and are minified
+  before they are compiled.
+  '''
+
+  def __init__(self):
+    self.templates = {}
+    self.prerendered = {}
+
+  def load(self):
+    for setting in TEMPLATE_SETTINGS:
+      name = getattr(settings, setting)
+      if name:
+        self.get_template(name)
+
+    return self.templates
+
+  def get_template(self, name):
+    with timed('template'):
+      try:
+        return self.templates[name]
+      except KeyError:
+        template = self.templates[name] = self.build(get_template(name), name)
+        return template
+
+  @staticmethod
+  def build(template, name):
+    inline = settings.USERS_EMAIL_HTML_INLINE_CSS
+    minify = settings.USERS_EMAIL_HTML_MINIFY
+
+    if not name.endswith(('.html', '.htm')) or not (inline or minify):
+      return template
+
+    # only the Django template backend exposes its source and engine
+    compiled = getattr(template, 'template', None)
+    if not hasattr(compiled, 'source') or not hasattr(compiled, 'engine'):
+      return template
+
+    source = build(compiled.source, inline=inline, minify=minify)
+    if source == compiled.source:
+      return template
+
+    rebuilt = compiled.engine.from_string(source)
+    rebuilt.name = compiled.name
+    rebuilt.origin = compiled.origin
+    return type(template)(rebuilt, template.backend)
+
+  def get_prerendered(self, key, render):
+    try:
+      return self.prerendered[key]
+    except KeyError:
+      body = self.prerendered[key] = render()
+      return body
+
+  def clear(self):
+    self.templates = {}
+    self.prerendered = {}
+
+
+renderer = EmailRenderer()
+
+@receiver(setting_changed)
+def setting_changed_callback(sender, setting, **kwargs):
+  if setting in TEMPLATE_SETTINGS or setting in BUILD_SETTINGS or \
+    setting == 'TEMPLATES':
+    renderer.clear()
@@ -1,6 +1,7 @@
 from django.dispatch import receiver
 from django.dispatch import Signal
 from .email import *
+from .notifications import Notification, dispatch
 
 user_registration = Signal()
 user_registration_confirmed = Signal()
@@ -16,16 +17,15 @@ def user_registration_callback(sender, **kwargs):
     domain = 'https://' + request.META['HTTP_HOST']
     recipients = [kwargs['email']]
     activation_id = kwargs['activation_id']
-    msg = generate_registration_email(recipients, domain, activation_id.value)
-    send_email(recipients, msg.as_string())
+    dispatch(Notification.REGISTRATION, recipients,
+      domain=domain, activation_id=activation_id.token)
 
 @receiver(user_registration_confirmed)
 def user_registration_confirmed_callback(sender, **kwargs):
   print("user_registration_confirmed_callback")
   if settings.EMAIL_SEND == True:
     recipients = [kwargs['email']]
-    msg = generate_account_activation_email(recipients)
-    send_email(recipients, msg.as_string())
+    dispatch(Notification.ACCOUNT_ACTIVATION, recipients)
 
 @receiver(resend_registration_email)
 def resend_registration_email_callback(sender, **kwargs):
@@ -35,8 +35,8 @@ def resend_registration_email_callback(sender, **kwargs):
     domain = 'https://' + request.META['HTTP_HOST']
     recipients = [kwargs['email']]
     activation_id = kwargs['activation_id']
-    msg = generate_registration_email(recipients, domain, activation_id.value)
-    send_email(recipients, msg.as_string())
+    dispatch(Notification.REGISTRATION, recipients,
+      domain=domain, activation_id=activation_id.token)
 
 @receiver(password_reset_request)
 def password_reset_callback(sender, **kwargs):
@@ -46,13 +46,12 @@ def password_reset_callback(sender, **kwargs):
     domain = 'https://' + request.META['HTTP_HOST']
     recipients = [kwargs['email']]
     activation_id = kwargs['activation_id']
-    msg = generate_password_reset_email(recipients, domain, activation_id.value)
-    send_email(recipients, msg.as_string())
+    dispatch(Notification.PASSWORD_RESET, recipients,
+      domain=domain, activation_id=activation_id.token)
 
 @receiver(password_changed)
 def password_changed_callback(sender, **kwargs):
   print("password_changed_callback")
   if settings.EMAIL_SEND == True:
     recipients = [kwargs['email']]
-    msg = generate_password_changed_email(recipients)
-    send_email(recipients, msg.as_string())
+    dispatch(Notification.PASSWORD_CHANGED, recipients)
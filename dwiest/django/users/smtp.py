@@ -0,0 +1,386 @@
+from contextlib import contextmanager
+from collections import deque
+import atexit
+import logging
+import smtplib
+import socket
+import threading
+import time
+from .conf import settings
+from .metrics import timed
+from .spool import Spool
+
+logger = logging.getLogger(__name__)
+
+# SMTPException is a subclass of OSError, so these are functions rather
+# than exception tuples: a refused recipient must not look like a dropped
+# connection
+
+def is_disconnected(error):
+  '''
+  Whether the connection is unusable after error and must not be pooled.
+  '''
+  if isinstance(error, smtplib.SMTPServerDisconnected):
+    return True
+  return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+def is_relay_error(error):
+  '''
+  Whether error means the relay itself is unavailable, rather than that
+  it refused a message.
+  '''
+  return is_disconnected(error) or \
+    isinstance(error, (smtplib.SMTPConnectError, smtplib.SMTPHeloError))
+
+
+class CircuitOpenError(smtplib.SMTPException):
+  pass
+
+
+class PoolTimeoutError(smtplib.SMTPException):
+  pass
+
+
+class CircuitBreaker:
+  '''
+  Stops calls to a relay after threshold consecutive failures.  Once
+  reset_timeout seconds have passed a single probe is let through; the
+  circuit closes again if it succeeds, and on_close is called.  If the
+  probe's outcome is never recorded another one is let through after
+  a further reset_timeout seconds.
+  '''
+
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half_open'
+
+  def __init__(self, threshold, reset_timeout, on_close=None):
+    self.threshold = threshold
+    self.reset_timeout = reset_timeout
+    self.on_close = on_close
+    self.state = self.CLOSED
+    self.failures = 0
+    self.opened_at = None
+    self._lock = threading.Lock()
+
+  def allow(self):
+    if not self.threshold:
+      return True
+
+    with self._lock:
+      if self.state == self.CLOSED:
+        return True
+
+      now = time.monotonic()
+
+      if now - self.opened_at >= self.reset_timeout:
+        # opened_at now dates the probe
+        self.state = self.HALF_OPEN
+        self.opened_at = now
+        return True
+
+      return False
+
+  def record_success(self):
+    with self._lock:
+      recovered = self.state != self.CLOSED
+      self.state = self.CLOSED
+      self.failures = 0
+
+    if recovered and self.on_close:
+      self.on_close()
+
+  def record_failure(self):
+    with self._lock:
+      self.failures += 1
+
+      if self.threshold and \
+        (self.state == self.HALF_OPEN or self.failures >= self.threshold):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+
+class _ProxyMixin:
+  '''
+  Opens the connection socket through a SOCKS5 proxy, if one is set,
+  instead of patching smtplib globally with socks.wrapmodule().
+  '''
+
+  proxy_server = None
+  proxy_port = None
+
+  def _get_socket(self, host, port, timeout):
+    if not self.proxy_server:
+      return super()._get_socket(host, port, timeout)
+
+    import socks
+    return socks.create_connection(
+      (host, port),
+      timeout=timeout,
+      source_address=self.source_address,
+      proxy_type=socks.SOCKS5,
+      proxy_addr=self.proxy_server,
+      proxy_port=self.proxy_port,
+      )
+
+
+class ProxySMTP(_ProxyMixin, smtplib.SMTP):
+  pass
+
+
+class ProxySMTP_SSL(smtplib.SMTP_SSL, ProxySMTP):
+  pass
+
+
+class SmtpConnectionPool:
+  '''
+  A thread-safe pool of authenticated SMTP connections to a single relay.
+
+  Idle connections are checked with NOOP before reuse once they have
+  been idle for longer than health_check_interval, and are closed once
+  they have been idle for longer than max_idle.  acquire() waits at most
+  acquire_timeout seconds for a free slot.
+  '''
+
+  def __init__(self, host, port, login=None, password=None, use_ssl=False,
+    proxy_server=None, proxy_port=None, max_size=4, max_idle=60,
+    health_check_interval=5, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+    command_timeout=None, acquire_timeout=None, breaker=None):
+
+    self.host = host
+    self.port = port
+    self.login = login
+    self.password = password
+    self.use_ssl = use_ssl
+    self.proxy_server = proxy_server
+    self.proxy_port = proxy_port
+    self.max_size = max_size
+    self.max_idle = max_idle
+    self.health_check_interval = health_check_interval
+    self.timeout = timeout
+    self.command_timeout = command_timeout
+    self.acquire_timeout = acquire_timeout
+    self.breaker = breaker or CircuitBreaker(0, 0)
+
+    self._idle = deque() # (connection, last_used) pairs
+    self._lock = threading.Lock()
+    self._slots = threading.BoundedSemaphore(max_size)
+
+  def connect(self):
+    if self.use_ssl:
+      connection = ProxySMTP_SSL(timeout=self.timeout)
+    else:
+      connection = ProxySMTP(timeout=self.timeout)
+
+    connection.proxy_server = self.proxy_server
+    connection.proxy_port = self.proxy_port
+
+    with timed('connect'):
+      connection.connect(self.host, self.port)
+
+    connection.reused = False
+
+    try:
+      if self.command_timeout is not None:
+        connection.sock.settimeout(self.command_timeout)
+      if self.login:
+        with timed('login'):
+          connection.login(self.login, self.password)
+    except BaseException:
+      self.close_connection(connection)
+      raise
+
+    return connection
+
+  def acquire(self, fresh=False):
+    if not self._slots.acquire(timeout=self.acquire_timeout):
+      raise PoolTimeoutError('no free connection to {} after {}s'.format(
+        self.host, self.acquire_timeout))
+
+    try:
+      self.evict_idle()
+
+      while not fresh:
+        with self._lock:
+          if not self._idle:
+            break
+          # reuse the most recently used connection, older ones age out
+          connection, last_used = self._idle.pop()
+
+        idle = time.monotonic() - last_used
+
+        if idle > self.max_idle:
+          self.close_connection(connection)
+
+        elif idle > self.health_check_interval and \
+          not self.is_healthy(connection):
+          self.close_connection(connection)
+
+        else:
+          connection.reused = True
+          return connection
+
+      return self.connect()
+
+    except BaseException:
+      self._slots.release()
+      raise
+
+  def release(self, connection, discard=False):
+    try:
+      if discard:
+        self.close_connection(connection)
+      else:
+        with self._lock:
+          self._idle.append((connection, time.monotonic()))
+    finally:
+      self._slots.release()
+
+  @contextmanager
+  def connection(self, fresh=False):
+    connection = self.acquire(fresh=fresh)
+
+    try:
+      yield connection
+    except BaseException as e:
+      self.release(connection, discard=is_disconnected(e))
+      raise
+    else:
+      self.release(connection)
+
+  def sendmail(self, sender, recipients, message):
+    '''
+    Send a message on a pooled connection.  Only the SMTP transaction is
+    timed as the sendmail stage, connecting and logging in are timed as
+    their own stages.
+    '''
+    reused = False
+
+    try:
+      with self.connection() as connection:
+        reused = connection.reused
+        with timed('sendmail'):
+          return connection.sendmail(sender, recipients, message)
+
+    except OSError as e:
+      # the relay may have dropped a pooled connection; retry once on a
+      # new one before giving up.  A new connection failing, or failing
+      # to connect, is not retried
+      if not reused or not is_disconnected(e):
+        raise
+
+      with self.connection(fresh=True) as connection:
+        with timed('sendmail'):
+          return connection.sendmail(sender, recipients, message)
+
+  def evict_idle(self):
+    now = time.monotonic()
+
+    with self._lock:
+      expired = [c for c, last_used in self._idle if now - last_used > self.max_idle]
+      self._idle = deque(
+        (c, last_used) for c, last_used in self._idle if now - last_used <= self.max_idle)
+
+    for connection in expired:
+      self.close_connection(connection)
+
+  def close(self):
+    with self._lock:
+      idle, self._idle = self._idle, deque()
+
+    for connection, last_used in idle:
+      self.close_connection(connection)
+
+  @staticmethod
+  def is_healthy(connection):
+    try:
+      return connection.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+      return False
+
+  @staticmethod
+  def close_connection(connection):
+    try:
+      connection.quit()
+    except (smtplib.SMTPException, OSError):
+      connection.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_connection_pool(host, port, login=None, password=None, use_ssl=False,
+  proxy_server=None, proxy_port=None):
+  # the password isn't part of the key, so it isn't kept in it
+  key = (host, port, login, use_ssl, proxy_server, proxy_port)
+
+  with _pools_lock:
+    pool = _pools.get(key)
+
+    if pool is not None:
+      pool.password = password
+
+    else:
+      pool = SmtpConnectionPool(
+        host, port, login, password,
+        use_ssl=use_ssl,
+        proxy_server=proxy_server,
+        proxy_port=proxy_port,
+        max_size=settings.USERS_EMAIL_POOL_SIZE,
+        max_idle=settings.USERS_EMAIL_POOL_MAX_IDLE,
+        health_check_interval=settings.USERS_EMAIL_POOL_HEALTH_CHECK_INTERVAL,
+        timeout=settings.USERS_EMAIL_CONNECT_TIMEOUT,
+        command_timeout=settings.USERS_EMAIL_COMMAND_TIMEOUT,
+        acquire_timeout=settings.USERS_EMAIL_CONNECT_TIMEOUT,
+        )
+      pool.breaker = CircuitBreaker(
+        settings.USERS_EMAIL_CIRCUIT_BREAKER_THRESHOLD,
+        settings.USERS_EMAIL_CIRCUIT_BREAKER_RESET_TIMEOUT,
+        on_close=lambda: replay_spool_in_background(pool),
+        )
+      _pools[key] = pool
+
+  return pool
+
+def get_spool():
+  if settings.USERS_EMAIL_SPOOL_DIR:
+    return Spool(settings.USERS_EMAIL_SPOOL_DIR)
+
+def replay_spool(pool):
+  spool = get_spool()
+  if spool is None:
+    return 0
+
+  try:
+    # a message the relay rejects is set aside, only an unavailable relay
+    # stops the replay
+    return spool.replay(pool.sendmail, should_stop=is_relay_error)
+  except OSError as e:
+    if not is_relay_error(e):
+      raise
+    pool.breaker.record_failure()
+    return 0
+
+def replay_spool_logged(pool):
+  try:
+    replay_spool(pool)
+  except Exception:
+    logger.exception('replaying the email spool failed')
+
+def replay_spool_in_background(pool):
+  threading.Thread(
+    target=replay_spool_logged,
+    args=(pool,),
+    name='dwiest-django-users-spool',
+    daemon=True,
+    ).start()
+
+def close_connection_pools():
+  with _pools_lock:
+    pools = list(_pools.values())
+    _pools.clear()
+
+  for pool in pools:
+    pool.close()
+
+atexit.register(close_connection_pools)
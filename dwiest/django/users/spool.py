@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+class Spool:
+  '''
+  An on-disk queue of messages that could not be handed to the mail
+  relay.  Each message is stored in its own file: a JSON envelope line
+  followed by the raw message.  Files are claimed by renaming them, so
+  several processes can replay the same spool.  Messages that can never
+  be sent are renamed to FAILED_SUFFIX and left for an administrator.
+  '''
+
+  SUFFIX = '.eml'
+  CLAIMED_SUFFIX = '.sending'
+  FAILED_SUFFIX = '.failed'
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def put(self, sender, recipients, message):
+    if isinstance(message, str):
+      message = message.encode('utf-8')
+
+    os.makedirs(self.directory, exist_ok=True)
+    name = '{:020d}-{}'.format(time.time_ns(), uuid.uuid4().hex)
+    tmp_path = os.path.join(self.directory, '.' + name)
+    path = os.path.join(self.directory, name + self.SUFFIX)
+    envelope = json.dumps({'sender': sender, 'recipients': list(recipients)})
+
+    with open(tmp_path, 'wb') as f:
+      f.write(envelope.encode('utf-8') + b'\n')
+      f.write(message)
+
+    # only complete files become visible to replay()
+    os.replace(tmp_path, path)
+    return path
+
+  def __len__(self):
+    return len(self.pending())
+
+  def pending(self):
+    try:
+      names = os.listdir(self.directory)
+    except FileNotFoundError:
+      return []
+
+    return sorted(name for name in names if name.endswith(self.SUFFIX))
+
+  def failed(self):
+    try:
+      names = os.listdir(self.directory)
+    except FileNotFoundError:
+      return []
+
+    return sorted(name for name in names if name.endswith(self.FAILED_SUFFIX))
+
+  def replay(self, sendmail, should_stop=None):
+    '''
+    Pass spooled messages to sendmail(sender, recipients, message) in
+    the order they were spooled, deleting each once it has been sent.
+    An error for which should_stop(error) is true, e.g. the relay being
+    down, puts the message back and is raised; any other error means
+    the message itself was rejected, so it is set aside and replay
+    carries on.  Returns the number of messages sent.
+    '''
+    should_stop = should_stop or (lambda error: True)
+    sent = 0
+
+    for name in self.pending():
+      path = os.path.join(self.directory, name)
+      claimed_path = path[:-len(self.SUFFIX)] + self.CLAIMED_SUFFIX
+
+      try:
+        os.rename(path, claimed_path)
+      except FileNotFoundError:
+        # claimed by another process
+        continue
+
+      try:
+        with open(claimed_path, 'rb') as f:
+          envelope = json.loads(f.readline())
+          message = f.read()
+
+        sendmail(envelope['sender'], envelope['recipients'], message)
+
+      except Exception as e:
+        if should_stop(e):
+          os.rename(claimed_path, path)
+          raise
+
+        failed_path = path[:-len(self.SUFFIX)] + self.FAILED_SUFFIX
+        os.rename(claimed_path, failed_path)
+        logger.error('could not send spooled message %s: %r', failed_path, e)
+        continue
+
+      except BaseException:
+        os.rename(claimed_path, path)
+        raise
+
+      os.remove(claimed_path)
+      sent += 1
+
+    return sent
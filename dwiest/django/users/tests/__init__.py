@@ -0,0 +1,6 @@
+from celery import Celery
+
+# stands in for the project's celery app, which the shared tasks use
+app = Celery('dwiest-django-users-tests')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.set_default()
@@ -0,0 +1,66 @@
+# settings for running the tests with runtests.py
+
+import os
+
+SECRET_KEY = 'dwiest-django-users-tests'
+
+INSTALLED_APPS = [
+  'django.contrib.auth',
+  'django.contrib.contenttypes',
+  'django.contrib.messages',
+  'django.contrib.sessions',
+  'dwiest.django.users',
+]
+
+MIDDLEWARE = [
+  'django.contrib.sessions.middleware.SessionMiddleware',
+  'django.contrib.auth.middleware.AuthenticationMiddleware',
+  'django.contrib.messages.middleware.MessageMiddleware',
+]
+
+TEMPLATES = [
+  {
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'DIRS': [os.path.join(os.path.dirname(__file__), 'templates')],
+    'APP_DIRS': True,
+    'OPTIONS': {
+      'context_processors': [
+        'django.contrib.auth.context_processors.auth',
+        'django.contrib.messages.context_processors.messages',
+      ],
+    },
+  },
+]
+
+DATABASES = {
+  'default': {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': ':memory:',
+    'TEST': {'NAME': 'dwiest-django-users-tests.sqlite3'},
+  },
+}
+
+CACHES = {
+  'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+  },
+}
+
+AUTHENTICATION_BACKENDS = ['dwiest.django.auth.backends.ModelBackend']
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+ROOT_URLCONF = 'dwiest.django.users.urls'
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+USE_TZ = True
+
+EMAIL_HOST = 'localhost'
+EMAIL_PORT = 25
+PROXY_SERVER = None
+PROXY_PORT = None
+EMAIL_SEND = False
+
+CELERY_BROKER_URL = 'memory://'
+CELERY_TASK_ALWAYS_EAGER = True
+CELERY_TASK_EAGER_PROPAGATES = True
+
+USERS_EMAIL_PRELOAD_TEMPLATES = False
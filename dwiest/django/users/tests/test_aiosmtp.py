@@ -0,0 +1,254 @@
+from django.test import SimpleTestCase, override_settings
+from unittest import mock
+import asyncio
+import os
+import shutil
+import smtplib
+import ssl
+import subprocess
+import tempfile
+import unittest
+from .. import aiosmtp
+from ..aiosmtp import AsyncSMTP, send_email_async
+
+# kept for the stub server, the client's fallback test removes it
+stream_writer_start_tls = getattr(asyncio.StreamWriter, 'start_tls', None)
+
+class SmtpStub:
+  '''
+  Just enough of an SMTP server to exercise AsyncSMTP.  Records the
+  command verbs it receives and the messages it accepts.
+  '''
+
+  def __init__(self, pipelining=True, reject_sender=False, reject=(),
+    tls_context=None, greeting=b'220 stub ready'):
+
+    self.greeting = greeting
+    self.pipelining = pipelining
+    self.reject_sender = reject_sender
+    self.reject = set(reject)
+    self.tls_context = tls_context
+    self.commands = []
+    self.messages = []
+
+  async def start(self):
+    self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+    self.port = self.server.sockets[0].getsockname()[1]
+
+  async def stop(self):
+    self.server.close()
+    await self.server.wait_closed()
+
+  async def handle(self, reader, writer):
+    def reply(*lines):
+      for line in lines[:-1]:
+        writer.write(line[:3] + b'-' + line[4:] + b'\r\n')
+      writer.write(lines[-1] + b'\r\n')
+
+    reply(self.greeting)
+
+    while True:
+      line = await reader.readline()
+      if not line:
+        break
+
+      verb, _, argument = line.rstrip(b'\r\n').partition(b' ')
+      verb = verb.upper()
+      self.commands.append(verb.decode('ascii'))
+
+      if verb == b'EHLO':
+        extensions = [b'250 stub']
+        if self.pipelining:
+          extensions.append(b'250 PIPELINING')
+        if self.tls_context:
+          extensions.append(b'250 STARTTLS')
+        reply(*extensions)
+
+      elif verb == b'STARTTLS' and self.tls_context:
+        reply(b'220 go ahead')
+        await writer.drain()
+        await stream_writer_start_tls(writer, self.tls_context)
+
+      elif verb == b'MAIL':
+        reply(b'550 sender rejected' if self.reject_sender else b'250 ok')
+
+      elif verb == b'RCPT':
+        address = argument.partition(b'<')[2].rstrip(b'>').decode('ascii')
+        reply(b'550 no such user' if address in self.reject else b'250 ok')
+
+      elif verb == b'DATA':
+        reply(b'354 go ahead')
+        await writer.drain()
+        data = b''
+        while True:
+          line = await reader.readline()
+          if line == b'.\r\n':
+            break
+          data += line[1:] if line.startswith(b'..') else line
+        self.messages.append(data)
+        reply(b'250 queued')
+
+      elif verb in (b'RSET', b'NOOP'):
+        reply(b'250 ok')
+
+      elif verb == b'QUIT':
+        reply(b'221 bye')
+        await writer.drain()
+        break
+
+      else:
+        reply(b'502 not implemented')
+
+      await writer.drain()
+
+    writer.close()
+
+
+class AsyncSMTPTests(SimpleTestCase):
+
+  async def send(self, stub, recipients, message=b'Subject: hi\r\n\r\nhello\r\n.dot\r\n',
+    **kwargs):
+
+    await stub.start()
+    client = AsyncSMTP('127.0.0.1', stub.port, timeout=5, command_timeout=5, **kwargs)
+
+    try:
+      await client.connect()
+      return await client.sendmail('from@example.com', recipients, message)
+    finally:
+      await client.quit()
+      await stub.stop()
+
+  async def test_pipelined_send(self):
+    stub = SmtpStub()
+    refused = await self.send(stub, ['a@example.com', 'b@example.com'])
+
+    self.assertEqual(refused, {})
+    self.assertEqual(stub.messages, [b'Subject: hi\r\n\r\nhello\r\n.dot\r\n'])
+    self.assertEqual(stub.commands, ['EHLO', 'MAIL', 'RCPT', 'RCPT', 'DATA', 'QUIT'])
+
+  async def test_partially_refused_recipients(self):
+    stub = SmtpStub(pipelining=False, reject=['b@example.com'])
+    refused = await self.send(stub, ['a@example.com', 'b@example.com'])
+
+    self.assertEqual(list(refused), ['b@example.com'])
+    self.assertEqual(len(stub.messages), 1)
+
+  async def test_rejected_sender_stops_without_pipelining(self):
+    stub = SmtpStub(pipelining=False, reject_sender=True)
+
+    with self.assertRaises(smtplib.SMTPSenderRefused):
+      await self.send(stub, ['a@example.com'])
+
+    self.assertEqual(stub.commands, ['EHLO', 'MAIL', 'RSET', 'QUIT'])
+
+  async def test_rejected_sender_with_pipelining(self):
+    stub = SmtpStub(reject_sender=True)
+
+    with self.assertRaises(smtplib.SMTPSenderRefused):
+      await self.send(stub, ['a@example.com'])
+
+    self.assertEqual(stub.messages, [b''])
+
+  async def test_all_recipients_refused_skips_data(self):
+    stub = SmtpStub(pipelining=False, reject=['a@example.com'])
+
+    with self.assertRaises(smtplib.SMTPRecipientsRefused):
+      await self.send(stub, ['a@example.com'])
+
+    self.assertEqual(stub.commands, ['EHLO', 'MAIL', 'RCPT', 'RSET', 'QUIT'])
+
+
+class SendEmailAsyncTests(SimpleTestCase):
+
+  async def send(self, stub):
+    await stub.start()
+
+    try:
+      with mock.patch.object(aiosmtp.metrics, 'record_smtp_error') as record_smtp_error, \
+        mock.patch.object(AsyncSMTP, 'close', autospec=True, side_effect=AsyncSMTP.close) as close:
+        with self.assertRaises(smtplib.SMTPResponseException) as raised:
+          await send_email_async(
+            ['a@example.com'], b'hello\r\n', sender='from@example.com',
+            smtp_server='127.0.0.1', smtp_server_port=stub.port,
+            smtp_server_login=None, proxy_server=None)
+    finally:
+      await stub.stop()
+
+    record_smtp_error.assert_called_once_with(raised.exception)
+    close.assert_called_once()
+    return raised.exception
+
+  async def test_failed_greeting_closes_the_connection(self):
+    error = await self.send(SmtpStub(greeting=b'554 go away'))
+    self.assertEqual(error.smtp_code, 554)
+
+  @override_settings(EMAIL_USE_TLS=True)
+  async def test_refused_starttls_closes_the_connection(self):
+    stub = SmtpStub()
+    error = await self.send(stub)
+
+    self.assertEqual(error.smtp_code, 502)
+    self.assertEqual(stub.commands, ['EHLO', 'STARTTLS'])
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl is needed to make a test certificate')
+@unittest.skipUnless(stream_writer_start_tls, 'the stub server needs Python 3.11')
+class StartTLSTests(SimpleTestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls.directory = tempfile.mkdtemp()
+    cls.certfile = os.path.join(cls.directory, 'cert.pem')
+    cls.keyfile = os.path.join(cls.directory, 'key.pem')
+    subprocess.run(
+      ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+       '-subj', '/CN=127.0.0.1', '-keyout', cls.keyfile, '-out', cls.certfile],
+      check=True, capture_output=True)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.directory)
+    super().tearDownClass()
+
+  def get_contexts(self):
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(self.certfile, self.keyfile)
+    client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.load_verify_locations(self.certfile)
+    client_context.check_hostname = False
+    return server_context, client_context
+
+  async def send_over_starttls(self):
+    server_context, client_context = self.get_contexts()
+    stub = SmtpStub(tls_context=server_context)
+    await stub.start()
+    client = AsyncSMTP('127.0.0.1', stub.port, starttls=True,
+      ssl_context=client_context, timeout=5, command_timeout=5)
+
+    try:
+      await client.connect()
+      self.assertIsNotNone(client.writer.get_extra_info('ssl_object'))
+      await client.sendmail('from@example.com', ['a@example.com'], b'hello\r\n')
+    finally:
+      await client.quit()
+      await stub.stop()
+
+    self.assertEqual(stub.commands, ['EHLO', 'STARTTLS', 'EHLO', 'MAIL', 'RCPT', 'DATA', 'QUIT'])
+    self.assertEqual(stub.messages, [b'hello\r\n'])
+
+  async def test_starttls(self):
+    await self.send_over_starttls()
+
+  async def test_starttls_without_stream_writer_start_tls(self):
+    # the path taken before Python 3.11
+    start_tls = getattr(asyncio.StreamWriter, 'start_tls', None)
+    if start_tls is not None:
+      del asyncio.StreamWriter.start_tls
+
+    try:
+      await self.send_over_starttls()
+    finally:
+      if start_tls is not None:
+        asyncio.StreamWriter.start_tls = start_tls
@@ -0,0 +1,70 @@
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase
+from ...auth.forms import AuthenticationForm
+from ..mfa.models import MfaModel
+from ..mfa.totp import decode_secret, get_time_step, hotp
+
+SECRET_KEY = 'JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP'
+
+class LoginQueryTests(TestCase):
+  '''
+  With auth.backends.ModelBackend the user's MFA record is loaded with
+  the user, so neither the login form nor the user_logged_in handlers
+  query it again.
+  '''
+
+  def setUp(self):
+    cache.clear()
+    self.user = User.objects.create_user('user@example.com', 'user@example.com', 'password')
+    self.request = RequestFactory().post('/login/')
+    # the cache backend doesn't query the database
+    self.request.session = SessionStore()
+
+  def get_form(self, password='password', mfa_token=''):
+    return AuthenticationForm(self.request, data={
+      'username': 'user@example.com',
+      'password': password,
+      'mfa_token': mfa_token,
+      })
+
+  def log_in(self, user):
+    # one query: django.contrib.auth updates last_login
+    with self.assertNumQueries(1):
+      user_logged_in.send(sender=type(user), request=self.request, user=user)
+
+  def test_mfa_login(self):
+    MfaModel.objects.create(user=self.user, secret_key=SECRET_KEY)
+    token = hotp(decode_secret(SECRET_KEY), get_time_step(), 6).decode('ascii')
+    form = self.get_form(mfa_token=token)
+
+    # the user with its MFA record, then the replay ledger
+    with self.assertNumQueries(2):
+      self.assertTrue(form.is_valid(), form.errors)
+
+    self.log_in(form.get_user())
+    self.assertTrue(self.request.session['user_has_mfa'])
+
+  def test_login_without_mfa(self):
+    with self.assertNumQueries(1):
+      user = authenticate(self.request, username='user@example.com', password='password')
+
+    self.assertEqual(user, self.user)
+    self.log_in(user)
+    self.assertNotIn('user_has_mfa', self.request.session)
+
+  def test_form_without_mfa_record(self):
+    form = self.get_form(mfa_token='123456')
+
+    # the missing record is known from the user query
+    with self.assertNumQueries(1):
+      self.assertFalse(form.is_valid())
+
+  def test_wrong_password(self):
+    form = self.get_form(password='wrong')
+
+    with self.assertNumQueries(1):
+      self.assertFalse(form.is_valid())
@@ -0,0 +1,98 @@
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from unittest import mock
+from . import app as project_app
+from ..celery import tasks
+from ..email import MassSendResult
+from ..notifications import Notification
+
+class IdempotencyTests(SimpleTestCase):
+
+  def setUp(self):
+    cache.clear()
+
+  def test_redelivered_task_sends_once(self):
+    with mock.patch.object(tasks, 'deliver') as deliver:
+      first = tasks.send_registration_email.delay(
+        ['user@example.com'], 'https://example.com', 'token')
+      second = tasks.send_registration_email.delay(
+        ['user@example.com'], 'https://example.com', 'token')
+
+    self.assertIs(first.get(), True)
+    self.assertIs(second.get(), False)
+    deliver.assert_called_once_with(
+      Notification.REGISTRATION, ['user@example.com'],
+      activation_id='token', domain='https://example.com')
+
+  def test_other_activation_id_is_sent(self):
+    with mock.patch.object(tasks, 'deliver') as deliver:
+      tasks.send_password_reset_email.delay(['a@example.com'], 'https://example.com', 'one')
+      tasks.send_password_reset_email.delay(['a@example.com'], 'https://example.com', 'two')
+
+    self.assertEqual(deliver.call_count, 2)
+
+  def test_failed_delivery_releases_key(self):
+    with mock.patch.object(tasks, 'deliver', side_effect=ValueError):
+      with self.assertRaises(ValueError):
+        tasks.send_registration_email.delay(['a@example.com'], 'https://example.com', 'token')
+
+    key = tasks.get_idempotency_key(Notification.REGISTRATION, 'token')
+    self.assertIsNone(cache.get(key))
+
+
+class BulkEmailTests(SimpleTestCase):
+
+  def test_recipients_are_chunked(self):
+    chunks = []
+
+    def send_mass(messages):
+      chunks.append([recipients for recipients, message in messages])
+      return MassSendResult()
+
+    recipients_list = [['user{}@example.com'.format(i)] for i in range(5)]
+
+    with mock.patch.object(tasks, 'send_mass', side_effect=send_mass), \
+      mock.patch.object(tasks, 'generate'):
+      result = tasks.send_bulk_email.delay(
+        Notification.PASSWORD_CHANGED.value, recipients_list, chunk_size=2)
+
+    self.assertEqual(result.get(), 3)
+    self.assertEqual(chunks, [
+      recipients_list[0:2],
+      recipients_list[2:4],
+      recipients_list[4:5],
+      ])
+
+  def test_chunk_reports_failures(self):
+    result = MassSendResult()
+    result.failures.append((1, ['b@example.com'], ValueError('bad')))
+
+    with mock.patch.object(tasks, 'send_mass', return_value=result), \
+      mock.patch.object(tasks, 'generate'):
+      failures = tasks.send_email_chunk.delay(
+        Notification.PASSWORD_CHANGED.value,
+        [['a@example.com'], ['b@example.com']],
+        {},
+        ).get()
+
+    self.assertEqual(failures, [(['b@example.com'], "ValueError('bad')")])
+
+
+class SharedTaskTests(SimpleTestCase):
+
+  def test_tasks_are_registered_on_the_project_app(self):
+    self.assertIn(
+      'dwiest.django.users.celery.tasks.send_registration_email', project_app.tasks)
+
+  @override_settings(USERS_CELERY_PURGE_INTERVAL=3600)
+  def test_purge_is_scheduled(self):
+    app = mock.Mock()
+    tasks.add_periodic_tasks(app)
+
+    app.add_periodic_task.assert_called_once_with(
+      3600, mock.ANY, name='purge-expired-registrations')
+
+  def test_purge_is_not_scheduled_by_default(self):
+    app = mock.Mock()
+    tasks.add_periodic_tasks(app)
+    app.add_periodic_task.assert_not_called()
@@ -0,0 +1,97 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, override_settings
+from unittest import mock
+from .. import coalesce
+from ..celery import tasks
+from ..models import OutboxMessage
+from ..notifications import Notification, dispatch
+
+RECIPIENTS = ['user@example.com']
+
+@override_settings(USERS_EMAIL_COALESCE_WINDOW=60)
+class CoalesceTests(TestCase):
+
+  def setUp(self):
+    cache.clear()
+
+  def dispatch(self, activation_id):
+    with self.captureOnCommitCallbacks(execute=True):
+      dispatch(Notification.REGISTRATION, RECIPIENTS,
+        activation_id=activation_id, domain='https://example.com')
+
+  def test_rolled_back_dispatch_does_not_claim_window(self):
+    with mock.patch('dwiest.django.users.notifications.dispatch_now') as send:
+      with self.captureOnCommitCallbacks(execute=True):
+        try:
+          with transaction.atomic():
+            dispatch(Notification.REGISTRATION, RECIPIENTS, activation_id='one')
+            raise ValueError
+        except ValueError:
+          pass
+
+    send.assert_not_called()
+    key = coalesce.get_key(Notification.REGISTRATION, RECIPIENTS, 'window')
+    self.assertIsNone(cache.get(key))
+
+  @override_settings(USERS_EMAIL_DELIVERY='outbox')
+  def test_outbox_holds_latest_until_window_closes(self):
+    self.dispatch('one')
+    self.dispatch('two')
+    self.dispatch('three')
+
+    sent, held = OutboxMessage.objects.order_by('id')
+    self.assertEqual(sent.context['activation_id'], 'one')
+    self.assertEqual(held.context['activation_id'], 'three')
+    self.assertGreater(held.available_at, sent.available_at)
+    self.assertEqual(coalesce.get_suppressed_count(Notification.REGISTRATION), 1)
+
+  @override_settings(USERS_EMAIL_DELIVERY='outbox')
+  def test_outbox_message_is_written_with_the_change(self):
+    # the commit hook never runs, as if the process died after the commit
+    with self.captureOnCommitCallbacks(execute=False):
+      dispatch(Notification.REGISTRATION, RECIPIENTS, activation_id='one')
+
+    message = OutboxMessage.objects.get()
+    self.assertEqual(message.context, {'activation_id': 'one'})
+
+  @override_settings(USERS_EMAIL_DELIVERY='outbox')
+  def test_rolled_back_outbox_message_is_not_written(self):
+    with self.captureOnCommitCallbacks(execute=True):
+      try:
+        with transaction.atomic():
+          dispatch(Notification.REGISTRATION, RECIPIENTS, activation_id='one')
+          raise ValueError
+      except ValueError:
+        pass
+
+    self.assertFalse(OutboxMessage.objects.exists())
+    key = coalesce.get_key(Notification.REGISTRATION, RECIPIENTS, 'window')
+    self.assertIsNone(cache.get(key))
+
+  @override_settings(USERS_EMAIL_DELIVERY='outbox')
+  def test_repeated_link_is_dropped(self):
+    self.dispatch('one')
+    self.dispatch('one')
+
+    self.assertEqual(OutboxMessage.objects.count(), 1)
+    self.assertEqual(coalesce.get_suppressed_count(Notification.REGISTRATION), 1)
+
+  @override_settings(USERS_EMAIL_DELIVERY='celery')
+  def test_celery_flush_is_a_delayed_task(self):
+    with mock.patch('dwiest.django.users.celery.tasks.flush_coalesced') as task, \
+      mock.patch('dwiest.django.users.notifications.dispatch_now') as send:
+      self.dispatch('one')
+      self.dispatch('two')
+      self.dispatch('three')
+
+    self.assertEqual(send.call_count, 1)
+    task.apply_async.assert_called_once()
+    self.assertGreater(task.apply_async.call_args[1]['countdown'], 0)
+
+    with mock.patch('dwiest.django.users.notifications.dispatch_now') as send:
+      tasks.flush_coalesced(Notification.REGISTRATION.value, RECIPIENTS)
+
+    send.assert_called_once_with(
+      Notification.REGISTRATION, RECIPIENTS,
+      activation_id='three', domain='https://example.com')
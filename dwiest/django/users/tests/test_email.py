@@ -0,0 +1,187 @@
+from django.template.backends.django import Template
+from django.test import SimpleTestCase
+from unittest import mock
+import smtplib
+from .. import email
+from ..email import generate_password_changed_email, send_mass
+from ..renderer import renderer
+from ..smtp import CircuitBreaker, CircuitOpenError, PoolTimeoutError
+
+class FakeConnection:
+
+  def __init__(self, sent, error=None):
+    self.sent = sent
+    self.error = error
+    self.reused = False
+
+  def sendmail(self, sender, recipients, message):
+    if self.error is not None:
+      raise self.error
+    if recipients == ['refused@example.com']:
+      raise smtplib.SMTPDataError(554, b'rejected')
+    self.sent.append((sender, recipients, message))
+    return {}
+
+
+class FakePool:
+
+  host = 'localhost'
+
+  def __init__(self, connect_error=None, send_error=None):
+    self.breaker = CircuitBreaker(1, 60)
+    self.connect_error = connect_error
+    self.send_error = send_error
+    self.sent = []
+    self.acquired = 0
+    self.discarded = 0
+
+  def acquire(self):
+    self.acquired += 1
+    if self.connect_error is not None:
+      raise self.connect_error
+    return FakeConnection(self.sent, self.send_error)
+
+  def release(self, connection, discard=False):
+    self.discarded += discard
+
+
+def render_error():
+  raise ValueError('template error')
+
+
+class SendMassTests(SimpleTestCase):
+
+  def test_failures_do_not_abort_the_batch(self):
+    pool = FakePool()
+    messages = [
+      (['a@example.com'], lambda: b'one'),
+      (['b@example.com'], render_error),
+      (['refused@example.com'], b'three'),
+      (['d@example.com'], b'four'),
+      ]
+
+    result = send_mass(iter(messages), sender='from@example.com', pool=pool)
+
+    self.assertEqual(result.sent, 2)
+    self.assertEqual(
+      [(index, recipients, type(e)) for index, recipients, e in result.failures],
+      [
+        (1, ['b@example.com'], ValueError),
+        (2, ['refused@example.com'], smtplib.SMTPDataError),
+      ])
+    self.assertEqual(
+      [recipients for sender, recipients, message in pool.sent],
+      [['a@example.com'], ['d@example.com']])
+
+  def test_raising_generator_is_reported(self):
+    def messages():
+      yield ['a@example.com'], b'one'
+      raise ValueError('generator error')
+
+    result = send_mass(messages(), sender='from@example.com', pool=FakePool())
+
+    self.assertEqual(result.sent, 1)
+    self.assertEqual(len(result.failures), 1)
+    index, recipients, error = result.failures[0]
+    self.assertEqual((index, recipients), (1, None))
+    self.assertIsInstance(error, ValueError)
+
+
+  def test_connection_is_replaced_after_messages_per_connection(self):
+    pool = FakePool()
+    messages = [(['{}@example.com'.format(i)], b'message') for i in range(5)]
+
+    result = send_mass(
+      messages, sender='from@example.com', messages_per_connection=2, pool=pool)
+
+    self.assertEqual(result.sent, 5)
+    self.assertEqual(pool.acquired, 3)
+    # the two full connections are closed, the last one is pooled
+    self.assertEqual(pool.discarded, 2)
+
+  def assert_rest_failed(self, result, pool, error_class, count=4):
+    self.assertEqual(result.sent, 0)
+    self.assertEqual(
+      [(index, type(e)) for index, recipients, e in result.failures],
+      [(index, error_class) for index in range(count)])
+    self.assertEqual(pool.sent, [])
+
+  def get_messages(self, count=4):
+    for i in range(count):
+      # never rendered once the relay is known to be down
+      yield ['{}@example.com'.format(i)], self.fail
+
+  def test_relay_down_stops_the_batch(self):
+    pool = FakePool(connect_error=smtplib.SMTPConnectError(421, b'down'))
+
+    result = send_mass(self.get_messages(), sender='from@example.com', pool=pool)
+
+    self.assertEqual(pool.acquired, 1)
+    self.assert_rest_failed(result, pool, smtplib.SMTPConnectError)
+    self.assertEqual(pool.breaker.state, pool.breaker.OPEN)
+
+  def test_pool_timeout_stops_the_batch(self):
+    pool = FakePool(connect_error=PoolTimeoutError('no free connection'))
+
+    result = send_mass(self.get_messages(), sender='from@example.com', pool=pool)
+
+    self.assertEqual(pool.acquired, 1)
+    self.assert_rest_failed(result, pool, PoolTimeoutError)
+
+  def test_new_connection_dropped_stops_the_batch(self):
+    pool = FakePool(send_error=smtplib.SMTPServerDisconnected())
+    messages = [(['{}@example.com'.format(i)], b'message') for i in range(4)]
+
+    result = send_mass(messages, sender='from@example.com', pool=pool)
+
+    self.assertEqual(pool.acquired, 1)
+    self.assert_rest_failed(result, pool, smtplib.SMTPServerDisconnected)
+
+  def test_open_circuit_sends_nothing(self):
+    pool = FakePool()
+    pool.breaker.record_failure()
+
+    result = send_mass(self.get_messages(), sender='from@example.com', pool=pool)
+
+    self.assertEqual(pool.acquired, 0)
+    self.assert_rest_failed(result, pool, CircuitOpenError)
+
+  def test_refused_message_closes_the_circuit(self):
+    pool = FakePool()
+    pool.breaker.state = pool.breaker.HALF_OPEN
+    pool.breaker.opened_at = 0
+
+    send_mass([(['refused@example.com'], b'message')], sender='from@example.com', pool=pool)
+
+    self.assertEqual(pool.breaker.state, pool.breaker.CLOSED)
+
+
+class PrerenderedEmailTests(SimpleTestCase):
+
+  def setUp(self):
+    renderer.clear()
+
+  def test_body_is_rendered_once_for_all_recipients(self):
+    recipients = ['a@example.com', 'b@example.com', 'c@example.com']
+    render = Template.render
+
+    with mock.patch.object(Template, 'render', autospec=True, side_effect=render) as rendered:
+      messages = [generate_password_changed_email([r]).as_bytes() for r in recipients]
+
+    # the html and the text template, once each
+    self.assertEqual(rendered.call_count, 2)
+
+    headers, body = zip(*(m.split(b'\r\n\r\n', 1) for m in messages))
+    self.assertEqual(len(set(body)), 1)
+    for recipient, header in zip(recipients, headers):
+      self.assertIn('To: {}'.format(recipient).encode('ascii'), header)
+
+  def test_changed_template_setting_renders_again(self):
+    generate_password_changed_email(['a@example.com'])
+
+    with self.settings(USERS_PASSWORD_CHANGE_EMAIL_HTML=None), \
+      mock.patch.object(email, 'generate_email_body', wraps=email.generate_email_body) as body:
+      generate_password_changed_email(['a@example.com'])
+      generate_password_changed_email(['b@example.com'])
+
+    body.assert_called_once()
@@ -0,0 +1,32 @@
+from django.test import SimpleTestCase
+import threading
+import time
+from ..executor import BoundedExecutor
+
+class ShutdownTests(SimpleTestCase):
+
+  def test_timeout_is_honoured_with_a_full_queue(self):
+    release = threading.Event()
+    executor = BoundedExecutor(1, 2, backpressure='drop')
+    self.addCleanup(release.set)
+
+    for i in range(4):
+      executor.submit(release.wait)
+
+    start = time.monotonic()
+    executor.shutdown(timeout=0.2)
+    self.assertLess(time.monotonic() - start, 1)
+
+    release.set()
+    executor._threads[0].join(1)
+    self.assertFalse(executor._threads[0].is_alive())
+
+  def test_queued_work_is_finished(self):
+    done = []
+    executor = BoundedExecutor(2, 10)
+
+    for i in range(5):
+      executor.submit(done.append, i)
+
+    executor.shutdown(timeout=5)
+    self.assertEqual(sorted(done), [0, 1, 2, 3, 4])
@@ -0,0 +1,69 @@
+from django.test import SimpleTestCase, override_settings
+from ..htmlmail import inline_css, minify_html
+from ..renderer import renderer
+
+TEMPLATE = 'dwiest-django-users-tests/styled_email.html'
+
+class InlineCssTests(SimpleTestCase):
+
+  def test_simple_selectors_are_inlined(self):
+    html = inline_css(
+      '<style>p{margin:0} .b{color:white} a.b{background:blue} #f{font-size:small}</style>'
+      '<p>x</p><a class="b">y</a><div id="f">z</div>')
+
+    self.assertIn('<p style="margin:0">', html)
+    self.assertIn('<a class="b" style="color:white;background:blue">', html)
+    self.assertIn('<div id="f" style="font-size:small">', html)
+    self.assertNotIn('<style>', html)
+
+  def test_other_rules_stay_in_style_block(self):
+    html = inline_css(
+      '<style>td p{color:grey} a:hover{color:red} '
+      '@media (max-width:600px){p{margin:4px}}</style><p>x</p>')
+
+    self.assertIn('<style>@media (max-width:600px){p{margin:4px}}td p{color:grey}'
+      'a:hover{color:red}</style>', html)
+    self.assertIn('<p>x</p>', html)
+
+  def test_style_attribute_takes_precedence(self):
+    html = inline_css('<style>a{color:red}</style><a style="color:blue">x</a>')
+    self.assertIn('<a style="color:red;color:blue">', html)
+
+  def test_no_style_block_is_unchanged(self):
+    html = '<p class="b">x</p>'
+    self.assertEqual(inline_css(html), html)
+
+
+class MinifyHtmlTests(SimpleTestCase):
+
+  def test_comments_and_whitespace(self):
+    html = minify_html('<p>\n  a   b <!-- note -->\n</p><pre>  x\n    y</pre>')
+    self.assertEqual(html, '<p>\na b\n</p><pre>  x\n    y</pre>')
+
+  def test_conditional_comments_are_kept(self):
+    html = '<!--[if mso]><table><![endif]-->'
+    self.assertEqual(minify_html(html), html)
+
+
+class RendererTests(SimpleTestCase):
+
+  def setUp(self):
+    renderer.clear()
+
+  def test_template_is_built_when_loaded(self):
+    html = renderer.get_template(TEMPLATE).render({'link': 'https://example.com/x'})
+
+    self.assertIn(
+      '<a class="button" href="https://example.com/x" '
+      'style="color: white;background: blue;padding: 8px">', html)
+    self.assertIn('<div id="footer" style="font-size: small">', html)
+    self.assertIn('<td><p style="margin: 0">Nested</p></td>', html)
+    self.assertIn('td p{color: grey}a:hover{color: red}</style>', html)
+    self.assertIn('<pre>\n  kept\n    as is</pre>', html)
+    self.assertNotIn('the link to follow', html)
+
+  @override_settings(USERS_EMAIL_HTML_INLINE_CSS=False, USERS_EMAIL_HTML_MINIFY=False)
+  def test_build_can_be_turned_off(self):
+    html = renderer.get_template(TEMPLATE).render({'link': 'x'})
+    self.assertIn('<a class="button" href="x" style="padding: 8px">', html)
+    self.assertIn('the link to follow', html)
@@ -0,0 +1,222 @@
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from io import BytesIO
+import importlib
+import time
+from PIL import Image
+from unittest import mock
+from ..mfa import status
+from ..mfa.forms import MfaEnableForm, render_qrcode
+from ..mfa.models import MfaModel
+from ..mfa.views import (
+  PENDING_SECRET_KEY,
+  QRCODE_SALT,
+  MfaQrCodeView,
+  get_secret_key_digest,
+  )
+from ..mfa.totp import decode_secret, get_time_step, hotp
+
+SECRET_KEY = 'JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP'
+
+# the mfa package exports django.forms as "forms"
+forms = importlib.import_module('dwiest.django.users.mfa.forms')
+
+def get_token(secret_key=SECRET_KEY):
+  return hotp(decode_secret(secret_key), get_time_step(), 6).decode('ascii')
+
+class MfaStatusTests(TestCase):
+
+  def setUp(self):
+    cache.clear()
+    self.user = User.objects.create_user('user@example.com', 'user@example.com', 'x')
+
+  def test_status_follows_changes(self):
+    self.assertFalse(status.user_has_mfa(self.user.id))
+
+    with self.captureOnCommitCallbacks(execute=True):
+      user_mfa = MfaModel.objects.create(user=self.user, secret_key='secret')
+    self.assertTrue(status.user_has_mfa(self.user.id))
+
+    with self.captureOnCommitCallbacks(execute=True):
+      user_mfa.delete()
+    self.assertFalse(status.user_has_mfa(self.user.id))
+
+  def test_status_read_before_a_commit_is_not_cached(self):
+    has_mfa_record = status.has_mfa_record
+
+    def read_then_enable(user_id):
+      # this request read the old status, then MFA was enabled and
+      # committed before it could cache it
+      has_mfa = has_mfa_record(user_id)
+      patched.side_effect = has_mfa_record
+      with self.captureOnCommitCallbacks(execute=True):
+        MfaModel.objects.create(user=self.user, secret_key='secret')
+      return has_mfa
+
+    with mock.patch.object(status, 'has_mfa_record', side_effect=read_then_enable) as patched:
+      self.assertFalse(status.user_has_mfa(self.user.id))
+
+    self.assertTrue(status.user_has_mfa(self.user.id))
+
+
+class MfaEnableFormTests(TestCase):
+
+  def setUp(self):
+    cache.clear()
+    render_qrcode.cache_clear()
+    self.user = User.objects.create_user('user@example.com', 'user@example.com', 'password')
+
+  def get_data(self, token=None):
+    return {
+      'password': 'password',
+      'secret_key': SECRET_KEY,
+      'token': token or get_token(),
+      }
+
+  def test_valid_post_does_not_render_the_qrcode(self):
+    self.client.force_login(self.user)
+
+    with mock.patch.object(forms, 'render_qrcode') as patched:
+      response = self.client.post(reverse('mfa_enable'), self.get_data())
+
+    self.assertRedirects(response, reverse('mfa_enable_success'),
+      fetch_redirect_response=False)
+    patched.assert_not_called()
+    self.assertTrue(MfaModel.objects.filter(user=self.user).exists())
+
+  def test_invalid_form_renders_the_qrcode_when_shown(self):
+    form = MfaEnableForm(user=self.user, data=self.get_data(token='000000'))
+
+    with mock.patch.object(forms, 'render_qrcode', return_value=b'png') as patched:
+      self.assertFalse(form.is_valid())
+      patched.assert_not_called()
+
+      form.secret_key_image
+      form.secret_key_image
+      patched.assert_called_once()
+
+  def test_rendered_qrcode_is_cached(self):
+    uri = MfaEnableForm.get_provisioning_uri(SECRET_KEY)
+
+    first = MfaEnableForm.get_qrcode_image(uri)
+    second = MfaEnableForm.get_qrcode_image(uri)
+
+    self.assertIs(first, second)
+    self.assertEqual(render_qrcode.cache_info().misses, 1)
+    self.assertEqual(render_qrcode.cache_info().hits, 1)
+
+  def test_render_settings_are_part_of_the_cache_key(self):
+    uri = MfaEnableForm.get_provisioning_uri(SECRET_KEY)
+    MfaEnableForm.get_qrcode_image(uri)
+
+    with override_settings(USERS_MFA_QRCODE_BOX_SIZE=2):
+      MfaEnableForm.get_qrcode_image(uri)
+
+    self.assertEqual(render_qrcode.cache_info().misses, 2)
+
+  def get_image(self, **kwargs):
+    uri = MfaEnableForm.get_provisioning_uri(SECRET_KEY)
+    with override_settings(USERS_MFA_QRCODE_IMAGE_MODE='P', **kwargs):
+      return Image.open(BytesIO(MfaEnableForm.get_qrcode_image(uri)))
+
+  def test_palette_mode_keeps_black_and_white_as_one_bit(self):
+    self.assertEqual(self.get_image().mode, '1')
+
+  def test_palette_mode_uses_two_colours(self):
+    image = self.get_image(USERS_MFA_QRCODE_FILL_COLOR='navy')
+
+    self.assertEqual(image.mode, 'P')
+    self.assertEqual(len(image.getcolors()), 2)
+
+
+class MfaQrCodeViewTests(TestCase):
+
+  def setUp(self):
+    render_qrcode.cache_clear()
+    self.user = User.objects.create_user('user@example.com', 'user@example.com', 'password')
+    self.client.force_login(self.user)
+
+    session = self.client.session
+    session[PENDING_SECRET_KEY] = SECRET_KEY
+    session.save()
+
+  def get_url(self, secret_key=SECRET_KEY):
+    ref = signing.TimestampSigner(salt=QRCODE_SALT).sign(
+      get_secret_key_digest(secret_key))
+    return reverse('mfa_enable_qrcode', args=[ref])
+
+  def test_image_is_served(self):
+    response = self.client.get(self.get_url())
+
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response['Content-Type'], 'image/png')
+    self.assertTrue(response.content.startswith(b'\x89PNG'))
+    self.assertEqual(response['Cache-Control'], 'private, max-age=600')
+    self.assertEqual(response['ETag'], MfaQrCodeView.get_etag(
+      get_secret_key_digest(SECRET_KEY)))
+
+  def test_matching_etag_is_not_modified(self):
+    etag = self.client.get(self.get_url())['ETag']
+
+    with mock.patch.object(forms, 'render_qrcode') as patched:
+      response = self.client.get(self.get_url(), HTTP_IF_NONE_MATCH=etag)
+
+    self.assertEqual(response.status_code, 304)
+    self.assertEqual(response['ETag'], etag)
+    self.assertTrue(response['Cache-Control'].startswith('private'))
+    patched.assert_not_called()
+
+  def test_etag_follows_the_render_settings(self):
+    etag = self.client.get(self.get_url())['ETag']
+
+    with override_settings(USERS_MFA_QRCODE_BOX_SIZE=2):
+      response = self.client.get(self.get_url(), HTTP_IF_NONE_MATCH=etag)
+
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response['ETag'], etag)
+
+  @override_settings(USERS_MFA_QRCODE_IMAGE_FORMAT='SVG')
+  def test_svg_content_type(self):
+    response = self.client.get(self.get_url())
+
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response['Content-Type'], 'image/svg+xml')
+    self.assertIn(b'<svg', response.content)
+
+  def test_tampered_ref_is_rejected(self):
+    url = self.get_url()
+    ref = url.rstrip('/').rsplit('/', 1)[1]
+    tampered = ('0' if ref[0] != '0' else '1') + ref[1:]
+
+    response = self.client.get(reverse('mfa_enable_qrcode', args=[tampered]))
+    self.assertEqual(response.status_code, 404)
+
+  def test_ref_for_another_secret_is_rejected(self):
+    response = self.client.get(self.get_url('MFRGGZDFMZTWQ2LKNNWG23TPOBYXE43U'))
+    self.assertEqual(response.status_code, 404)
+
+  def test_expired_ref_is_rejected(self):
+    url = self.get_url()
+
+    with mock.patch('django.core.signing.time.time', return_value=time.time() + 601):
+      response = self.client.get(url)
+
+    self.assertEqual(response.status_code, 404)
+
+  def test_ref_without_a_pending_secret_is_rejected(self):
+    session = self.client.session
+    del session[PENDING_SECRET_KEY]
+    session.save()
+
+    response = self.client.get(self.get_url())
+    self.assertEqual(response.status_code, 404)
+
+  def test_login_is_required(self):
+    url = self.get_url()
+    self.client.logout()
+
+    response = self.client.get(url)
+    self.assertEqual(response.status_code, 302)
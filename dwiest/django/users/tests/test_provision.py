@@ -0,0 +1,88 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+import csv
+import io
+import os
+import stat
+import tempfile
+import zipfile
+from ..mfa.models import MfaModel
+from ..mfa.provision import DirectoryWriter, ProvisionResult, ZipWriter, flush
+
+class FailingWriter(DirectoryWriter):
+
+  def __init__(self, path, fail_after):
+    super().__init__(path)
+    self.fail_after = fail_after
+
+  def write(self, name, data):
+    if not self.fail_after:
+      raise OSError('disk full')
+    self.fail_after -= 1
+    super().write(name, data)
+
+
+class ProvisionTests(TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.output = os.path.join(self.directory.name, 'out')
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def get_batch(self, count):
+    batch = []
+    images = {}
+
+    for i in range(count):
+      user = User.objects.create_user('user{}'.format(i))
+      row = MfaModel(user_id=user.pk, secret_key='secret')
+      row.username = user.username
+      batch.append(row)
+      images[user.pk] = b'image'
+
+    return batch, images
+
+  def get_mode(self, path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+  def test_failed_write_rolls_back_the_batch(self):
+    batch, images = self.get_batch(3)
+    writer = FailingWriter(self.output, fail_after=2)
+    result = ProvisionResult()
+
+    with self.assertRaises(OSError):
+      flush(batch, images, writer, csv.writer(io.StringIO()), result)
+
+    self.assertFalse(MfaModel.objects.exists())
+    self.assertEqual(os.listdir(self.output), [])
+    self.assertEqual(result.provisioned, 0)
+
+  def test_batch_is_written_and_saved(self):
+    batch, images = self.get_batch(2)
+    writer = DirectoryWriter(self.output)
+    result = ProvisionResult()
+
+    flush(batch, images, writer, csv.writer(io.StringIO()), result)
+
+    self.assertEqual(MfaModel.objects.count(), 2)
+    self.assertEqual(sorted(os.listdir(self.output)), ['user0.png', 'user1.png'])
+    self.assertEqual(result.provisioned, 2)
+
+  def test_directory_is_private(self):
+    writer = DirectoryWriter(self.output)
+    writer.write('user.png', b'image')
+
+    self.assertEqual(self.get_mode(self.output) & 0o077, 0)
+    self.assertEqual(self.get_mode(os.path.join(self.output, 'user.png')), 0o600)
+
+  def test_zip_is_private(self):
+    path = os.path.join(self.directory.name, 'out.zip')
+    writer = ZipWriter(path)
+    writer.write('user.png', b'image')
+    writer.close()
+
+    self.assertEqual(self.get_mode(path), 0o600)
+    with zipfile.ZipFile(path) as archive:
+      self.assertEqual(archive.read('user.png'), b'image')
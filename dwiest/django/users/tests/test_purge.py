@@ -0,0 +1,51 @@
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+import datetime
+from ..models import ActivationId, PendingRegistration
+from ..purge import purge
+
+class PurgeTests(TestCase):
+
+  def setUp(self):
+    self.now = timezone.now() + datetime.timedelta(days=30)
+
+  def create_user(self, username, pending=True):
+    user = User.objects.create_user(username, username, 'password', is_active=False)
+    ActivationId.objects.issue(user)
+    if pending:
+      PendingRegistration.objects.create(user=user)
+    return user
+
+  def test_only_pending_registrations_are_purged(self):
+    self.create_user('pending@example.com')
+    self.create_user('admin-created@example.com', pending=False)
+
+    result = purge(sleep=0, now=self.now)
+
+    self.assertEqual(result.users, 1)
+    self.assertQuerysetEqual(
+      User.objects.values_list('username', flat=True),
+      ['admin-created@example.com'])
+
+  def test_recent_registration_is_kept(self):
+    self.create_user('pending@example.com')
+    result = purge(sleep=0)
+    self.assertEqual(result.users, 0)
+
+  def test_dry_run_deletes_nothing(self):
+    self.create_user('pending@example.com')
+
+    result = purge(sleep=0, dry_run=True, now=self.now)
+
+    self.assertEqual(result.users, 1)
+    self.assertEqual(User.objects.count(), 1)
+
+  @override_settings(USERS_ACTIVATION_TOKEN_MODE='signed')
+  def test_signed_mode_purge_is_opt_in(self):
+    self.create_user('pending@example.com')
+
+    self.assertEqual(purge(sleep=0, dry_run=True, now=self.now).users, 0)
+
+    with self.settings(USERS_PURGE_SIGNED_MODE_USERS=True):
+      self.assertEqual(purge(sleep=0, dry_run=True, now=self.now).users, 1)
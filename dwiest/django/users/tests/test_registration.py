@@ -0,0 +1,169 @@
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from urllib.parse import parse_qs, urlparse
+from ..forms import RegistrationResendForm
+from ..models import ActivationId, PendingRegistration
+from ..tokens import sign_resend_target
+from ..views import RegistrationConfirmView
+
+@override_settings(USERS_REGISTRATION_ALLOW_EMAIL_RESEND=True)
+class RegistrationResendTests(TestCase):
+
+  def setUp(self):
+    self.user = User.objects.create_user(
+      'user@example.com', 'user@example.com', 'password', is_active=False)
+    self.activation_id = ActivationId.objects.issue(self.user)
+    PendingRegistration.objects.create(user=self.user)
+
+  def get_resend_value(self):
+    response = self.client.post(reverse('registration'), {
+      'username': 'user@example.com',
+      'password1': 'a-Long-passw0rd',
+      'password2': 'a-Long-passw0rd',
+      })
+    self.assertEqual(response.status_code, 302)
+    return parse_qs(urlparse(response.url).query)['activation_id'][0]
+
+  def test_failed_registration_does_not_link_the_digest(self):
+    value = self.get_resend_value()
+
+    self.assertNotIn(self.activation_id.value, value)
+    self.assertNotIn(self.activation_id.token, value)
+
+  def test_resend_value_is_accepted(self):
+    form = RegistrationResendForm(data={'activation_id': self.get_resend_value()})
+    self.assertTrue(form.is_valid(), form.errors)
+    self.assertEqual(form.user, self.user)
+
+  def test_token_is_accepted(self):
+    form = RegistrationResendForm(data={'activation_id': self.activation_id.token})
+    self.assertTrue(form.is_valid(), form.errors)
+    self.assertEqual(form.user, self.user)
+
+  def test_digest_is_rejected(self):
+    form = RegistrationResendForm(data={'activation_id': self.activation_id.value})
+    self.assertFalse(form.is_valid())
+    self.assertIsNone(form.user)
+
+  def test_deactivated_user_is_not_linked(self):
+    PendingRegistration.objects.filter(user=self.user).delete()
+
+    response = self.client.post(reverse('registration'), {
+      'username': 'user@example.com',
+      'password1': 'a-Long-passw0rd',
+      'password2': 'a-Long-passw0rd',
+      })
+
+    self.assertEqual(response.status_code, 302)
+    self.assertNotIn('activation_id', response.url)
+    self.assertIsNone(sign_resend_target(self.user))
+
+  def test_deactivated_user_cannot_resend(self):
+    value = self.get_resend_value()
+    PendingRegistration.objects.filter(user=self.user).delete()
+
+    for activation_id in (value, self.activation_id.token):
+      form = RegistrationResendForm(data={'activation_id': activation_id})
+      self.assertFalse(form.is_valid())
+      self.assertEqual(
+        form.errors.as_data()['__all__'][0].code,
+        RegistrationResendForm.Errors.USER_INVALID)
+
+
+class PendingRegistrationTests(TestCase):
+
+  def test_registering_marks_the_new_user_pending(self):
+    self.client.post(reverse('registration'), {
+      'username': 'new@example.com',
+      'password1': 'a-Long-passw0rd',
+      'password2': 'a-Long-passw0rd',
+      })
+
+    user = User.objects.get(username='new@example.com')
+    self.assertTrue(PendingRegistration.objects.filter(user=user).exists())
+
+  def test_existing_user_is_not_marked_pending(self):
+    User.objects.create_user('old@example.com', 'old@example.com', 'x', is_active=False)
+
+    self.client.post(reverse('registration'), {
+      'username': 'old@example.com',
+      'password1': 'a-Long-passw0rd',
+      'password2': 'a-Long-passw0rd',
+      })
+
+    self.assertFalse(PendingRegistration.objects.exists())
+
+
+@override_settings(CACHES={
+  'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+  'confirm': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'confirm',
+    },
+  },
+  USERS_REGISTRATION_CONFIRM_CACHE='confirm')
+class RegistrationConfirmViewTests(TestCase):
+
+  def setUp(self):
+    self.user = User.objects.create_user(
+      'user@example.com', 'user@example.com', 'password', is_active=False)
+    PendingRegistration.objects.create(user=self.user)
+    self.activation_id = ActivationId.objects.issue(self.user)
+    self.url = reverse('registration_confirm') + '?activation_id=' + self.activation_id.token
+
+  def tearDown(self):
+    caches['confirm'].clear()
+
+  def assert_not_activated(self):
+    self.user.refresh_from_db()
+    self.assertFalse(self.user.is_active)
+    self.assertTrue(ActivationId.objects.filter(pk=self.activation_id.pk).exists())
+
+  def test_head_does_not_activate(self):
+    response = self.client.head(self.url)
+
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response['Cache-Control'], 'no-store')
+    self.assert_not_activated()
+
+  def test_prefetch_does_not_activate(self):
+    for header in ('HTTP_PURPOSE', 'HTTP_SEC_PURPOSE'):
+      response = self.client.get(self.url, **{header: 'prefetch'})
+
+      self.assertEqual(response.status_code, 200)
+      self.assertEqual(response['Cache-Control'], 'no-store')
+      self.assert_not_activated()
+
+  def test_activation_still_works_after_prefetch(self):
+    self.client.get(self.url, HTTP_SEC_PURPOSE='prefetch')
+    response = self.client.get(self.url)
+
+    self.assertRedirects(response, reverse('registration_confirm_success'),
+      fetch_redirect_response=False)
+    self.user.refresh_from_db()
+    self.assertTrue(self.user.is_active)
+
+  def test_repeated_get_shows_the_cached_success(self):
+    self.client.get(self.url)
+    self.assertFalse(ActivationId.objects.exists())
+
+    # the token is gone, only the cache knows it was used
+    self.assertTrue(caches['confirm'].get(
+      RegistrationConfirmView.get_cache_key(self.activation_id.token)))
+    self.assertIsNone(caches['default'].get(
+      RegistrationConfirmView.get_cache_key(self.activation_id.token)))
+
+    response = self.client.get(self.url)
+
+    self.assertRedirects(response, reverse('registration_confirm_success'),
+      fetch_redirect_response=False)
+
+  @override_settings(USERS_REGISTRATION_CONFIRM_CACHE_TIMEOUT=0)
+  def test_repeated_get_fails_without_the_cache(self):
+    self.client.get(self.url)
+    response = self.client.get(self.url)
+
+    self.assertRedirects(response, reverse('registration_confirm_failed'),
+      fetch_redirect_response=False)
@@ -0,0 +1,55 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+import threading
+from ..mfa.models import MfaModel
+from ..mfa.replay import accept_step
+
+THREADS = 8
+
+class AcceptStepTests(TransactionTestCase):
+
+  def setUp(self):
+    cache.clear()
+    user = User.objects.create_user('user@example.com', 'user@example.com', 'x')
+    self.user_mfa = MfaModel.objects.create(user=user, secret_key='secret')
+
+  def accept_concurrently(self, step):
+    barrier = threading.Barrier(THREADS)
+    results = []
+
+    def accept():
+      # each thread gets its own copy, as concurrent requests would
+      user_mfa = MfaModel.objects.get(pk=self.user_mfa.pk)
+      try:
+        barrier.wait()
+        results.append(accept_step(user_mfa, step))
+      finally:
+        connection.close()
+
+    threads = [threading.Thread(target=accept) for i in range(THREADS)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    return results
+
+  def assert_accepted_once(self):
+    results = self.accept_concurrently(100)
+
+    self.assertEqual(len(results), THREADS)
+    self.assertEqual(results.count(True), 1)
+
+    # the step stays used, a later one is accepted
+    self.assertFalse(accept_step(self.user_mfa, 100))
+    self.assertTrue(accept_step(self.user_mfa, 101))
+
+  @override_settings(USERS_MFA_REPLAY_LEDGER='database')
+  def test_database_ledger_accepts_once(self):
+    self.assert_accepted_once()
+
+  @override_settings(USERS_MFA_REPLAY_LEDGER='cache')
+  def test_cache_ledger_accepts_once(self):
+    self.assert_accepted_once()
@@ -0,0 +1,236 @@
+from django.test import SimpleTestCase, override_settings
+from unittest import mock
+import smtplib
+import tempfile
+import time
+from .. import email, metrics
+from ..smtp import CircuitBreaker, PoolTimeoutError, SmtpConnectionPool, is_relay_error
+from ..spool import Spool
+
+class CircuitBreakerTests(SimpleTestCase):
+
+  def open_breaker(self, reset_timeout=0.05):
+    breaker = CircuitBreaker(1, reset_timeout)
+    breaker.record_failure()
+    self.assertEqual(breaker.state, breaker.OPEN)
+    return breaker
+
+  def test_single_probe_after_reset_timeout(self):
+    breaker = self.open_breaker()
+    self.assertFalse(breaker.allow())
+
+    time.sleep(0.06)
+    self.assertTrue(breaker.allow())
+    self.assertEqual(breaker.state, breaker.HALF_OPEN)
+    self.assertFalse(breaker.allow())
+
+  def test_unrecorded_probe_is_replaced(self):
+    breaker = self.open_breaker()
+    time.sleep(0.06)
+    self.assertTrue(breaker.allow())
+
+    time.sleep(0.06)
+    self.assertTrue(breaker.allow())
+
+  def test_successful_probe_closes(self):
+    on_close = mock.Mock()
+    breaker = self.open_breaker()
+    breaker.on_close = on_close
+    time.sleep(0.06)
+    breaker.allow()
+
+    breaker.record_success()
+
+    self.assertEqual(breaker.state, breaker.CLOSED)
+    on_close.assert_called_once_with()
+
+
+@override_settings(USERS_EMAIL_SPOOL_DIR=None)
+class SendEmailBreakerTests(SimpleTestCase):
+
+  def get_pool(self, error):
+    pool = SmtpConnectionPool('localhost', 25, breaker=CircuitBreaker(1, 60))
+    pool.breaker.state = pool.breaker.HALF_OPEN
+    pool.breaker.opened_at = 0
+    pool.sendmail = mock.Mock(side_effect=error)
+    return pool
+
+  def send(self, pool):
+    with mock.patch.object(email, 'get_connection_pool', return_value=pool):
+      email.send_email(['a@example.com'], b'message', sender='from@example.com')
+
+  def test_refused_message_closes_the_circuit(self):
+    pool = self.get_pool(smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'no')}))
+
+    with self.assertRaises(smtplib.SMTPRecipientsRefused):
+      self.send(pool)
+
+    self.assertEqual(pool.breaker.state, pool.breaker.CLOSED)
+
+  def test_relay_error_reopens_the_circuit(self):
+    pool = self.get_pool(smtplib.SMTPServerDisconnected())
+
+    with self.assertRaises(smtplib.SMTPServerDisconnected):
+      self.send(pool)
+
+    self.assertEqual(pool.breaker.state, pool.breaker.OPEN)
+
+
+class PoolRetryTests(SimpleTestCase):
+
+  def get_pool(self, error):
+    pool = SmtpConnectionPool('localhost', 25)
+    pooled = mock.Mock()
+    pooled.sendmail.side_effect = error
+    pool._idle.append((pooled, time.monotonic()))
+    fresh = mock.Mock()
+    fresh.sendmail.return_value = {}
+    pool.connect = mock.Mock(return_value=fresh)
+    return pool, pooled, fresh
+
+  def test_dropped_pooled_connection_is_retried(self):
+    pool, pooled, fresh = self.get_pool(smtplib.SMTPServerDisconnected())
+
+    pool.sendmail('from@example.com', ['a@example.com'], b'message')
+
+    fresh.sendmail.assert_called_once_with('from@example.com', ['a@example.com'], b'message')
+    self.assertEqual([c for c, last_used in pool._idle], [fresh])
+
+  def test_refused_message_is_not_retried(self):
+    pool, pooled, fresh = self.get_pool(
+      smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'no')}))
+
+    with self.assertRaises(smtplib.SMTPRecipientsRefused):
+      pool.sendmail('from@example.com', ['a@example.com'], b'message')
+
+    pool.connect.assert_not_called()
+    # the connection is still usable
+    self.assertEqual([c for c, last_used in pool._idle], [pooled])
+
+  def test_sendmail_stage_excludes_connect(self):
+    pool = SmtpConnectionPool('localhost', 25)
+    connection = mock.Mock()
+    connection.sendmail.return_value = {}
+
+    def connect():
+      with metrics.timed('connect'):
+        time.sleep(0.05)
+      return connection
+
+    pool.connect = connect
+    reporter = mock.Mock()
+
+    with mock.patch.object(metrics, 'get_reporter', return_value=reporter):
+      pool.sendmail('from@example.com', ['a@example.com'], b'message')
+
+    stages = {dict(call.args[2])['stage']: call.args[1]
+      for call in reporter.observe.call_args_list}
+    self.assertEqual(set(stages), {'connect', 'sendmail'})
+    self.assertLess(stages['sendmail'], 0.05)
+
+
+class PoolTests(SimpleTestCase):
+
+  def get_pool(self, **kwargs):
+    pool = SmtpConnectionPool('localhost', 25, **kwargs)
+    self.fresh = mock.Mock()
+    pool.connect = mock.Mock(return_value=self.fresh)
+    return pool
+
+  def add_idle(self, pool, idle_for, noop=(250, b'OK')):
+    connection = mock.Mock()
+    connection.noop.return_value = noop
+    pool._idle.append((connection, time.monotonic() - idle_for))
+    return connection
+
+  def test_idle_connection_is_reused_without_check(self):
+    pool = self.get_pool(health_check_interval=5)
+    idle = self.add_idle(pool, 1)
+
+    self.assertIs(pool.acquire(), idle)
+    idle.noop.assert_not_called()
+    pool.connect.assert_not_called()
+
+  def test_connections_past_max_idle_are_closed(self):
+    pool = self.get_pool(max_idle=60)
+    expired = self.add_idle(pool, 120)
+
+    self.assertIs(pool.acquire(), self.fresh)
+    expired.quit.assert_called_once_with()
+    expired.noop.assert_not_called()
+
+  def test_evict_idle_keeps_recent_connections(self):
+    pool = self.get_pool(max_idle=60)
+    expired = self.add_idle(pool, 120)
+    recent = self.add_idle(pool, 1)
+
+    pool.evict_idle()
+
+    expired.quit.assert_called_once_with()
+    recent.quit.assert_not_called()
+    self.assertEqual([c for c, last_used in pool._idle], [recent])
+
+  def test_healthy_connection_is_checked_and_reused(self):
+    pool = self.get_pool(health_check_interval=5, max_idle=60)
+    idle = self.add_idle(pool, 10)
+
+    self.assertIs(pool.acquire(), idle)
+    idle.noop.assert_called_once_with()
+
+  def test_failed_health_check_replaces_connection(self):
+    pool = self.get_pool(health_check_interval=5, max_idle=60)
+    idle = self.add_idle(pool, 10)
+    idle.noop.side_effect = smtplib.SMTPServerDisconnected()
+
+    self.assertIs(pool.acquire(), self.fresh)
+    idle.noop.assert_called_once_with()
+    idle.quit.assert_called_once_with()
+
+  def test_acquire_times_out_when_pool_is_full(self):
+    pool = self.get_pool(max_size=1, acquire_timeout=0.05)
+    connection = pool.acquire()
+
+    with self.assertRaises(PoolTimeoutError):
+      pool.acquire()
+
+    # a released slot can be taken again
+    pool.release(connection)
+    self.assertIs(pool.acquire(), connection)
+
+
+class SpoolReplayTests(SimpleTestCase):
+
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.spool = Spool(directory.name)
+
+  def test_rejected_message_is_set_aside(self):
+    self.spool.put('from@example.com', ['bad@example.com'], b'one')
+    self.spool.put('from@example.com', ['good@example.com'], b'two')
+    sent = []
+
+    def sendmail(sender, recipients, message):
+      if recipients == ['bad@example.com']:
+        raise smtplib.SMTPRecipientsRefused({'bad@example.com': (550, b'no')})
+      sent.append(message)
+
+    with self.assertLogs('dwiest.django.users.spool', 'ERROR'):
+      count = self.spool.replay(sendmail, should_stop=is_relay_error)
+
+    self.assertEqual(count, 1)
+    self.assertEqual(sent, [b'two'])
+    self.assertEqual(len(self.spool), 0)
+    self.assertEqual(len(self.spool.failed()), 1)
+
+  def test_relay_error_stops_replay(self):
+    self.spool.put('from@example.com', ['a@example.com'], b'one')
+    self.spool.put('from@example.com', ['b@example.com'], b'two')
+    sendmail = mock.Mock(side_effect=smtplib.SMTPServerDisconnected())
+
+    with self.assertRaises(smtplib.SMTPServerDisconnected):
+      self.spool.replay(sendmail, should_stop=is_relay_error)
+
+    self.assertEqual(sendmail.call_count, 1)
+    self.assertEqual(len(self.spool), 2)
+    self.assertEqual(self.spool.failed(), [])
@@ -0,0 +1,217 @@
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from unittest import mock
+import datetime
+import time
+from ..forms import (
+  PasswordResetConfirmForm,
+  RegistrationConfirmForm,
+  RegistrationResendForm,
+  )
+from ..models import ActivationId, PendingRegistration
+from ..tokens import SignedActivationId, TokenPurpose, TokenStatus
+
+class IssueTests(TestCase):
+
+  def setUp(self):
+    self.user = User.objects.create_user('user@example.com', 'user@example.com', 'x')
+
+  def assert_saved(self, activation_id):
+    self.assertFalse(activation_id._state.adding)
+    self.assertEqual(activation_id._state.db, 'default')
+
+    stored = ActivationId.objects.get(pk=activation_id.pk)
+    self.assertEqual(activation_id.created_at, stored.created_at)
+    self.assertEqual(activation_id.value, stored.value)
+
+  def test_issued_activation_id_is_saved(self):
+    self.assert_saved(ActivationId.objects.issue(self.user))
+
+  def test_reissued_activation_id_is_saved(self):
+    first = ActivationId.objects.issue(self.user)
+    second = ActivationId.objects.issue(self.user)
+
+    self.assertEqual(first.pk, second.pk)
+    self.assert_saved(second)
+
+    # the instance can be used like a loaded one
+    second.delete()
+    self.assertFalse(ActivationId.objects.exists())
+
+
+class ResolveTests(TestCase):
+
+  def setUp(self):
+    self.user = User.objects.create_user('user@example.com', 'user@example.com', 'x')
+    self.activation_id = ActivationId.objects.issue(self.user)
+
+  def test_valid_token_with_user_in_one_query(self):
+    with self.assertNumQueries(1):
+      resolution = ActivationId.objects.resolve(
+        self.activation_id.token, expiration_days=1, require_active_user=True)
+      self.assertEqual(resolution.user.username, 'user@example.com')
+
+    self.assertEqual(resolution.status, TokenStatus.VALID)
+
+  def test_expired_token_in_one_query(self):
+    ActivationId.objects.filter(pk=self.activation_id.pk).update(
+      created_at=timezone.now() - datetime.timedelta(days=2))
+
+    with self.assertNumQueries(1):
+      resolution = ActivationId.objects.resolve(
+        self.activation_id.token, expiration_days=1)
+      self.assertEqual(resolution.user, self.user)
+
+    self.assertEqual(resolution.status, TokenStatus.EXPIRED)
+
+  def test_unknown_token_in_one_query(self):
+    with self.assertNumQueries(1):
+      resolution = ActivationId.objects.resolve('unknown', expiration_days=1)
+
+    self.assertEqual(resolution.status, TokenStatus.UNKNOWN)
+    self.assertIsNone(resolution.user)
+
+  def test_inactive_user_in_one_query(self):
+    User.objects.filter(pk=self.user.pk).update(is_active=False)
+
+    with self.assertNumQueries(1):
+      resolution = ActivationId.objects.resolve(
+        self.activation_id.token, expiration_days=1, require_active_user=True)
+
+    self.assertEqual(resolution.status, TokenStatus.USER_INACTIVE)
+
+
+def days_later(days):
+  # TimestampSigner checks the age against the current time
+  return mock.patch(
+    'django.core.signing.time.time', return_value=time.time() + days * 86400)
+
+
+@override_settings(USERS_ACTIVATION_TOKEN_MODE='signed')
+class SignedActivationIdTests(TestCase):
+
+  def setUp(self):
+    self.user = User.objects.create_user(
+      'user@example.com', 'user@example.com', 'password', is_active=False)
+    PendingRegistration.objects.create(user=self.user)
+
+  def get_registration_token(self):
+    return SignedActivationId.issue(self.user, TokenPurpose.REGISTRATION).token
+
+  def get_reset_token(self):
+    User.objects.filter(pk=self.user.pk).update(is_active=True)
+    self.user.refresh_from_db()
+    return SignedActivationId.issue(self.user, TokenPurpose.PASSWORD_RESET).token
+
+  def get_confirm_errors(self, token):
+    form = RegistrationConfirmForm(data={'activation_id': token})
+    self.assertFalse(form.is_valid())
+    return [error.code for error in form.errors.as_data()['activation_id']]
+
+  def get_reset_errors(self, token):
+    # clean_mfa_token() needs the user the token names, so only check
+    # the activation id
+    form = PasswordResetConfirmForm(None)
+    form.cleaned_data = {'activation_id': token}
+
+    try:
+      form.clean_activation_id()
+    except ValidationError as e:
+      return [e.code]
+
+    self.assertEqual(form.user, self.user)
+    return []
+
+  def test_registration_token_is_accepted(self):
+    form = RegistrationConfirmForm(data={'activation_id': self.get_registration_token()})
+    self.assertTrue(form.is_valid(), form.errors)
+    self.assertEqual(form.user, self.user)
+
+  @override_settings(USERS_REGISTRATION_EXPIRATION_DAYS=2)
+  def test_registration_token_expires(self):
+    token = self.get_registration_token()
+
+    with days_later(1):
+      self.assertTrue(RegistrationConfirmForm(data={'activation_id': token}).is_valid())
+
+    with days_later(3):
+      self.assertEqual(self.get_confirm_errors(token),
+        [RegistrationConfirmForm.Errors.ACTIVATION_ID_EXPIRED])
+
+  @override_settings(USERS_PASSWORD_RESET_EXPIRATION_DAYS=1)
+  def test_reset_token_expires(self):
+    token = self.get_reset_token()
+
+    self.assertEqual(self.get_reset_errors(token), [])
+
+    with days_later(2):
+      self.assertEqual(self.get_reset_errors(token),
+        [PasswordResetConfirmForm.Errors.ACTIVATION_ID_EXPIRED])
+
+  def test_registration_token_is_not_a_reset_token(self):
+    token = self.get_registration_token()
+    User.objects.filter(pk=self.user.pk).update(is_active=True)
+
+    self.assertEqual(self.get_reset_errors(token),
+      [PasswordResetConfirmForm.Errors.ACTIVATION_ID_INVALID])
+
+  def test_reset_token_is_not_a_registration_token(self):
+    token = self.get_reset_token()
+    User.objects.filter(pk=self.user.pk).update(is_active=False)
+
+    self.assertEqual(self.get_confirm_errors(token),
+      [RegistrationConfirmForm.Errors.ACTIVATION_ID_INVALID])
+
+  def test_reset_token_fails_after_password_change(self):
+    token = self.get_reset_token()
+    self.user.set_password('another-passw0rd')
+    self.user.save()
+
+    self.assertEqual(self.get_reset_errors(token),
+      [PasswordResetConfirmForm.Errors.ACTIVATION_ID_INVALID])
+
+  def test_reset_token_fails_after_login(self):
+    token = self.get_reset_token()
+    User.objects.filter(pk=self.user.pk).update(last_login=timezone.now())
+
+    self.assertEqual(self.get_reset_errors(token),
+      [PasswordResetConfirmForm.Errors.ACTIVATION_ID_INVALID])
+
+  def test_confirm_view_activates_the_user(self):
+    response = self.client.get(reverse('registration_confirm'),
+      {'activation_id': self.get_registration_token()})
+
+    self.assertRedirects(response, reverse('registration_confirm_success'),
+      fetch_redirect_response=False)
+    self.user.refresh_from_db()
+    self.assertTrue(self.user.is_active)
+    self.assertFalse(PendingRegistration.objects.exists())
+
+  @override_settings(USERS_REGISTRATION_ALLOW_EMAIL_RESEND=True)
+  def test_expired_token_can_be_resent(self):
+    token = self.get_registration_token()
+
+    with days_later(30):
+      form = RegistrationResendForm(data={'activation_id': token})
+      self.assertTrue(form.is_valid(), form.errors)
+      form.save()
+
+    self.assertEqual(form.user, self.user)
+    self.assertTrue(RegistrationConfirmForm(
+      data={'activation_id': form.activation_id.token}).is_valid())
+
+  @override_settings(USERS_REGISTRATION_ALLOW_EMAIL_RESEND=True)
+  def test_resend_view_accepts_the_token(self):
+    response = self.client.get(reverse('registration_resend'),
+      {'activation_id': self.get_registration_token()})
+
+    self.assertRedirects(response, reverse('registration_success'),
+      fetch_redirect_response=False)
+
+  def test_no_activation_id_records(self):
+    self.get_registration_token()
+    self.get_reset_token()
+    self.assertFalse(ActivationId.objects.exists())
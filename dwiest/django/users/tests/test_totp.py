@@ -0,0 +1,70 @@
+from django.test import SimpleTestCase, override_settings
+from ..mfa.totp import INTERVAL, decode_secret, get_time_step, hotp, verify
+
+# RFC 6238 test secret, "12345678901234567890"
+SECRET_KEY = 'GEZDGNBVGY3TQOJQGEZDGNBVGY3TQOJQ'
+NOW = 1111111109 # an RFC 6238 test time
+
+def get_token(step):
+  return hotp(decode_secret(SECRET_KEY), step, 6).decode('ascii')
+
+@override_settings(USERS_MFA_TOKEN_LENGTH=6, USERS_MFA_TOKEN_VALID_WINDOW=1)
+class VerifyTests(SimpleTestCase):
+
+  def setUp(self):
+    self.step = get_time_step(NOW)
+
+  def test_rfc_6238_value(self):
+    self.assertEqual(get_token(get_time_step(59)), '287082')
+    self.assertEqual(get_token(self.step), '081804')
+
+  def test_current_step_is_returned(self):
+    self.assertEqual(verify(SECRET_KEY, get_token(self.step), for_time=NOW), self.step)
+
+  def test_steps_in_the_window_are_returned(self):
+    for offset in (-1, 1):
+      step = self.step + offset
+      self.assertEqual(verify(SECRET_KEY, get_token(step), for_time=NOW), step)
+
+  def test_steps_outside_the_window_are_rejected(self):
+    for offset in (-2, 2):
+      self.assertIsNone(
+        verify(SECRET_KEY, get_token(self.step + offset), for_time=NOW))
+
+  def test_window_argument(self):
+    token = get_token(self.step - 2)
+
+    self.assertIsNone(verify(SECRET_KEY, token, window=1, for_time=NOW))
+    self.assertEqual(verify(SECRET_KEY, token, window=2, for_time=NOW), self.step - 2)
+
+  def test_zero_window_only_accepts_the_current_step(self):
+    self.assertEqual(
+      verify(SECRET_KEY, get_token(self.step), window=0, for_time=NOW), self.step)
+    self.assertIsNone(
+      verify(SECRET_KEY, get_token(self.step + 1), window=0, for_time=NOW))
+
+  def test_step_boundaries(self):
+    start = self.step * INTERVAL
+
+    # the window moves with the step for_time falls in, not with for_time
+    self.assertEqual(
+      verify(SECRET_KEY, get_token(self.step + 1), for_time=start), self.step + 1)
+    self.assertIsNone(
+      verify(SECRET_KEY, get_token(self.step + 1), for_time=start - 1))
+    self.assertEqual(
+      verify(SECRET_KEY, get_token(self.step - 1), for_time=start + INTERVAL - 1),
+      self.step - 1)
+    self.assertIsNone(
+      verify(SECRET_KEY, get_token(self.step - 1), for_time=start + INTERVAL))
+
+  def test_wrong_token_is_rejected(self):
+    token = '000000' if get_token(self.step) != '000000' else '111111'
+    self.assertIsNone(verify(SECRET_KEY, token, window=0, for_time=NOW))
+
+  def test_lower_case_secret_is_accepted(self):
+    self.assertEqual(
+      verify(SECRET_KEY.lower(), get_token(self.step), for_time=NOW), self.step)
+
+  def test_malformed_secret_is_rejected(self):
+    for secret_key in ('not base32!', 'JBSWY3DP1', '0' * 32, None):
+      self.assertIsNone(verify(secret_key, '123456', for_time=NOW))
@@ -0,0 +1,149 @@
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from unittest import mock
+import time
+from ...auth.forms import AuthenticationForm
+from ..mfa.models import MfaModel
+from ..mfa.totp import decode_secret, get_time_step, hotp
+
+SECRET_KEY = 'JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP'
+OTHER_SECRET_KEY = 'MFRGGZDFMZTWQ2LKNNWG23TPOBYXE43U'
+COOKIE_NAME = 'mfa_trusted_device'
+
+def get_token(secret_key=SECRET_KEY):
+  return hotp(decode_secret(secret_key), get_time_step(), 6).decode('ascii')
+
+@override_settings(USERS_MFA_TRUST_DEVICE_DAYS=30, USERS_MFA_TRUST_COOKIE_NAME=COOKIE_NAME)
+class TrustedDeviceTests(TestCase):
+
+  def setUp(self):
+    cache.clear()
+    self.user = User.objects.create_user('user@example.com', 'user@example.com', 'password')
+    MfaModel.objects.create(user=self.user, secret_key=SECRET_KEY)
+
+  def trust_device(self, username='user@example.com', secret_key=SECRET_KEY):
+    response = self.client.post(reverse('login'), {
+      'username': username,
+      'password': 'password',
+      'mfa_token': get_token(secret_key),
+      'trust_device': 'on',
+      })
+
+    self.assertEqual(response.status_code, 302)
+    return response.cookies[COOKIE_NAME]
+
+  def get_form(self, cookie, username='user@example.com'):
+    # no MFA token, only the cookie
+    request = RequestFactory().post(reverse('login'))
+    request.session = SessionStore()
+    request.COOKIES[COOKIE_NAME] = cookie
+
+    return AuthenticationForm(request, data={
+      'username': username,
+      'password': 'password',
+      'mfa_token': '',
+      })
+
+  def assert_trusted(self, cookie, username='user@example.com'):
+    form = self.get_form(cookie, username)
+    self.assertTrue(form.is_valid(), form.errors)
+    self.assertTrue(form.device_trusted)
+
+  def assert_not_trusted(self, cookie, username='user@example.com'):
+    form = self.get_form(cookie, username)
+    self.assertFalse(form.is_valid())
+    self.assertFalse(form.device_trusted)
+
+  def test_cookie_is_set(self):
+    cookie = self.trust_device()
+
+    self.assertTrue(cookie['httponly'])
+    self.assertEqual(cookie['samesite'], 'Lax')
+    self.assertEqual(cookie['max-age'], 30 * 24 * 60 * 60)
+
+  def test_cookie_is_only_set_when_asked(self):
+    response = self.client.post(reverse('login'), {
+      'username': 'user@example.com',
+      'password': 'password',
+      'mfa_token': get_token(),
+      })
+
+    self.assertEqual(response.status_code, 302)
+    self.assertNotIn(COOKIE_NAME, response.cookies)
+
+  def test_trusted_device_skips_the_token(self):
+    self.assert_trusted(self.trust_device().value)
+
+  def test_trusted_login_does_not_renew_the_cookie(self):
+    self.trust_device()
+
+    with mock.patch('dwiest.django.auth.forms.verify') as patched:
+      response = self.client.post(reverse('login'), {
+        'username': 'user@example.com',
+        'password': 'password',
+        'mfa_token': '',
+        'trust_device': 'on',
+        })
+
+    self.assertEqual(response.status_code, 302)
+    patched.assert_not_called()
+    self.assertNotIn(COOKIE_NAME, response.cookies)
+
+  def test_tampered_cookie_is_rejected(self):
+    value = self.trust_device().value
+    self.assert_not_trusted(value[:-1] + ('A' if value[-1] != 'A' else 'B'))
+
+  def test_password_change_revokes(self):
+    value = self.trust_device().value
+    self.user.set_password('password')
+    self.user.save()
+
+    # same password, new salt and hash
+    self.assert_not_trusted(value)
+
+  def test_mfa_reenrollment_revokes(self):
+    value = self.trust_device().value
+    MfaModel.objects.filter(user=self.user).delete()
+    MfaModel.objects.create(user=self.user, secret_key=OTHER_SECRET_KEY)
+    cache.clear()
+
+    self.assert_not_trusted(value)
+
+  def test_cookie_is_for_one_user(self):
+    other = User.objects.create_user('other@example.com', 'other@example.com', 'password')
+    MfaModel.objects.create(user=other, secret_key=SECRET_KEY)
+    value = self.trust_device().value
+
+    self.assert_not_trusted(value, 'other@example.com')
+    self.assert_trusted(value)
+
+  def test_expired_cookie_is_rejected(self):
+    value = self.trust_device().value
+    later = time.time() + 30 * 24 * 60 * 60
+
+    with mock.patch('django.core.signing.time.time', return_value=later - 60):
+      self.assert_trusted(value)
+
+    with mock.patch('django.core.signing.time.time', return_value=later + 1):
+      self.assert_not_trusted(value)
+
+  def test_disabling_mfa_revokes(self):
+    value = self.trust_device().value
+    self.client.force_login(self.user)
+
+    response = self.client.post(reverse('mfa_disable'), {
+      'password': 'password',
+      'disable_mfa': 'I want to make my account less secure',
+      })
+
+    self.assertEqual(response.status_code, 302)
+    self.assertEqual(response.cookies[COOKIE_NAME].value, '')
+    self.assertEqual(response.cookies[COOKIE_NAME]['max-age'], 0)
+
+    # and a cookie kept from before doesn't survive re-enrolling
+    MfaModel.objects.create(user=self.user, secret_key=OTHER_SECRET_KEY)
+    cache.clear()
+    self.assert_not_trusted(value)
@@ -0,0 +1,150 @@
+from django.contrib.auth.models import User
+from django.core import signing
+from django.utils.crypto import salted_hmac
+from enum import Enum
+import datetime
+import hashlib
+import uuid
+from .conf import settings
+
+class TokenMode(str, Enum):
+  DATABASE = 'database'
+  SIGNED = 'signed'
+
+
+class TokenPurpose(str, Enum):
+  PASSWORD_RESET = 'password_reset'
+  REGISTRATION = 'registration'
+  REGISTRATION_RESEND = 'registration_resend'
+
+
+class TokenStatus(str, Enum):
+  EXPIRED = 'expired'
+  UNKNOWN = 'unknown'
+  USER_INACTIVE = 'user_inactive'
+  VALID = 'valid'
+
+
+class TokenResolution:
+  '''
+  The outcome of ActivationId.objects.resolve().  activation_id, with
+  its user, is set unless the token is unknown.
+  '''
+
+  def __init__(self, status, activation_id=None):
+    self.status = status
+    self.activation_id = activation_id
+
+  @property
+  def user(self):
+    return self.activation_id and self.activation_id.user
+
+  def __repr__(self):
+    return '<TokenResolution {}>'.format(self.status.value)
+
+
+def is_signed_mode():
+  return TokenMode(settings.USERS_ACTIVATION_TOKEN_MODE) == TokenMode.SIGNED
+
+def generate_token():
+  return str(uuid.uuid4())
+
+def hash_token(token):
+  '''
+  The digest stored in place of an activation token.  Only the digest
+  is kept, so the database can't be used to build working links.
+  '''
+  return hashlib.sha256(str(token).encode('utf-8')).hexdigest()
+
+def get_signer(purpose):
+  # a token issued for one purpose can't be used for another
+  return signing.TimestampSigner(
+    salt='dwiest.django.users.tokens.{}'.format(TokenPurpose(purpose).value))
+
+def get_fingerprint(user):
+  '''
+  A digest of the user state that changes once a token has been used:
+  the password hash and the last login time.
+  '''
+  last_login = user.last_login and user.last_login.replace(microsecond=0, tzinfo=None)
+  return salted_hmac(
+    'dwiest.django.users.tokens.fingerprint',
+    '{}{}'.format(user.password, last_login),
+    ).hexdigest()[:20]
+
+
+def sign_resend_target(user):
+  '''
+  The value the registration failed page passes to the resend view.  It
+  names the user without being a credential: all it allows is sending
+  a new registration email to the user's own address.  None unless the
+  user registered through RegistrationForm and hasn't activated yet, so
+  an account deactivated by an admin can't be sent an activation link.
+  '''
+  from .models import PendingRegistration # models imports this module
+
+  if not PendingRegistration.objects.filter(user=user).exists():
+    return None
+
+  return get_signer(TokenPurpose.REGISTRATION_RESEND).sign(str(user.pk))
+
+def load_resend_target(value):
+  '''
+  The user named by a sign_resend_target() value.  Raises
+  signing.SignatureExpired if it is too old and signing.BadSignature if
+  it is invalid.
+  '''
+  user_id = get_signer(TokenPurpose.REGISTRATION_RESEND).unsign(
+    value, max_age=settings.USERS_REGISTRATION_RESEND_LINK_MAX_AGE)
+
+  try:
+    return User.objects.get(pk=user_id)
+  except (User.DoesNotExist, ValueError):
+    raise signing.BadSignature('unknown user')
+
+
+class SignedActivationId:
+  '''
+  Stands in for an ActivationId record when USERS_ACTIVATION_TOKEN_MODE
+  is 'signed'.  Everything needed to check the token is in the token.
+  '''
+
+  def __init__(self, user, token):
+    self.user = user
+    self.user_id = user.id
+    self.token = token
+    self.value = token
+
+  @classmethod
+  def issue(cls, user, purpose):
+    value = '{}:{}'.format(user.pk, get_fingerprint(user))
+    return cls(user, get_signer(purpose).sign(value))
+
+  @classmethod
+  def load(cls, token, purpose, max_age_days=None):
+    '''
+    Check the token's signature, age and fingerprint.  Raises
+    signing.SignatureExpired if it is too old and signing.BadSignature
+    if it is invalid or has already been used.
+    '''
+    max_age = None if max_age_days is None else datetime.timedelta(days=max_age_days)
+    value = get_signer(purpose).unsign(token, max_age=max_age)
+    user_id, _, fingerprint = value.partition(':')
+
+    try:
+      user = User.objects.get(pk=user_id)
+    except (User.DoesNotExist, ValueError):
+      raise signing.BadSignature('unknown user')
+
+    if fingerprint != get_fingerprint(user):
+      raise signing.BadSignature('token already used')
+
+    return cls(user, token)
+
+  # there is no record to update or delete
+
+  def save(self):
+    pass
+
+  def delete(self):
+    pass
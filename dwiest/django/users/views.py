@@ -1,7 +1,9 @@
 from django.contrib.auth import update_session_auth_hash
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib import messages
-from django.http import HttpResponseRedirect
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import reverse
 from django.views.generic import FormView, TemplateView
@@ -9,10 +11,18 @@ import json
 from .conf import settings
 from .forms import *
 from .signals import *
+from .tokens import hash_token, sign_resend_target
 
 login_page = 'login'
 status_page = 'home'
 
+PREFETCH_HEADERS = ('HTTP_PURPOSE', 'HTTP_SEC_PURPOSE', 'HTTP_X_PURPOSE', 'HTTP_X_MOZ')
+
+def is_prefetch(request):
+  return any(
+    'prefetch' in request.META.get(header, '').lower()
+    for header in PREFETCH_HEADERS)
+
 class RegistrationView(FormView):
   page_name = 'User Registration'
   template_name = settings.USERS_REGISTRATION_TEMPLATE
@@ -36,9 +46,11 @@ class RegistrationView(FormView):
     process_errors = True
 
     if form.is_valid():
-      form.save()
+      # queued notifications are written in the same transaction
+      with transaction.atomic():
+        form.save()
+        user_registration.send(sender=request.user.__class__, request=request, email=form.user.email, activation_id=form.activation_id)
       request.session['registration_success'] = True
-      user_registration.send(sender=request.user.__class__, request=request, email=form.user.email, activation_id=form.activation_id)
       return HttpResponseRedirect(reverse(self.success_page), self.response_dict)
     else:
       form_errors = json.loads(form.errors.as_json()) # as_data() doesn't include the code
@@ -54,8 +66,11 @@ class RegistrationView(FormView):
         for field, errors in form_errors.items():
           for error in errors:
             messages.error(request, error['message'])
-            if error['code'] == form.Errors.USER_ALREADY_EXISTS and form.activation_id:
-              query_string = '?activation_id=' + form.activation_id.value
+            if error['code'] == form.Errors.USER_ALREADY_EXISTS and form.user:
+              # never put the stored digest in a URL, it is looked up as-is
+              resend_target = sign_resend_target(form.user)
+              if resend_target:
+                query_string = '?activation_id=' + resend_target
 
       request.session['registration_failed'] = True
       return HttpResponseRedirect(reverse(self.fail_page) + query_string, self.response_dict)
@@ -107,7 +122,28 @@ class RegistrationConfirmView(TemplateView):
       'page_name': self.page_name,
     }
 
+  @staticmethod
+  def get_cache():
+    return caches[settings.USERS_REGISTRATION_CONFIRM_CACHE]
+
+  @staticmethod
+  def get_cache_key(activation_id):
+    return 'dwiest-django-users:confirm:' + hash_token(activation_id)
+
+  def head(self, request, *args, **kwargs):
+    # link checkers only need to know the page exists, don't activate
+    return self.get_prefetch_response()
+
+  @staticmethod
+  def get_prefetch_response():
+    response = HttpResponse()
+    response['Cache-Control'] = 'no-store'
+    return response
+
   def get(self, request, *args, **kwargs):
+    if is_prefetch(request):
+      return self.get_prefetch_response()
+
     form = self.form_class(data=request.GET)
     query_string = ''
     process_errors = True
@@ -121,11 +157,26 @@ class RegistrationConfirmView(TemplateView):
       request.session['registration_confirm_failed'] = True
       return HttpResponseRedirect(reverse(self.fail_page), self.response_dict)
 
+    # the link has already been used, most likely by a mail scanner
+    cache_key = self.get_cache_key(activation_id)
+    if settings.USERS_REGISTRATION_CONFIRM_CACHE_TIMEOUT and self.get_cache().get(cache_key):
+      request.session['registration_confirm_success'] = True
+      return HttpResponseRedirect(reverse(self.success_page), self.response_dict)
+
     if form.is_valid():
-      form.save()
+      with transaction.atomic():
+        form.save()
+        user_registration_confirmed.send(sender=request.user.__class__, request=request, email=form.user.email)
+      if settings.USERS_REGISTRATION_CONFIRM_CACHE_TIMEOUT:
+        self.get_cache().set(cache_key, True, settings.USERS_REGISTRATION_CONFIRM_CACHE_TIMEOUT)
+      request.session['registration_confirm_success'] = True
+      return HttpResponseRedirect(reverse(self.success_page), self.response_dict)
+
+    # a concurrent request with the same link may have just succeeded
+    elif settings.USERS_REGISTRATION_CONFIRM_CACHE_TIMEOUT and self.get_cache().get(cache_key):
       request.session['registration_confirm_success'] = True
-      user_registration_confirmed.send(sender=request.user.__class__, request=request, email=form.user.email)
       return HttpResponseRedirect(reverse(self.success_page), self.response_dict)
+
     else:
       form_errors = json.loads(form.errors.as_json()) # as_data() ddoesn't include the code
 
@@ -206,9 +257,10 @@ class RegistrationResendView(TemplateView):
 
     form = self.form_class(data=request.GET)
     if form.is_valid():
-      form.save()
+      with transaction.atomic():
+        form.save()
+        resend_registration_email.send(sender=request.user.__class__, request=request, email=form.user.email, activation_id=form.activation_id)
       request.session[self.success_page] = True
-      resend_registration_email.send(sender=request.user.__class__, request=request, email=form.user.email, activation_id=form.activation_id)
       return HttpResponseRedirect(reverse(self.success_page), self.response_dict)
     else:
       for field, errors in form.errors.as_data().items():
@@ -240,9 +292,15 @@ class SendPasswordResetView(TemplateView):
     form = self.form_class(data=request.POST)
     self.response_dict['form'] = form
 
-    if form.is_valid():
+    # the form issues the activation id while validating, queued
+    # notifications are written in the same transaction
+    with transaction.atomic():
+      is_valid = form.is_valid()
+      if is_valid:
+        password_reset_request.send(sender=request.user.__class__, request=request, email=form.user.email, activation_id=form.activation_id)
+
+    if is_valid:
       request.session['password_reset'] = True
-      password_reset_request.send(sender=request.user.__class__, request=request, email=form.user.email, activation_id=form.activation_id)
       return HttpResponseRedirect(reverse(self.success_page))
     else:
       form_errors = json.loads(form.errors.as_json()) # as_data() ddoesn't include the code
@@ -302,8 +360,9 @@ class PasswordResetConfirmView(TemplateView):
       # prevent the user from being logged out after a password change
       update_session_auth_hash(request, request.user)
       request.session['password_reset_confirm'] = True
-      form.save()
-      password_changed.send(sender=request.user.__class__, request=request, email=form.user.email)
+      with transaction.atomic():
+        form.save()
+        password_changed.send(sender=request.user.__class__, request=request, email=form.user.email)
       return HttpResponseRedirect(reverse(self.success_page))
     else:
       # Don't allow form re-submission for activation id issues
@@ -370,11 +429,12 @@ class PasswordChangeView(LoginRequiredMixin, TemplateView):
     self.response_dict['form'] = form
 
     if form.is_valid():
-      form.save()
+      with transaction.atomic():
+        form.save()
+        password_changed.send(sender=request.user.__class__, request=request, email=request.user.email)
       # prevent the user from being logged out after a password change
       update_session_auth_hash(request, request.user)
       request.session['password_changed'] = True
-      password_changed.send(sender=request.user.__class__, request=request, email=request.user.email)
       return HttpResponseRedirect(reverse(self.success_page))
     else:
       return render(request, self.template_name, self.response_dict)